@@ -11,6 +11,7 @@ from geventhttpclient.url import URL
 from shadowsocks import encrypt, asyncdns, eventloop, tcprelay, udprelay
 
 from gsocks.server import SocksServer
+from gsocks import tuning
 from meeksocks.relay import Relay, MeekRelayFactory
 from lib.ipc import ActorObject, ActorProcess
 from lib.utils import init_logging, load_file, remote_fetch_with_proxy, local_update_datafile, get_ca_certs_env, which
@@ -82,6 +83,7 @@ class MeekChannel(ActorProcess):
         self.ip = confdata['circumvention_proxy_ip']
         self.port = confdata['circumvention_proxy_port']
         self.meekconf = confdata['circumvention_chan_meek']
+        self.tuning = confdata.get('socket_tuning', "default")
         self.ready = False
         
     def _test_relay(self, relay, result):
@@ -125,6 +127,7 @@ class MeekChannel(ActorProcess):
         
     def run(self):
         init_logging()
+        tuning.set_default(self.tuning)
         relays = load_file(os.path.join(self.rootdir, self.meekconf['relays']), idna=False)
         self.meekfactory = MeekRelayFactory(self._valid_relays(relays), get_ca_certs_env(), self.timeout)
         self.proxy = SocksServer(self.ip, self.port, self.meekfactory)
@@ -5,22 +5,21 @@ import collections
 from collections import defaultdict
 
 from gevent import socket
-from fnmatch import fnmatch
 if os.name == 'nt':
     import win_inet_pton
     socket.inet_pton = win_inet_pton.inet_pton
     socket.inet_ntop = win_inet_pton.inet_ntop
 
 from gsocks.smart_relay import ForwardDestination
+from gsocks.dial import create_connection_addrs
 from lib.utils import load_file, remote_update_datafile
 
+# flags of a domain named by a hosts group
+DISABLED = 1
+REDIRECT = 2
+
 def create_connection_hosts(addrs, port, timeout):
-    for addr in addrs:
-        try:
-            return socket.create_connection((addr, port), timeout=timeout)
-        except:
-            pass
-    raise socket.error("all addrs are failed.")  # @UndefinedVariable
+    return create_connection_addrs(addrs, port, timeout)
 
 def create_hosts(rootdir, confdata):
     f = codecs.open(os.path.join(rootdir, confdata['hosts']['meta']), "r", "utf-8")
@@ -80,56 +79,86 @@ class FireflyHosts(object):
             except Exception, e:
                 pass
                 #print "[Hosts]: ", entry, str(e)
+        self.compile()
+            
+    def compile(self):
+        """ index the groups and the data, so that find() is one dict
+        lookup and is_disabled() and need_redirect() one walk of the host's
+        suffixes.
+        
+        a group domain matches itself and the names below it. domains
+        never matched as fnmatch patterns, so wildcards in them are taken
+        literally.
+        """
+        # every suffix of a domain is a key, the ones no group names map to
+        # 0, so a walk stops at the first suffix no domain ends with
+        self.domains = {}
+        for (groupname, domains) in self.meta.get('groups', {}).iteritems():
+            for (domain, redirect) in domains:
+                flags = 0
+                if groupname in self.disabled:
+                    flags |= DISABLED
+                if redirect:
+                    flags |= REDIRECT
+                if flags:
+                    self.add_domain(domain, flags)
+        
+        # name -> (destination without ipv6, destination with ipv6), None
+        # where there is no address to use
+        self.routes = {}
+        for (name, addrs) in self.data.iteritems():
+            if self.domain_flags(name) & DISABLED:
+                continue
+            v4 = [addr for addr in addrs if ":" not in addr]
+            v6 = [addr for addr in addrs if ":" in addr]
+            # assume ipv4 is always available.
+            self.routes[name] = (
+                ForwardDestination("hosts", v4) if v4 else None,
+                ForwardDestination("hosts", v6 + v4) if v6 + v4 else None,
+            )
+        
+    def add_domain(self, domain, flags):
+        domains = self.domains
+        domains[domain] = domains.get(domain, 0) | flags
+        i = domain.find(".")
+        while i >= 0:
+            parent = domain[i+1:]
+            if parent in domains:
+                break
+            domains[parent] = 0
+            i = domain.find(".", i+1)
+            
+    def domain_flags(self, host):
+        """ flags of the group domains host is or is below.
+        """
+        domains = self.domains
+        flags = 0
+        end = len(host)
+        while True:
+            i = host.rfind(".", 0, end)
+            bits = domains.get(host[i+1:])
+            if bits is None:
+                break
+            flags |= bits
+            if i < 0:
+                break
+            end = i
+        return flags
             
     def count(self):
         return len(self.data.keys())
             
     def disable(self, groupname):
         self.disabled.add(groupname)
-        
-    def match_domain(self, domain, host):
-        if fnmatch(domain, host):
-            return True
-        parts = host.split(".")
-        for i in range(len(parts)-1, -1, -1):
-            if ".".join(parts[i:]) == domain:
-                return True
-        return False
+        self.compile()
         
     def need_redirect(self, method, host):
         if method != "GET":
             return False
-        
-        groups = self.meta.get('groups', {})
-        for (_, domains) in groups.iteritems():
-            for (domain, redirect) in domains:
-                if self.match_domain(domain, host) and redirect:
-                    return True        
-        return False
+        return bool(self.domain_flags(host) & REDIRECT)
             
     def is_disabled(self, host):
-        groups = self.meta.get('groups', {})
-        for groupname in self.disabled:
-            domains = groups.get(groupname, [])
-            for (domain, _) in domains:
-                if self.match_domain(domain, host):
-                    return True
-        return False
-    
-    def __classify(self, addrs):
-        v4 = []
-        v6 = []
-        for addr in addrs:
-            if ":" in addr:
-                v6.append(addr)
-            else:
-                v4.append(addr)
-                
-        if self.has_ipv6:
-            # assume ipv4 is always available.
-            return v6 + v4
-        else:
-            return v4 
+        return bool(self.domain_flags(host) & DISABLED)
             
     def find(self, host):
         if not self.enable:
@@ -139,14 +168,10 @@ class FireflyHosts(object):
         if self.has_ipv6 == None:
             self.has_ipv6 = detect_ipv6()
         
-        for name, addrs in self.data.iteritems():
-            if name == host and not self.is_disabled(host):
-                addrs = self.__classify(addrs)
-                if addrs:
-                    return ForwardDestination("hosts", addrs)
-                else:
-                    return None
-        return None
+        route = self.routes.get(host)
+        if route is None:
+            return None
+        return route[1] if self.has_ipv6 else route[0]
     
     def groups(self):
         ret = []
@@ -1,15 +1,25 @@
+import os
+import sys
 import logging
+import threading
 import urlparse
 from httplib import HTTPConnection
 import mimetools
 from StringIO import StringIO
+import multiprocessing
+from multiprocessing.reduction import reduce_socket
 
+import gevent
 from gevent import socket
 
 from gsocks.smart_relay import SmartRelayFactory, SmartRelaySession
 from gsocks.server import SocksServer
-from gsocks.utils import request_success, sock_addr_info, pipe_tcp
+from gsocks.utils import request_success, sock_addr_info
+from gsocks.pump import pump_tcp
 from gsocks.msg import UDPRequest, IP_V4, IP_V6
+from gsocks import tuning
+from gsocks import metrics
+from gsocks.accesslog import open_access_log
 from ghttproxy.smart_relay import HTTP2SocksSmartApplication
 from ghttproxy.server import HTTPProxyServer, copy_request, set_forwarded_for, CHUNKSIZE
 
@@ -19,6 +29,127 @@ from lib.utils import init_logging
 
 log = logging.getLogger(__name__)
 
+# how long a replaced proxy process keeps relaying its sessions
+DRAIN_TIMEOUT = 300
+# how often a successor tries the metrics port its predecessor still holds
+METRICS_RETRY_DELAY = 1
+
+class LocalProxy(ActorProcess):
+    """ a local proxy process which can be replaced without dropping
+    sessions: the successor takes over its listening socket, and it drains,
+    relaying what it has until done or the drain timeout.
+    """
+    timeout = 60
+    drain_timeout = DRAIN_TIMEOUT
+    metrics_port = 0
+    
+    def __init__(self, coordinator, matcher, listener=None):
+        super(LocalProxy, self).__init__()
+        self.coordinator = coordinator
+        self.matcher = matcher
+        # IPC_listener() of the process being replaced
+        self.listener = listener
+        self.ready = multiprocessing.Event()
+        self.draining = multiprocessing.Event()
+        self.proxy = None
+        self.drain_request = None
+        self.accesslog = None
+        self.metrics_server = None
+        
+        confdata = self.coordinator.get('confdata')
+        self.tuning = confdata.get('socket_tuning', "default")
+        self.accesslog_conf = confdata.get('access_log', {})
+        self.rootdir = self.coordinator.get('rootdir')
+        
+    def create_server(self, listener):
+        raise NotImplementedError
+    
+    def inherited_listener(self):
+        if not self.listener:
+            return None
+        rebuild, args = self.listener
+        return socket.socket(_sock=rebuild(*args))
+        
+    def open_access_log(self):
+        conf = self.accesslog_conf
+        if not conf.get('enable'):
+            return None
+        try:
+            return open_access_log(os.path.join(self.rootdir, conf['file']),
+                conf.get('sample', 1.0), conf.get('rate', 0))
+        except Exception, e:
+            log.error("[Exception][LocalProxy.open_access_log]: %s" % str(e))
+            return None
+        
+    def serve_metrics(self):
+        """ serve metrics on the local metrics_port, once a process being
+        replaced has let it go.
+        """
+        server = metrics.MetricsServer("127.0.0.1", self.metrics_port)
+        while True:
+            try:
+                server.start()
+                self.metrics_server = server
+                return
+            except socket.error, e:  # @UndefinedVariable
+                log.debug("metrics port %d not available yet: %s" % (self.metrics_port, str(e)))
+            except Exception, e:
+                log.error("[Exception][LocalProxy.serve_metrics]: %s" % str(e))
+                return
+            gevent.sleep(METRICS_RETRY_DELAY)
+            
+    def start_drain(self):
+        if self.metrics_server:
+            self.metrics_server.stop()
+        self.proxy.drain(self.drain_timeout)
+        
+    def run(self):
+        init_logging()
+        tuning.set_default(self.tuning)
+        self.accesslog = self.open_access_log()
+        self.proxy = self.create_server(self.inherited_listener())
+        # the request comes to a thread, which wakes the hub up with this watcher
+        self.drain_request = gevent.get_hub().loop.async()
+        self.drain_request.start(lambda: gevent.spawn(self.start_drain))
+        t = threading.Thread(target=self.wait_drain)
+        t.daemon = True
+        t.start()
+        self.proxy.start()
+        if self.metrics_port:
+            gevent.spawn(self.serve_metrics)
+        self.ready.set()
+        self.proxy.run()
+        if self.accesslog:
+            self.accesslog.close()
+        
+    def wait_drain(self):
+        self.draining.wait()
+        self.drain_request.send()
+        
+    def drain(self):
+        """ called by the parent. not an IPC interface: the process may be
+        gone before an answer is sent.
+        """
+        self.draining.set()
+        
+    def IPC_addr(self):
+        return (self.ip, self.port)
+    
+    def IPC_matcher_stats(self):
+        return self.matcher.cache_stats()
+    
+    def IPC_listener(self):
+        """ the listening socket reduced for another process, None where
+        sockets cannot be passed.
+        """
+        if sys.platform == 'win32' or not self.ready.is_set():
+            return None
+        try:
+            return reduce_socket(self.proxy.server.socket)
+        except Exception, e:
+            log.error("[Exception][LocalProxy.IPC_listener]: %s" % str(e))
+            return None
+
 class FireflyHTTPApplication(HTTP2SocksSmartApplication):
     def __init__(self, *args, **kwargs):
         super(FireflyHTTPApplication, self).__init__(*args, **kwargs)
@@ -84,27 +215,20 @@ class FireflyHTTPApplication(HTTP2SocksSmartApplication):
         else:
             return self.forward_hosts_http(addrs, host, port, environ, start_response)
 
-class HTTPProxy(ActorProcess):
-    timeout = 60
-    
-    def __init__(self, coordinator, matcher):
-        super(HTTPProxy, self).__init__()
-        self.coordinator = coordinator
-        self.matcher = matcher
+class HTTPProxy(LocalProxy):
+    def __init__(self, coordinator, matcher, listener=None):
+        super(HTTPProxy, self).__init__(coordinator, matcher, listener)
         
         confdata = self.coordinator.get('confdata')
         self.ip = confdata['http_proxy_ip']
         self.port = confdata['http_proxy_port']
+        self.metrics_port = confdata.get('http_proxy_metrics_port', 0)
         
-    def run(self):
-        init_logging()
+    def create_server(self, listener):
         self.application = FireflyHTTPApplication(self.matcher, self.timeout)
-        self.proxy = HTTPProxyServer(self.ip, self.port, self.application, log=None)
-        self.proxy.run()
+        return HTTPProxyServer(self.ip, self.port, self.application, log=None, listener=listener,
+            accesslog=self.accesslog)
         
-    def IPC_addr(self):
-        return (self.ip, self.port)
-    
     def IPC_url(self):
         return "http://%s:%d" % (str(self.ip), self.port)
     
@@ -123,7 +247,7 @@ class FireflyRelaySession(SmartRelaySession):
         self.track_sock(self.remoteconn)
         addrtype, bndaddr, bndport = sock_addr_info(self.remoteconn)
         request_success(self.socksconn, addrtype, bndaddr, bndport)
-        data = self.socksconn.recv(65536)
+        data = self.early_data or self.socksconn.recv(65536)
         if data[:3] == 'GET':
             request, rest = data.split('\r\n', 1)
             method, path, version = request.split()
@@ -140,10 +264,10 @@ class FireflyRelaySession(SmartRelaySession):
                 self.socksconn.sendall("\r\n".join(response))
             else:
                 self.remoteconn.sendall(data)
-                pipe_tcp(self.socksconn, self.remoteconn, self.timeout, self.timeout)
+                pump_tcp(self.socksconn, self.remoteconn, self.timeout, self.timeout)
         else:
             self.remoteconn.sendall(data)
-            pipe_tcp(self.socksconn, self.remoteconn, self.timeout, self.timeout)
+            pump_tcp(self.socksconn, self.remoteconn, self.timeout, self.timeout)
     
     def forward_hosts_udp(self, addrs, localhandler, firstdata, firstaddr):
         orig_req = UDPRequest(firstdata)
@@ -161,27 +285,20 @@ class FireflyRelayFactory(SmartRelayFactory):
     def create_relay_session(self, socksconn, clientaddr):
         return FireflyRelaySession(socksconn, self.timeout, self.matcher)
         
-class SocksProxy(ActorProcess):
-    timeout = 60
-    
-    def __init__(self, coordinator, matcher):
-        super(SocksProxy, self).__init__()
-        self.coordinator = coordinator
-        self.matcher = matcher
+class SocksProxy(LocalProxy):
+    def __init__(self, coordinator, matcher, listener=None):
+        super(SocksProxy, self).__init__(coordinator, matcher, listener)
         
         confdata = self.coordinator.get('confdata')
         self.ip = confdata['socks_proxy_ip']
         self.port = confdata['socks_proxy_port']
+        self.metrics_port = confdata.get('socks_proxy_metrics_port', 0)
         
-    def run(self):
-        init_logging()
+    def create_server(self, listener):
         self.relayfactory = FireflyRelayFactory(self.matcher, self.timeout)
-        self.proxy = SocksServer(self.ip, self.port, self.relayfactory)
-        self.proxy.run()
+        return SocksServer(self.ip, self.port, self.relayfactory, listener=listener,
+            accesslog=self.accesslog)
         
-    def IPC_addr(self):
-        return (self.ip, self.port)
-    
     def IPC_update_matcher(self, matcher):
         self.matcher = matcher
         self.relayfactory.set_matcher(matcher)
@@ -1,13 +1,19 @@
 import os
 import json
-import fnmatch
 import codecs
 import collections
 from urlparse import urlparse
 from gsocks.smart_relay import ForwardMatcher, ForwardDestination
+from gsocks.cidr import CIDRIndex, load_index, parse_network, parse_ip
 
 from component.hosts import create_hosts
 from lib.utils import load_file, remote_update_datafile
+from lib.domainindex import DomainIndex, WHITE, BLACK
+from lib.lrucache import LRUCache
+
+# routing decisions kept per (host, port, proto), and for how long
+DECISION_CACHE_SIZE = 4096
+DECISION_CACHE_TTL = 600
 
 def create_matcher(rootdir, confdata, circumvention_url):
     hosts = create_hosts(rootdir, confdata)
@@ -19,9 +25,16 @@ def create_matcher(rootdir, confdata, circumvention_url):
     custom_blacklist = load_file(os.path.join(rootdir, confdata['custom_blacklist']))
     custom_whitelist = load_file(os.path.join(rootdir, confdata['custom_whitelist']))
     
+    networks = None
+    if confdata.get('networks'):
+        try:
+            networks = load_index(os.path.join(rootdir, confdata['networks']))
+        except Exception, e:
+            print "failed to load networks: %s" % str(e)
+    
     return FireflyMatcher(
         hosts, 
-        BlacklistMatcher(meta, blacklist, custom_blacklist, custom_whitelist, urlparse(circumvention_url))
+        BlacklistMatcher(meta, blacklist, custom_blacklist, custom_whitelist, urlparse(circumvention_url), networks)
     )
     
 def blacklist_info(rootdir, confdata, blacklist_matcher):
@@ -43,28 +56,60 @@ def remote_update_blacklist(proxies, rootdir, confdata):
     return remote_update_datafile(proxies, meta, metafile, metaurl, datafile, dataurl)
     
 
+# values of a compiled networks file and the list each stands for
+NETWORK_FLAGS = {
+    "direct": WHITE,
+    "tunnel": BLACK,
+}
+
 class BlacklistMatcher(ForwardMatcher):
-    def __init__(self, meta, blacklist, custom_blacklist, custom_whitelist, url):
+    def __init__(self, meta, blacklist, custom_blacklist, custom_whitelist, url, networks=None):
         self.meta = meta
         self.blacklist = blacklist
         self.custom_blacklist = custom_blacklist
         self.custom_whitelist = custom_whitelist
         self.dst = ForwardDestination("socks5", url)
+        
+        # whitelisted beats blacklisted, whichever list names the host. IP
+        # literals are looked up in the CIDR ranges of the lists the same
+        # way, and only when no list names them in the compiled networks
+        # file, where the longest range decides, so a "direct" range may
+        # hold a "tunnel" one and the other way round.
+        self.index = DomainIndex()
+        self.networks = CIDRIndex()
+        self.ranges = networks if networks is not None else CIDRIndex()
+        for name in blacklist:
+            if not self.add_network(name, BLACK):
+                self.index.add(name, BLACK)
+        for name in custom_blacklist:
+            if not self.add_network(name, BLACK):
+                self.index.add_pattern(name, BLACK)
+        for name in custom_whitelist:
+            if not self.add_network(name, WHITE):
+                self.index.add_pattern(name, WHITE)
+                
+    def add_network(self, name, flag):
+        try:
+            network = parse_network(name)
+        except ValueError:
+            return False
+        if flag:
+            self.networks.add(network, self.networks.get(network, 0) | flag)
+        return True
             
     def find(self, host, port, proto="tcp"):
-        for name in self.custom_whitelist:
-            if fnmatch.fnmatch(host, name):
-                return None
-            
-        for name in self.custom_blacklist:
-            if fnmatch.fnmatch(host, name):
-                return self.dst
-            
-        parts = host.split(".")
-        for i in range(len(parts)-1, -1, -1):
-            if ".".join(parts[i:]) in self.blacklist:
-                return self.dst
-        return None    
+        if parse_ip(host) is not None:
+            flags = 0
+            for flag in self.networks.lookup_all(host):
+                flags |= flag
+            flags = self.index.match_patterns(host.lower(), flags)
+            if not flags:
+                flags = NETWORK_FLAGS.get(self.ranges.lookup(host), 0)
+        else:
+            flags = self.index.lookup(host)
+        if flags & WHITE or not flags:
+            return None
+        return self.dst
     
     def count(self):
         return len(self.blacklist)
@@ -78,17 +123,36 @@ class BlacklistMatcher(ForwardMatcher):
         return [s.decode("idna") for s in self.custom_whitelist]
     
 class FireflyMatcher(ForwardMatcher):
-    def __init__(self, hosts, blacklist_matcher):
+    """ hosts first, then the blacklist.
+    
+    decisions, direct (None) included, are cached by the matcher itself, so
+    the matcher replacing it on an update starts with an empty cache. hosts
+    groups are disabled that way too (IPC_update_hosts_disabled), never by
+    changing the hosts of a matcher in use.
+    """
+    def __init__(self, hosts, blacklist_matcher, cachesize=DECISION_CACHE_SIZE, cachettl=DECISION_CACHE_TTL):
         super(FireflyMatcher, self).__init__()
         self.hosts = hosts
         self.blacklist_matcher = blacklist_matcher
+        self.cache = LRUCache(cachesize, cachettl)
         
     def find(self, host, port, proto="tcp"):
+        key = (host, port, proto)
+        found, ret = self.cache.get(key)
+        if not found:
+            ret = self.decide(host, port, proto)
+            self.cache.put(key, ret)
+        return ret
+        
+    def decide(self, host, port, proto="tcp"):
         ret = self.hosts.find(host)
         if ret:
             return ret
         return self.blacklist_matcher.find(host, port, proto)
         
+    def cache_stats(self):
+        return self.cache.stats()
+        
     def need_redirect(self, method, host):
         return self.hosts.need_redirect(method, host)
     
@@ -1,3 +1,5 @@
+import sys
+import getopt
 import logging
 import urlparse
 import time
@@ -9,29 +11,61 @@ from gevent.pywsgi import WSGIHandler, WSGIServer
 from gevent.pool import Pool
 from gevent.event import Event
 
+from gsocks.bufpool import default_pool
+from gsocks.timer import default_wheel
+from gsocks import dial
+from gsocks import metrics
+from gsocks import tuning
+from gsocks import accesslog
+from gsocks.admission import AdmissionControl, reject, HTTP_REJECT
+
 log = logging.getLogger(__name__)
 
 CHUNKSIZE = 65536
 
-def pipe_socket(client, remote):
+def pipe_socket(client, remote, pool=default_pool, wheel=default_wheel):
+    """ copy both ways until either side closes or, when remote has a
+    timeout, until nothing moved for that long.
+    """
     def copy(a, b, finish):
+        buf = pool.get()
+        view = memoryview(buf)
+        direction = "up" if a is client else "down"
+        relayed = metrics.relayed_bytes.labels("tcp", direction).tally()
         while not finish.is_set():
             try:
-                data = a.recv(CHUNKSIZE)
-                if not data:
+                n = a.recv_into(buf)
+                if not n:
                     break
-                b.sendall(data)
+                if timer:
+                    timer.reset()
+                b.sendall(view[:n])
+                relayed.value += n
             except:
                 break
+        if record:
+            record.relayed(a is client, relayed.value)
+        relayed.release()
+        pool.put(buf)
         finish.set()
         
+    record = accesslog.current()
     finish = Event()
     finish.clear()
+    timer = None
+    timeout = remote.gettimeout()
+    if timeout:
+        timer = wheel.arm(timeout, finish.set)
+    client.settimeout(None)
+    remote.settimeout(None)
     threads = [
         gevent.spawn(copy, client, remote, finish),
         gevent.spawn(copy, remote, client, finish),
     ]
-    [t.join() for t in threads]
+    finish.wait()
+    if timer:
+        timer.cancel()
+    gevent.killall(threads)
     client.close()
     remote.close()
 
@@ -51,6 +85,8 @@ class ProxyHandler(WSGIHandler):
                         break
                     else:
                         continue
+                # a request gevent could not parse
+                metrics.handshake_failures.labels("http").inc()
                 self.status, response_body = result
                 self.socket.sendall(response_body)
                 if self.time_finish == 0:
@@ -179,17 +215,19 @@ class ProxyApplication(object):
     def http(self, environ, start_response):
         try:
             host, port = get_destination(environ)
-            log.info("HTTP request to (%s:%d)" % (host, port))
+            log.info("HTTP request to (%s:%d)", host, port)
+            accesslog.note(target=(host, port))
             method, url, body, headers = copy_request(environ)
         except Exception, e:
             log.error("[Exception][http]: %s" % str(e))
+            metrics.handshake_failures.labels("http").inc()
             start_response("400 Bad Request", [("Content-Type", "text/plain; charset=utf-8")])
             yield "Bad Request"
             return
         
         try:
             set_forwarded_for(environ, headers)
-            http_conn = socket.create_connection((host, port), timeout=self.timeout)
+            http_conn = dial.create_connection((host, port), timeout=self.timeout)
             conn = HTTPConnection(host, port=port)
             conn.sock = http_conn
             u = urlparse.urlsplit(url)
@@ -197,14 +235,23 @@ class ProxyApplication(object):
             conn.request(method, path, body, headers)
             resp = conn.getresponse()
             start_response("%d %s" % (resp.status, resp.reason), resp.getheaders())
-            while True:
-                data = resp.read(CHUNKSIZE)
-                if not data:
-                    break
-                yield data
+            relayed = metrics.relayed_bytes.labels("http", "down").tally()
+            try:
+                while True:
+                    data = resp.read(CHUNKSIZE)
+                    if not data:
+                        break
+                    relayed.value += len(data)
+                    yield data
+            finally:
+                record = accesslog.current()
+                if record:
+                    record.down += relayed.value
+                relayed.release()
             conn.close()
         except Exception, e:
             log.error("[Exception][http]: %s" % str(e))
+            accesslog.note(error=str(e))
             start_response("500 Internal Server Error", [("Content-Type", "text/plain; charset=utf-8")])
             yield "Internal Server Error"
             return
@@ -212,23 +259,27 @@ class ProxyApplication(object):
     def tunnel(self, environ, start_response):
         try:
             host, port = get_destination(environ)
-            log.info("CONNECT request to (%s:%d)" % (host, port))
+            log.info("CONNECT request to (%s:%d)", host, port)
+            accesslog.note(target=(host, port))
         except Exception, e:
             log.error("[Exception][tunnel]: %s" % str(e))
+            metrics.handshake_failures.labels("http").inc()
             start_response("400 Bad Request", [("Content-Type", "text/plain; charset=utf-8")])
             return ["Bad Request"]
         
         try:
-            tunnel_conn = socket.create_connection((host, port), timeout=self.timeout)
+            tunnel_conn = dial.create_connection((host, port), timeout=self.timeout)
             environ['TUNNEL_CONN'] = tunnel_conn
             start_response("200 Connection established", [])
             return []
         except socket.timeout:  # @UndefinedVariable
             log.error("Connection Timeout")
+            accesslog.note(error="timed out")
             start_response("504 Gateway Timeout", [("Content-Type", "text/plain; charset=utf-8")])
             return ["Gateway Timeout"]
         except Exception, e:
             log.error("[Exception][https]: %s" % str(e))
+            accesslog.note(error=str(e))
             start_response("500 Internal Server Error", [("Content-Type", "text/plain; charset=utf-8")])
             return ["Internal Server Error"]
 
@@ -239,22 +290,69 @@ class ProxyApplication(object):
             return self.http(environ, start_response)
         
 class HTTPProxyServer(object):
-    def __init__(self, ip, port, app, log='default'):
+    def __init__(self, ip, port, app, log='default', maxclient=500, profile=None,
+                 admission=None, listener=None, accesslog=None):
         self.ip = ip
         self.port = port
+        self.accesslog = accesslog
         self.app = app
-        self.server = WSGIServer((self.ip, self.port), log=log,
-            application=self.app.application, spawn=Pool(500), handler_class=ProxyHandler)
+        # None follows tuning.default_profile
+        self.profile = profile
+        self.admission = admission or AdmissionControl(maxclient)
+        self.pool = Pool(self.admission.poolsize)
+        # a listener taken over from a process being drained
+        if listener is None:
+            listener = (self.ip, self.port)
+        self.server = WSGIServer(listener, log=log, handle=self._handle,
+            application=self.app.application, spawn=self.pool, handler_class=ProxyHandler)
+        
+        listen = "%s:%d" % (ip, port)
+        self.accepts = metrics.accepts.labels("http", listen)
+        self.active = metrics.active_sessions.labels("http", listen)
+        self.rejected = {
+            "full": metrics.rejected.labels("http", "full"),
+            "lag": metrics.rejected.labels("http", "lag"),
+        }
+        metrics.pool_used.labels("http", listen).set_function(lambda: len(self.pool))
+        metrics.pool_size.labels("http", listen).set(maxclient)
+        
+    def _handle(self, sock, addr):
+        self.accepts.inc()
+        reason = self.admission.enter()
+        if reason:
+            self.rejected[reason].inc()
+            reject(sock, HTTP_REJECT)
+            return
+        self.active.inc()
+        record = self.accesslog.begin("http", addr) if self.accesslog else None
+        try:
+            (self.profile or tuning.default_profile).accepted(sock)
+            WSGIServer.handle(self.server, sock, addr)
+        finally:
+            if record:
+                self.accesslog.end(record)
+            self.active.dec()
+            self.admission.leave()
         
     def start(self):
         self.server.start()
+        (self.profile or tuning.default_profile).listening(self.server.socket)
         
     def run(self):
+        if not self.server.started:
+            self.start()
         self.server.serve_forever()
     
     def stop(self):
         self.server.stop()
         
+    def drain(self, timeout=None):
+        """ stop accepting, give the sessions being served timeout seconds
+        to finish (None for as long as they last) and kill the rest.
+        """
+        self.server.stop_timeout = timeout
+        self.server.stop(timeout)
+        
     @property
     def closed(self):
         return self.server.closed
@@ -265,5 +363,10 @@ if __name__ == '__main__':
         datefmt='%Y-%d-%m %H:%M:%S',
         level=logging.DEBUG, 
     )
+    # -m, --metrics: local port to serve metrics on
+    opts, _ = getopt.gnu_getopt(sys.argv[1:], "m:", ["metrics="])
+    for o, a in opts:
+        if o == "-m" or o == "--metrics":
+            metrics.MetricsServer("127.0.0.1", int(a)).start()
     HTTPProxyServer("127.0.0.1", 8000, ProxyApplication()).run()
 
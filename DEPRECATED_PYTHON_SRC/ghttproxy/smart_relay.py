@@ -5,6 +5,7 @@ import re
 from server import HTTPProxyServer, ProxyApplication, get_destination
 from socks_relay import HTTP2SocksProxyApplication
 from gsocks.smart_relay import RESocksMatcher, ForwardDestination
+from gsocks import accesslog
 
 log = logging.getLogger(__name__)
 
@@ -47,6 +48,8 @@ class HTTP2SocksSmartApplication(ProxyApplication):
         
         try:
             scheme = self.matcher.find(host, port)
+            if scheme:
+                accesslog.note(route=scheme.scheme)
             if not scheme:
                 return super(HTTP2SocksSmartApplication, self).application(environ, start_response)
             else:
@@ -2,12 +2,11 @@ import logging
 import urlparse
 from httplib import HTTPConnection
 
-from gevent import socket
-
 from server import HTTPProxyServer, ProxyApplication, \
 copy_request, CHUNKSIZE, get_destination, set_forwarded_for
 from gsocks import utils as socksutils
 from gsocks import msg as socksmsg
+from gsocks.upstream import get_pool
 
 log = logging.getLogger(__name__)
 
@@ -21,15 +20,13 @@ class HTTP2SocksProxyApplication(ProxyApplication):
     def connect_socks(self, host, port):
         socksconn = None
         try:
-            socksconn = socket.create_connection((self.socksip, self.socksport), timeout=self.timeout)
-            if not socksutils.basic_handshake_client(socksconn):
-                socksconn.close()
-            addrtype = socksutils.addr_type(host)
-            socksutils.send_request(socksconn, cmd=socksmsg.CONNECT,
-                        addrtype=addrtype, dstaddr=host, dstport=port)
-            reply = socksutils.read_reply(socksconn)
+            # greeting and request go out in one write where the upstream allows it
+            pool = get_pool(self.socksip, self.socksport, self.timeout)
+            req = socksmsg.Request(cmd=socksmsg.CONNECT,
+                        addrtype=socksutils.addr_type(host), dstaddr=host, dstport=port)
+            socksconn, reply = pool.request(req.pack())
             if reply.rep != socksmsg.SUCCEEDED:
-                log.info("error response %d returned from socks server" % reply.rep)
+                log.info("error response %d returned from socks server" % ord(reply.rep))
                 socksconn.close()
                 return None
             return socksconn
@@ -0,0 +1,215 @@
+# per-session access records and logging written by a background thread
+import sys
+import time
+import json
+import random
+import logging
+import threading
+from collections import deque
+
+import gevent
+
+# records or log lines kept while the writer is behind, the rest are dropped
+MAX_QUEUE = 8192
+# seconds between two batches of the writer
+FLUSH_INTERVAL = 1.0
+
+FIELDS = ('time', 'server', 'client', 'target', 'route', 'up', 'down', 'connect', 'duration', 'error')
+
+class BackgroundWriter(object):
+    """ a bounded queue drained in batches by a thread.
+
+    put() only appends to a deque, which needs no lock, so the greenlet
+    producing an item never waits for the I/O of write(items). the thread
+    wakes up every interval seconds, a full queue drops new items.
+    """
+    def __init__(self, write, maxqueue=MAX_QUEUE, interval=FLUSH_INTERVAL):
+        self.write = write
+        self.maxqueue = maxqueue
+        self.interval = interval
+        self.queue = deque()
+        self.dropped = 0
+        self.written = 0
+        self.thread = None
+        self.stopping = False
+
+    def put(self, item):
+        if len(self.queue) >= self.maxqueue:
+            self.dropped += 1
+            return False
+        self.queue.append(item)
+        return True
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopping:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        items = []
+        try:
+            while True:
+                items.append(self.queue.popleft())
+        except IndexError:
+            pass
+        if not items:
+            return
+        try:
+            self.write(items)
+            self.written += len(items)
+        except Exception, e:
+            # logging may be what failed
+            print >> sys.stderr, "[Exception][BackgroundWriter]: %s" % str(e)
+
+    def stop(self):
+        self.stopping = True
+        self.flush()
+
+class Record(object):
+    """ what is known of a session, filled in by the code serving it.
+    """
+    __slots__ = FIELDS + ('start',)
+
+    def __init__(self, server, client):
+        self.start = time.time()
+        self.time = self.start
+        self.server = server
+        self.client = client
+        self.target = None
+        self.route = "direct"
+        self.up = 0
+        self.down = 0
+        self.connect = None
+        self.duration = None
+        self.error = None
+
+    def relayed(self, up, n):
+        if up:
+            self.up += n
+        else:
+            self.down += n
+
+    def as_dict(self):
+        d = dict([(f, getattr(self, f)) for f in FIELDS])
+        # addresses are kept as tuples until written
+        for f in ('client', 'target'):
+            if d[f]:
+                d[f] = "%s:%d" % tuple(d[f][:2])
+        return d
+
+# the record of each greenlet serving a sampled session
+records = {}
+
+def current():
+    """ the record of the session served by the current greenlet, None
+    when it is not logged.
+    """
+    if not records:
+        return None
+    return records.get(gevent.getcurrent())
+
+def note(**fields):
+    """ set fields of the current session's record, if it has one.
+    """
+    record = current()
+    if record is not None:
+        for (k, v) in fields.iteritems():
+            setattr(record, k, v)
+
+class AccessLog(object):
+    """ one JSON line per session, written by a BackgroundWriter.
+
+    sample is the fraction of sessions logged, rate caps the records per
+    second (0 for no cap). both are decided when the session starts, so
+    sessions left out cost a dict lookup wherever they could be noted.
+    """
+    def __init__(self, stream, sample=1.0, rate=0, maxqueue=MAX_QUEUE, interval=FLUSH_INTERVAL):
+        self.stream = stream
+        self.sample = sample
+        self.rate = rate
+        self.tokens = rate
+        self.refilled = time.time()
+        self.sampled_out = 0
+        self.limited = 0
+        self.writer = BackgroundWriter(self.write, maxqueue, interval)
+        self.writer.start()
+
+    def admit(self):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            self.sampled_out += 1
+            return False
+        if self.rate:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                self.limited += 1
+                return False
+            self.tokens -= 1
+        return True
+
+    def begin(self, server, client):
+        """ the record of a session starting in the current greenlet, None
+        when it is not logged. every record must be passed to end().
+        """
+        if not self.admit():
+            return None
+        record = Record(server, client)
+        records[gevent.getcurrent()] = record
+        return record
+
+    def end(self, record):
+        records.pop(gevent.getcurrent(), None)
+        record.duration = time.time() - record.start
+        self.writer.put(record)
+
+    def write(self, batch):
+        self.stream.write("".join([json.dumps(r.as_dict(), sort_keys=True) + "\n" for r in batch]))
+        self.stream.flush()
+
+    def close(self):
+        self.writer.stop()
+
+    def stats(self):
+        return {
+            'written': self.writer.written,
+            'dropped': self.writer.dropped,
+            'sampled_out': self.sampled_out,
+            'limited': self.limited,
+            'queued': len(self.writer.queue),
+        }
+
+def open_access_log(filename, sample=1.0, rate=0):
+    return AccessLog(open(filename, "a"), sample, rate)
+
+class BackgroundHandler(logging.Handler):
+    """ hand log records over to target from the writer thread, so a slow
+    console or disk never blocks the hub. messages are formatted there too.
+    """
+    def __init__(self, target, maxqueue=MAX_QUEUE, interval=0.2):
+        logging.Handler.__init__(self, target.level)
+        self.target = target
+        self.writer = BackgroundWriter(self.write, maxqueue, interval)
+        self.writer.start()
+
+    def emit(self, record):
+        self.writer.put(record)
+
+    def write(self, batch):
+        for record in batch:
+            self.target.handle(record)
+
+    def flush(self):
+        self.writer.flush()
+        self.target.flush()
+
+    def close(self):
+        self.writer.stop()
+        self.target.close()
+        logging.Handler.close(self)
@@ -0,0 +1,142 @@
+# admission control: fail new clients fast instead of queueing them
+import time
+import logging
+
+import gevent
+from gevent import socket
+
+import metrics
+import pump
+
+log = logging.getLogger(__name__)
+
+# lag of the event loop at which new clients are refused
+MAX_LOOP_LAG = 1.0
+# sessions idle for less than this are never evicted
+MIN_EVICT_IDLE = 10
+# how long a rejected client may take to send its first message
+REJECT_TIMEOUT = 1
+
+# no acceptable method, the only reply a socks5 client understands before
+# a method has been chosen
+SOCKS_REJECT = "\x05\xff"
+HTTP_REJECT = "\r\n".join([
+    "HTTP/1.1 503 Service Unavailable",
+    "Content-Type: text/plain; charset=utf-8",
+    "Content-Length: 19",
+    "Retry-After: 1",
+    "Connection: close",
+    "",
+    "Service Unavailable",
+])
+
+class LoopLagMonitor(object):
+    """ measures how late a sleeping greenlet is woken up, which is how
+    long ready callbacks wait for the hub.
+
+    the lag is kept as the latest measure, or half the previous one when
+    that is larger, so a single stall is remembered for a few intervals.
+    """
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.lag = 0.0
+        self.glet = None
+
+    def start(self):
+        if self.glet is None:
+            self.glet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self.glet is not None:
+            self.glet.kill(block=False)
+            self.glet = None
+
+    def _run(self):
+        while True:
+            start = time.time()
+            gevent.sleep(self.interval)
+            lag = max(time.time() - start - self.interval, 0.0)
+            self.lag = max(lag, self.lag / 2)
+
+default_monitor = LoopLagMonitor()
+metrics.loop_lag.set_function(lambda: default_monitor.lag)
+
+class AdmissionControl(object):
+    """ admits at most maxclient concurrent sessions.
+
+    the server's pool is sized maxclient + overflow, so the accept loop
+    keeps running when all sessions are taken and the overflow greenlets
+    only send a refusal. with evict_idle, a full server first ends the TCP
+    relay that has been idle the longest, if that is at least min_idle.
+    """
+    def __init__(self, maxclient, max_lag=MAX_LOOP_LAG, evict_idle=False,
+                 min_idle=MIN_EVICT_IDLE, overflow=None, monitor=default_monitor):
+        self.maxclient = maxclient
+        self.max_lag = max_lag
+        self.evict_idle = evict_idle
+        self.min_idle = min_idle
+        self.overflow = overflow if overflow is not None else max(16, maxclient // 10)
+        self.monitor = monitor
+        self.sessions = set()
+        self.evicted = 0
+        if self.max_lag:
+            self.monitor.start()
+
+    @property
+    def poolsize(self):
+        return self.maxclient + self.overflow
+
+    def evict_oldest_idle(self):
+        oldest = None
+        longest = self.min_idle
+        for glet in self.sessions:
+            p = pump.running.get(glet)
+            if p is None:
+                continue
+            idle = p.idle()
+            if idle >= longest:
+                oldest = p
+                longest = idle
+        if oldest is None:
+            return False
+        log.info("[AdmissionControl] evicting a session idle for %.1f seconds" % longest)
+        oldest.stop()
+        self.evicted += 1
+        return True
+
+    def enter(self):
+        """ None when the current greenlet may serve its client, otherwise
+        why it may not. an admitted greenlet must call leave().
+        """
+        if self.max_lag and self.monitor.lag > self.max_lag:
+            return "lag"
+        if len(self.sessions) >= self.maxclient:
+            if not (self.evict_idle and self.evict_oldest_idle()):
+                return "full"
+        self.sessions.add(gevent.getcurrent())
+        return None
+
+    def leave(self):
+        self.sessions.discard(gevent.getcurrent())
+
+    def stats(self):
+        return {
+            'sessions': len(self.sessions),
+            'maxclient': self.maxclient,
+            'lag': self.monitor.lag,
+            'evicted': self.evicted,
+        }
+
+def reject(sock, response, timeout=REJECT_TIMEOUT):
+    """ answer a refused client and close.
+    """
+    try:
+        sock.settimeout(timeout)
+        # take the client's first message, so that closing with unread
+        # data does not reset the connection before the reply is read
+        sock.recv(4096)
+        sock.sendall(response)
+    except socket.error:  # @UndefinedVariable
+        pass
+    finally:
+        sock.close()
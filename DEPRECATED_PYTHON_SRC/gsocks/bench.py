@@ -0,0 +1,263 @@
+# micro benchmarks for the relay hot paths
+import os
+import re
+import sys
+import time
+import socket as _socket
+import timeit
+
+import gevent
+from gevent import socket
+from gevent.server import StreamServer
+
+from bufpool import BufferPool
+from pump import pump_tcp
+from server import SocksServer
+from relay import SocksRelayFactory
+import utils
+import mmsg
+import msg
+from rules import RuleSet
+
+def usage(f):
+    print >> f, """
+Usage: python -m gsocks.bench <benchmark> [args]
+
+Benchmarks:
+    relay [megabytes]       loopback bulk transfer, recv() copy vs pooled recv_into()
+    msg [iterations]        encode/decode of each socks5 message type
+    udp [packets]           UDP associate echo, per-packet vs recvmmsg/sendmmsg
+    match [rules]           forwarding rule lookups, linear re.match scan vs compiled RuleSet
+    """
+
+class AllocCounter(object):
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+def legacy_pipe(local, remote, counter, bufsize=65536):
+    """ the pre-pool copy loop: one fresh string per recv().
+    """
+    def copy(a, b):
+        while True:
+            data = a.recv(bufsize)
+            counter.calls += 1
+            counter.bytes += bufsize
+            if not data:
+                try:
+                    b.shutdown(socket.SHUT_WR)  # @UndefinedVariable
+                except socket.error:  # @UndefinedVariable
+                    pass
+                return
+            b.sendall(data)
+    gevent.joinall([gevent.spawn(copy, local, remote), gevent.spawn(copy, remote, local)])
+
+def _relay_once(total, relay):
+    payload = "x" * 65536
+
+    def sink(sock, _):
+        while sock.recv(65536):
+            pass
+        sock.close()
+    sinkserver = StreamServer(("127.0.0.1", 0), sink)
+    sinkserver.start()
+
+    def handle(sock, _):
+        remote = socket.create_connection(("127.0.0.1", sinkserver.server_port))
+        relay(sock, remote)
+        remote.close()
+        sock.close()
+    relayserver = StreamServer(("127.0.0.1", 0), handle)
+    relayserver.start()
+
+    conn = socket.create_connection(("127.0.0.1", relayserver.server_port))
+    start = time.time()
+    sent = 0
+    while sent < total:
+        conn.sendall(payload)
+        sent += len(payload)
+    conn.shutdown(socket.SHUT_WR)  # @UndefinedVariable
+    conn.recv(1)
+    elapsed = time.time() - start
+    conn.close()
+    relayserver.stop()
+    sinkserver.stop()
+    return elapsed
+
+def bench_relay(megabytes=256):
+    total = megabytes << 20
+    counter = AllocCounter()
+    elapsed = _relay_once(total, lambda a, b: legacy_pipe(a, b, counter))
+    print "recv() copy:      %8.1f MB/s, %8d payload strings (%d MB requested)" % (
+        megabytes / elapsed, counter.calls, counter.bytes >> 20)
+
+    pool = BufferPool()
+    elapsed = _relay_once(total, lambda a, b: pump_tcp(a, b, 30, 30, pool))
+    print "pooled recv_into: %8.1f MB/s, %8d buffers allocated (high-water %d)" % (
+        megabytes / elapsed, pool.allocated, pool.highwater)
+
+def bench_msg(iterations=200000):
+    buf = bytearray(512)
+    payload = "x" * 512
+    initreq = msg.InitRequest()
+    initreply = msg.InitReply()
+    req4 = msg.Request(addrtype=msg.IP_V4, dstaddr="93.184.216.34", dstport=443)
+    reqd = msg.Request(addrtype=msg.DOMAIN_NAME, dstaddr="www.example.com", dstport=443)
+    reply6 = msg.Reply(addrtype=msg.IP_V6, bndaddr="2001:db8::1", bndport=1080)
+    udpreq = msg.UDPRequest(addrtype=msg.IP_V4, dstaddr="8.8.8.8", dstport=53, data=payload)
+    cases = [
+        ("InitRequest encode", initreq.pack),
+        ("InitRequest decode", lambda s=initreq.pack(): msg.InitRequest(s)),
+        ("InitReply encode", initreply.pack),
+        ("InitReply decode", lambda s=initreply.pack(): msg.InitReply(s)),
+        ("Request(ipv4) encode", req4.pack),
+        ("Request(ipv4) pack_into", lambda: req4.pack_into(buf)),
+        ("Request(ipv4) decode", lambda s=req4.pack(): msg.Request(s)),
+        ("Request(domain) encode", reqd.pack),
+        ("Request(domain) decode", lambda s=reqd.pack(): msg.Request(s)),
+        ("Reply(ipv6) encode", reply6.pack),
+        ("Reply(ipv6) pack_into", lambda: reply6.pack_into(buf)),
+        ("Reply(ipv6) decode", lambda s=reply6.pack(): msg.Reply(s)),
+        ("UDPRequest encode", udpreq.pack),
+        ("UDPRequest pack_into", lambda: udpreq.pack_into(buf)),
+        ("UDPRequest decode", lambda s=udpreq.pack(): msg.UDPRequest(s)),
+        ("udp_header", lambda: msg.udp_header(msg.IP_V4, "8.8.8.8", 53)),
+    ]
+    for (name, func) in cases:
+        elapsed = min(timeit.repeat(func, number=iterations, repeat=3))
+        print "%-26s %8.0f ns/op" % (name, elapsed / iterations * 1e9)
+
+def _udp_peer(packets, burst, ports_w, relay_r, result_w):
+    """ client and echo server, in a forked process with blocking sockets
+    so that only the relay runs on the hub being measured.
+    """
+    echo = _socket.socket(_socket.AF_INET, _socket.SOCK_DGRAM)  # @UndefinedVariable
+    echo.bind(("127.0.0.1", 0))
+    client = _socket.socket(_socket.AF_INET, _socket.SOCK_DGRAM)  # @UndefinedVariable
+    client.bind(("127.0.0.1", 0))
+    os.write(ports_w, "%d %d\n" % (echo.getsockname()[1], client.getsockname()[1]))
+    relayport = int(os.read(relay_r, 64))
+    relay = ("127.0.0.1", relayport)
+    datagram = msg.UDPRequest(addrtype=msg.IP_V4, dstaddr="127.0.0.1",
+                              dstport=echo.getsockname()[1], data="x" * 100).pack()
+    start = time.time()
+    done = 0
+    while done < packets:
+        for _ in range(burst):
+            client.sendto(datagram, relay)
+        for _ in range(burst):
+            data, addr = echo.recvfrom(65536)
+            echo.sendto(data, addr)
+        for _ in range(burst):
+            client.recvfrom(65536)
+        done += burst
+    os.write(result_w, "%f\n" % (time.time() - start))
+
+def _udp_once(packets, burst=32):
+    ports_r, ports_w = os.pipe()
+    relay_r, relay_w = os.pipe()
+    result_r, result_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _udp_peer(packets, burst, ports_w, relay_r, result_w)
+        finally:
+            os._exit(0)
+
+    socks = SocksServer("127.0.0.1", 0, SocksRelayFactory(), timeout=60)
+    socks.start()
+    socket.wait_read(ports_r)
+    echoport, clientport = [int(p) for p in os.read(ports_r, 64).split()]
+    conn = socket.create_connection(("127.0.0.1", socks.server.server_port))
+    utils.basic_handshake_client(conn)
+    utils.send_request(conn, msg.UDP_ASSOCIATE, msg.IP_V4, "127.0.0.1", clientport)
+    reply = utils.read_reply(conn)
+    os.write(relay_w, "%d" % reply.bndport)
+    socket.wait_read(result_r)
+    elapsed = float(os.read(result_r, 64))
+    os.waitpid(pid, 0)
+    conn.close()
+    socks.stop()
+    for fd in (ports_r, ports_w, relay_r, relay_w, result_r, result_w):
+        os.close(fd)
+    return elapsed
+
+def bench_udp(packets=200000):
+    available = mmsg.available
+    try:
+        mmsg.available = False
+        elapsed = _udp_once(packets)
+        print "per-packet:        %8.0f packets/s" % (packets / elapsed)
+    finally:
+        mmsg.available = available
+    if available:
+        elapsed = _udp_once(packets)
+        print "recvmmsg/sendmmsg: %8.0f packets/s" % (packets / elapsed)
+
+def legacy_find(rules, host, port, proto):
+    """ the pre-compilation lookup: three re.match per rule.
+    """
+    for ((h, p, pr), dst) in rules:
+        if re.match(pr, proto) and re.match(h, host) and re.match(p, str(port)):
+            return dst
+    return None
+
+def _match_rules(count):
+    """ mostly domain suffixes, as a blacklist turned into rules would
+    be, plus exact hosts, port restricted rules and free-form regexes.
+    """
+    rules = []
+    for i in range(count):
+        kind = i % 100
+        if kind < 90:
+            host = r'.*\.site%d\.com$' % i
+        elif kind < 95:
+            host = r'^host%d\.example\.org$' % i
+        elif kind < 99:
+            host = r'.*\.secure%d\.net$' % i
+        else:
+            host = r'cdn\d+\.img%d\.net' % i
+        port = r'(443|8443)$' if 95 <= kind < 99 else r'.*'
+        rules.append(((host, port, r'.*'), i))
+    return rules
+
+def bench_match(count=10000):
+    rules = _match_rules(count)
+    # callers hand compiled patterns over, which keeps re's cache out of it
+    compiled_rules = [(tuple([re.compile(p) for p in pattern]), dst) for (pattern, dst) in rules]
+    start = time.time()
+    ruleset = RuleSet(rules)
+    print "compiled %d rules in %.2fs: %d exact, %d suffixes, %d regex chunks" % (
+        count, time.time() - start, len(ruleset.exact), len(ruleset.suffixes), len(ruleset.chunks))
+    lookups = [
+        ("www.site%d.com" % (count // 2), 443, "tcp"),
+        ("host%d.example.org" % (count - 10), 80, "tcp"),
+        ("api.secure%d.net" % (count - 5), 443, "tcp"),
+        ("api.secure%d.net" % (count - 5), 80, "tcp"),
+        ("cdn7.img%d.net" % (count - 1), 80, "udp"),
+        ("www.unlisted.com", 443, "tcp"),
+    ]
+    for (host, port, proto) in lookups:
+        assert legacy_find(compiled_rules, host, port, proto) == ruleset.find(host, port, proto)
+    for (host, port, proto) in lookups:
+        legacy = min(timeit.repeat(lambda: legacy_find(compiled_rules, host, port, proto), number=10, repeat=3)) / 10
+        compiled = min(timeit.repeat(lambda: ruleset.find(host, port, proto), number=10000, repeat=3)) / 10000
+        print "%-26s %-4s linear %10.1f us  compiled %6.2f us  x%.0f" % (
+            "%s:%d" % (host, port), proto, legacy * 1e6, compiled * 1e6, legacy / compiled)
+
+BENCHMARKS = {
+    'relay': (bench_relay, int),
+    'msg': (bench_msg, int),
+    'udp': (bench_udp, int),
+    'match': (bench_match, int),
+}
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        usage(f=sys.stderr)
+        sys.exit(-1)
+    func, argtype = BENCHMARKS[sys.argv[1]]
+    func(*[argtype(a) for a in sys.argv[2:]])
+
+if __name__ == '__main__':
+    main()
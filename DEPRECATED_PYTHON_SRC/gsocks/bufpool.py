@@ -0,0 +1,43 @@
+# preallocated relay buffers shared across sessions
+
+class BufferPool(object):
+    """ a bounded free-list of bytearrays for recv_into().
+
+    get() never blocks: when the free-list is empty a new buffer is
+    allocated, and put() drops buffers beyond maxfree so an idle process
+    does not keep a burst's worth of memory around.
+    """
+    def __init__(self, bufsize=65536, maxfree=256):
+        self.bufsize = bufsize
+        self.maxfree = maxfree
+        self.free = []
+        self.in_use = 0
+        self.highwater = 0
+        self.allocated = 0
+
+    def get(self):
+        if self.free:
+            buf = self.free.pop()
+        else:
+            buf = bytearray(self.bufsize)
+            self.allocated += 1
+        self.in_use += 1
+        if self.in_use > self.highwater:
+            self.highwater = self.in_use
+        return buf
+
+    def put(self, buf):
+        self.in_use -= 1
+        if len(self.free) < self.maxfree:
+            self.free.append(buf)
+
+    def stats(self):
+        return {
+            'bufsize': self.bufsize,
+            'free': len(self.free),
+            'in_use': self.in_use,
+            'highwater': self.highwater,
+            'allocated': self.allocated,
+        }
+
+default_pool = BufferPool()
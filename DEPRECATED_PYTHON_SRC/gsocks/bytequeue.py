@@ -0,0 +1,49 @@
+# a queue of strings with byte accounting and watermark flow control
+from gevent.queue import Queue
+from gevent.event import Event
+
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
+
+class ByteQueue(Queue):
+    """ an unbounded gevent Queue of strings that also counts the bytes it
+    holds.
+
+    put() never blocks, producers are expected to call wait_writable()
+    before reading more from their source: once the queued bytes reach
+    high, it blocks until the consumer brings them down to low.
+    """
+    def __init__(self, high=HIGH_WATERMARK, low=LOW_WATERMARK):
+        Queue.__init__(self)
+        self.high = high
+        self.low = low
+        self.size = 0
+        self.resumed = Event()
+        self.resumed.set()
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self.size += len(item)
+        if self.size >= self.high:
+            self.resumed.clear()
+
+    def _get(self):
+        item = Queue._get(self)
+        self.size -= len(item)
+        if self.size <= self.low:
+            self.resumed.set()
+        return item
+
+    @property
+    def paused(self):
+        return not self.resumed.is_set()
+
+    def wait_writable(self, timeout=None):
+        """ False if still above the low watermark after timeout.
+        """
+        return self.resumed.wait(timeout)
+
+    def clear(self):
+        self.queue.clear()
+        self.size = 0
+        self.resumed.set()
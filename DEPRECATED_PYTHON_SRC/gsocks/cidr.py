@@ -0,0 +1,250 @@
+# longest-prefix matching of IP addresses against CIDR ranges
+import os
+import sys
+import struct
+
+from gevent import socket
+
+if os.name == 'nt':
+    import win_inet_pton
+    socket.inet_pton = win_inet_pton.inet_pton
+    socket.inet_ntop = win_inet_pton.inet_ntop
+
+MAGIC = "CIDR\x01"
+_FAMILIES = {
+    32: (socket.AF_INET, 4),  # @UndefinedVariable
+    128: (socket.AF_INET6, 6),  # @UndefinedVariable
+}
+_BITS = {4: 32, 6: 128}
+
+def _to_int(packed):
+    if len(packed) == 4:
+        return 32, struct.unpack("!I", packed)[0]
+    hi, lo = struct.unpack("!QQ", packed)
+    return 128, (hi << 64) | lo
+
+def _to_packed(bits, n):
+    if bits == 32:
+        return struct.pack("!I", n)
+    return struct.pack("!QQ", n >> 64, n & 0xffffffffffffffff)
+
+def parse_ip(host):
+    """ (32, n) or (128, n) for an IP literal, None for anything else.
+    """
+    # names end with a letter, save them the failing inet_pton
+    if not host or not (host[-1].isdigit() or ":" in host):
+        return None
+    for af in (socket.AF_INET, socket.AF_INET6):  # @UndefinedVariable
+        try:
+            return _to_int(socket.inet_pton(af, host))  # @UndefinedVariable
+        except (socket.error, ValueError, TypeError):  # @UndefinedVariable
+            pass
+    return None
+
+def parse_network(network):
+    """ (bits, prefix, prefixlen) of "addr/len" or of a single address.
+    host bits are cleared, ValueError for anything else.
+    """
+    addr, sep, plen = network.strip().partition("/")
+    parsed = parse_ip(addr)
+    if parsed is None:
+        raise ValueError("not an IP network: %r" % network)
+    bits, n = parsed
+    if sep:
+        if not plen.isdigit() or int(plen) > bits:
+            raise ValueError("bad prefix length: %r" % network)
+        plen = int(plen)
+    else:
+        plen = bits
+    return bits, n >> (bits - plen), plen
+
+def is_network(name):
+    try:
+        parse_network(name)
+        return True
+    except ValueError:
+        return False
+
+class CIDRIndex(object):
+    """ values of IPv4 and IPv6 prefixes.
+
+    prefixes are kept in one dict per family and prefix length, keyed by
+    the prefix bits, so a lookup costs a dict lookup per prefix length in
+    use, longest first, and never more than the address length. national
+    lists of thousands of ranges use a dozen or two lengths.
+    """
+    def __init__(self):
+        # bits -> {prefixlen: {prefix: value}}
+        self.tables = {32: {}, 128: {}}
+        # bits -> prefix lengths in use, longest first
+        self.lengths = {32: [], 128: []}
+        self.count = 0
+
+    def _table(self, bits, plen):
+        table = self.tables[bits].get(plen)
+        if table is None:
+            table = self.tables[bits][plen] = {}
+            self.lengths[bits] = sorted(self.tables[bits], reverse=True)
+        return table
+
+    def add(self, network, value=True):
+        """ network is "addr/len", a single address or a parse_network()
+        tuple. a prefix added twice keeps the last value.
+        """
+        if isinstance(network, basestring):
+            network = parse_network(network)
+        bits, prefix, plen = network
+        table = self._table(bits, plen)
+        if prefix not in table:
+            self.count += 1
+        table[prefix] = value
+
+    def get(self, network, default=None):
+        """ the value of exactly this network.
+        """
+        if isinstance(network, basestring):
+            network = parse_network(network)
+        bits, prefix, plen = network
+        return self.tables[bits].get(plen, {}).get(prefix, default)
+
+    def lookup_all(self, host):
+        """ values of the prefixes containing host, longest prefix first,
+        [] when host is not an IP literal.
+        """
+        parsed = parse_ip(host)
+        if parsed is None:
+            return []
+        bits, n = parsed
+        tables = self.tables[bits]
+        ret = []
+        for plen in self.lengths[bits]:
+            value = tables[plen].get(n >> (bits - plen))
+            if value is not None:
+                ret.append(value)
+        return ret
+
+    def lookup(self, host, default=None):
+        """ value of the longest prefix containing host.
+        """
+        parsed = parse_ip(host)
+        if parsed is None:
+            return default
+        bits, n = parsed
+        tables = self.tables[bits]
+        for plen in self.lengths[bits]:
+            value = tables[plen].get(n >> (bits - plen))
+            if value is not None:
+                return value
+        return default
+
+    def __len__(self):
+        return self.count
+
+    def networks(self):
+        """ ("addr/len", value) of every prefix.
+        """
+        for bits in (32, 128):
+            af = _FAMILIES[bits][0]
+            for plen in self.lengths[bits]:
+                for (prefix, value) in self.tables[bits][plen].iteritems():
+                    addr = socket.inet_ntop(af, _to_packed(bits, prefix << (bits - plen)))  # @UndefinedVariable
+                    yield "%s/%d" % (addr, plen), value
+
+    def dump(self, f):
+        """ write the index to a binary file. values must be strings, 255 of
+        them at most.
+
+        after MAGIC, a 2 bytes count of values and each as a length byte and
+        its bytes, then a 4 bytes count of prefixes, each as its family (4
+        or 6), prefix length and value number, one byte each, followed by
+        the bytes the prefix length covers.
+        """
+        values = sorted(set([v for bits in (32, 128) for t in self.tables[bits].itervalues()
+                             for v in t.itervalues()]))
+        if len(values) > 255:
+            raise ValueError("too many distinct values: %d" % len(values))
+        numbers = dict([(v, i) for (i, v) in enumerate(values)])
+        out = [MAGIC, struct.pack("!H", len(values))]
+        for v in values:
+            out.append(struct.pack("!B", len(v)) + v)
+        out.append(struct.pack("!I", self.count))
+        for bits in (32, 128):
+            family = _FAMILIES[bits][1]
+            for plen in sorted(self.tables[bits]):
+                nbytes = (plen + 7) // 8
+                shift = bits - plen
+                for (prefix, value) in sorted(self.tables[bits][plen].iteritems()):
+                    packed = _to_packed(bits, prefix << shift)[:nbytes]
+                    out.append(struct.pack("!BBB", family, plen, numbers[value]) + packed)
+        f.write("".join(out))
+
+    @classmethod
+    def load(cls, f):
+        data = f.read()
+        if not data.startswith(MAGIC):
+            raise ValueError("not a CIDR index file")
+        offset = len(MAGIC)
+        nvalues, = struct.unpack_from("!H", data, offset)
+        offset += 2
+        values = []
+        for _ in xrange(nvalues):
+            n = ord(data[offset])
+            values.append(data[offset+1:offset+1+n])
+            offset += 1 + n
+        count, = struct.unpack_from("!I", data, offset)
+        offset += 4
+        index = cls()
+        for _ in xrange(count):
+            family, plen, number = struct.unpack_from("!BBB", data, offset)
+            offset += 3
+            bits = _BITS[family]
+            nbytes = (plen + 7) // 8
+            packed = data[offset:offset+nbytes].ljust(bits // 8, "\0")
+            offset += nbytes
+            index.add((bits, _to_int(packed)[1] >> (bits - plen), plen), values[number])
+        return index
+
+def load_index(filename):
+    f = open(filename, "rb")
+    try:
+        return CIDRIndex.load(f)
+    finally:
+        f.close()
+
+def compile_lists(lists):
+    """ an index of text lists, one network per line, given as (value,
+    filename) pairs. later lists win for prefixes in several of them.
+    """
+    index = CIDRIndex()
+    for (value, filename) in lists:
+        f = open(filename, "r")
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                index.add(line, value)
+        f.close()
+    return index
+
+def usage(f):
+    print >> f, """
+Usage: python -m gsocks.cidr compile <output> <value>=<list> [<value>=<list> ...]
+       python -m gsocks.cidr lookup <index> <ip> [<ip> ...]
+    """
+
+def main():
+    if len(sys.argv) >= 4 and sys.argv[1] == "compile":
+        index = compile_lists([arg.split("=", 1) for arg in sys.argv[3:]])
+        f = open(sys.argv[2], "wb")
+        index.dump(f)
+        f.close()
+        print "%d prefixes written to %s" % (len(index), sys.argv[2])
+    elif len(sys.argv) >= 4 and sys.argv[1] == "lookup":
+        index = load_index(sys.argv[2])
+        for ip in sys.argv[3:]:
+            print "%s %s" % (ip, index.lookup(ip))
+    else:
+        usage(f=sys.stderr)
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# dual-stack outbound connections racing (RFC 8305, "happy eyeballs")
+import time
+import logging
+
+import gevent
+from gevent import socket
+from gevent.queue import Queue, Empty
+
+from dnscache import default_cache
+import metrics
+import tuning
+import accesslog
+
+log = logging.getLogger(__name__)
+
+# delay between two connection attempts
+CONNECTION_ATTEMPT_DELAY = 0.25
+# how long to wait for the second family once the first one has answered
+RESOLUTION_DELAY = 0.05
+
+def is_ip(host):
+    for af in (socket.AF_INET, socket.AF_INET6):  # @UndefinedVariable
+        try:
+            socket.inet_pton(af, host)  # @UndefinedVariable
+            return af
+        except (socket.error, ValueError, TypeError):  # @UndefinedVariable
+            pass
+    return None
+
+def interleave(addrinfos):
+    """ alternate address families, keeping the first entry's family first.
+    """
+    if not addrinfos:
+        return []
+    first = addrinfos[0][0]
+    preferred = [a for a in addrinfos if a[0] == first]
+    others = [a for a in addrinfos if a[0] != first]
+    ret = []
+    for i in range(max(len(preferred), len(others))):
+        ret.extend(preferred[i:i+1])
+        ret.extend(others[i:i+1])
+    return ret
+
+def _getaddrinfo(host, port, family):
+    try:
+        return default_cache.getaddrinfo(host, port, family)
+    except (socket.error, socket.gaierror):  # @UndefinedVariable
+        return []
+
+def resolve(host, port):
+    """ resolve AAAA and A concurrently, return [(family, sockaddr), ...]
+    interleaved with IPv6 first.
+    """
+    af = is_ip(host)
+    if af:
+        return [(af, (host, port))]
+
+    results = Queue()
+    def lookup(family):
+        results.put((family, _getaddrinfo(host, port, family)))
+    jobs = [
+        gevent.spawn(lookup, socket.AF_INET6),  # @UndefinedVariable
+        gevent.spawn(lookup, socket.AF_INET),  # @UndefinedVariable
+    ]
+    answers = {}
+    try:
+        family, infos = results.get()
+        answers[family] = infos
+        if infos:
+            # give the other family a moment before going ahead without it
+            try:
+                family, infos = results.get(timeout=RESOLUTION_DELAY)
+                answers[family] = infos
+            except Empty:
+                pass
+        else:
+            family, infos = results.get()
+            answers[family] = infos
+    finally:
+        gevent.killall(jobs, block=False)
+    return interleave(answers.get(socket.AF_INET6, []) + answers.get(socket.AF_INET, []))  # @UndefinedVariable
+
+def _attempt(family, sockaddr, timeout, source_address, results):
+    sock = socket.socket(family, socket.SOCK_STREAM)  # @UndefinedVariable
+    try:
+        tuning.outbound(sock)
+        sock.settimeout(timeout)
+        if source_address:
+            sock.bind(source_address)
+        sock.connect(sockaddr)
+    except socket.error, e:  # @UndefinedVariable
+        sock.close()
+        results.put((None, e))
+        return
+    except:
+        sock.close()
+        raise
+    results.put((sock, None))
+
+def race(addrinfos, timeout, source_address=None):
+    """ start a connection attempt every CONNECTION_ATTEMPT_DELAY seconds, or
+    as soon as the previous one fails, the first connected socket wins.
+    """
+    if not addrinfos:
+        raise socket.error("no address to connect")  # @UndefinedVariable
+    start = time.time()
+    deadline = time.time() + timeout if timeout else None
+    pending = list(addrinfos)
+    results = Queue()
+    attempts = []
+    active = 0
+    winner = None
+    error = None
+    try:
+        while winner is None:
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                metrics.connect_failures.inc()
+                raise socket.timeout("timed out")  # @UndefinedVariable
+            if pending:
+                family, sockaddr = pending.pop(0)
+                attempts.append(gevent.spawn(_attempt, family, sockaddr, remaining,
+                                             source_address, results))
+                active += 1
+                wait = CONNECTION_ATTEMPT_DELAY
+                if remaining is not None:
+                    wait = min(wait, remaining)
+            elif active:
+                wait = remaining
+            else:
+                break
+            try:
+                sock, err = results.get(timeout=wait)
+            except Empty:
+                continue
+            active -= 1
+            if sock:
+                winner = sock
+            else:
+                error = err
+    finally:
+        gevent.killall(attempts)
+        while not results.empty():
+            sock, _ = results.get()
+            if sock and sock is not winner:
+                sock.close()
+    if winner is None:
+        metrics.connect_failures.inc()
+        raise error or socket.error("all addrs are failed.")  # @UndefinedVariable
+    elapsed = time.time() - start
+    metrics.connect_seconds.observe(elapsed)
+    record = accesslog.current()
+    if record:
+        record.connect = elapsed
+    winner.settimeout(timeout)
+    return winner
+
+def create_connection(address, timeout=None, source_address=None):
+    """ drop-in for socket.create_connection() racing IPv6 and IPv4.
+    """
+    host, port = address
+    addrinfos = resolve(host, port)
+    if not addrinfos:
+        raise socket.gaierror("cannot resolve %s" % host)  # @UndefinedVariable
+    return race(addrinfos, timeout, source_address)
+
+def create_connection_addrs(addrs, port, timeout=None):
+    """ race a list of literal IP addresses.
+    """
+    addrinfos = []
+    for addr in addrs:
+        af = is_ip(addr)
+        if af == socket.AF_INET6:  # @UndefinedVariable
+            addrinfos.append((af, (addr, port, 0, 0)))
+        elif af:
+            addrinfos.append((af, (addr, port)))
+    return race(interleave(addrinfos), timeout)
@@ -0,0 +1,163 @@
+# in-process resolver cache shared by outbound dials
+import time
+import socket as _socket
+import logging
+
+import gevent
+from gevent import socket
+from gevent.event import AsyncResult
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# answers that mean "this name has no address of this family"
+NEGATIVE_ERRNOS = set([
+    getattr(_socket, name) for name in ('EAI_NONAME', 'EAI_NODATA', 'EAI_ADDRFAMILY')
+    if hasattr(_socket, name)
+])
+# how long a caller waits for a query before giving up on it
+QUERY_TIMEOUT = 30
+
+class DNSCache(object):
+    """ cache of getaddrinfo() answers keyed by (host, family).
+
+    gevent's resolvers do not hand out record TTLs, so positive answers live
+    for a fixed ttl and NXDOMAIN/NODATA answers for negative_ttl. concurrent
+    lookups of one key share a single query, and a hit within prefetch
+    seconds of expiry refreshes the entry in the background.
+
+    a query runs in a greenlet of its own that callers only wait on, so a
+    caller killed while waiting cancels nothing for the others.
+    """
+    def __init__(self, ttl=60, negative_ttl=10, prefetch=5, maxsize=4096, timeout=QUERY_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.negative_ttl = negative_ttl
+        self.prefetch = prefetch
+        self.maxsize = maxsize
+        # key -> (expires, addresses or None)
+        self.entries = {}
+        # key -> AsyncResult of the running query
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.collapsed = 0
+        self.prefetches = 0
+
+    def _query(self, host, family):
+        try:
+            infos = socket.getaddrinfo(host, 0, family, socket.SOCK_STREAM)  # @UndefinedVariable
+        except socket.gaierror, e:  # @UndefinedVariable
+            if e.args and e.args[0] in NEGATIVE_ERRNOS:
+                return None, self.negative_ttl
+            raise
+        addrs = []
+        for (af, _, _, _, sockaddr) in infos:
+            if (af, sockaddr[0]) not in addrs:
+                addrs.append((af, sockaddr[0]))
+        return addrs, self.ttl
+
+    def _store(self, key, addrs, ttl):
+        if len(self.entries) >= self.maxsize:
+            self.expire()
+            if len(self.entries) >= self.maxsize:
+                self.entries.popitem()
+        self.entries[key] = (time.time() + ttl, addrs)
+
+    def _resolve(self, key):
+        """ the AsyncResult of a new query of key.
+        """
+        result = AsyncResult()
+        self.inflight[key] = result
+        gevent.spawn(self._run, key, result)
+        return result
+
+    def _run(self, key, result):
+        try:
+            addrs, ttl = self._query(*key)
+            self._store(key, addrs, ttl)
+            result.set(addrs)
+        except Exception, e:
+            result.set_exception(e)
+        finally:
+            if self.inflight.get(key) is result:
+                del self.inflight[key]
+            if not result.ready():
+                # killed, waiters must not wait for it
+                result.set_exception(socket.gaierror(_socket.EAI_AGAIN, "Lookup cancelled"))  # @UndefinedVariable
+
+    def _wait(self, result):
+        result.wait(self.timeout)
+        if not result.ready():
+            raise socket.gaierror(_socket.EAI_AGAIN, "Lookup timed out")  # @UndefinedVariable
+        return result.get(block=False)
+
+    def _refresh(self, key):
+        try:
+            self._wait(self._resolve(key))
+        except Exception, e:
+            log.debug("[DNSCache] prefetch %s failed: %s" % (key[0], str(e)))
+
+    def resolve(self, host, family=socket.AF_UNSPEC):  # @UndefinedVariable
+        """ return [(family, ip), ...], raise socket.gaierror for names
+        without addresses.
+        """
+        key = (host, family)
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry and entry[0] > now:
+            self.hits += 1
+            expires, addrs = entry
+            if expires - now < self.prefetch and key not in self.inflight:
+                self.prefetches += 1
+                gevent.spawn(self._refresh, key)
+        else:
+            pending = self.inflight.get(key)
+            if pending is not None:
+                self.collapsed += 1
+                addrs = self._wait(pending)
+            else:
+                self.misses += 1
+                addrs = self._wait(self._resolve(key))
+        if addrs is None:
+            self.negative_hits += 1
+            raise socket.gaierror(_socket.EAI_NONAME, "Name or service not known")  # @UndefinedVariable
+        return addrs
+
+    def getaddrinfo(self, host, port, family=socket.AF_UNSPEC):  # @UndefinedVariable
+        """ return [(family, sockaddr), ...] for host:port.
+        """
+        ret = []
+        for (af, ip) in self.resolve(host, family):
+            if af == socket.AF_INET6:  # @UndefinedVariable
+                ret.append((af, (ip, port, 0, 0)))
+            else:
+                ret.append((af, (ip, port)))
+        return ret
+
+    def expire(self):
+        now = time.time()
+        for key in [k for (k, (expires, _)) in self.entries.iteritems() if expires <= now]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'collapsed': self.collapsed,
+            'prefetches': self.prefetches,
+        }
+
+default_cache = DNSCache()
+metrics.dns_hits.set_function(lambda: default_cache.hits)
+metrics.dns_misses.set_function(lambda: default_cache.misses)
+metrics.dns_negative_hits.set_function(lambda: default_cache.negative_hits)
+metrics.dns_collapsed.set_function(lambda: default_cache.collapsed)
+metrics.dns_prefetches.set_function(lambda: default_cache.prefetches)
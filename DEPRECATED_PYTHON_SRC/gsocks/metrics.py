@@ -0,0 +1,355 @@
+# counters, gauges and histograms served in prometheus text format
+import bisect
+import logging
+
+from gevent.pywsgi import WSGIServer
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (k, _escape(v)) for (k, v) in pairs])
+
+def _format_value(v):
+    if isinstance(v, float):
+        if v == float('inf'):
+            return "+Inf"
+        return repr(v)
+    return str(v)
+
+class Tally(object):
+    """ a private accumulator of a counter.
+
+    the owner adds to value directly, which is as cheap as updating a local
+    attribute, and nothing else writes to it, so one tally per greenlet or
+    thread needs no locking. live tallies are summed into the counter on
+    scrape and folded into it for good by release().
+    """
+    __slots__ = ('counter', 'value')
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.value = 0
+
+    def release(self):
+        counter = self.counter
+        if counter is not None:
+            counter.tallies.discard(self)
+            counter.value += self.value
+            self.counter = None
+
+class CounterChild(object):
+    def __init__(self):
+        self.value = 0
+        self.tallies = set()
+        self.function = None
+
+    def inc(self, n=1):
+        self.value += n
+
+    def tally(self):
+        t = Tally(self)
+        self.tallies.add(t)
+        return t
+
+    def set_function(self, f):
+        """ take the value from f() on every scrape instead, for a count
+        kept by its owner.
+        """
+        self.function = f
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value + sum([t.value for t in self.tallies])
+
+    def samples(self):
+        yield "", (), self.get()
+
+class GaugeChild(object):
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, f):
+        """ take the value from f() on every scrape instead.
+        """
+        self.function = f
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+    def samples(self):
+        yield "", (), self.get()
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+class HistogramChild(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # one slot per bucket plus +Inf, not cumulative until scraped
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+
+    def samples(self):
+        total = 0
+        for (bound, n) in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            yield "_bucket", (("le", _format_value(float(bound))),), total
+        yield "_sum", (), self.sum
+        yield "_count", (), total
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.default = None if self.labelnames else self.labels()
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """ the child for these label values, created on first use. look it
+        up once and keep it on hot paths.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError("%s expects labels %s" % (self.name, str(self.labelnames)))
+        child = self.children.get(values)
+        if child is None:
+            child = self.new_child()
+            self.children[values] = child
+        return child
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+    def collect(self):
+        samples = []
+        for (values, child) in sorted(self.children.items()):
+            try:
+                for (suffix, extra, v) in child.samples():
+                    samples.append((self.name + suffix,
+                                    _format_labels(self.labelnames, values, extra), v))
+            except Exception, e:
+                log.error("[Exception][Metric %s]: %s" % (self.name, str(e)))
+        return (self.name, self.kind, self.documentation, samples)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, n=1):
+        self.default.inc(n)
+
+    def tally(self):
+        return self.default.tally()
+
+    def set_function(self, f):
+        self.default.set_function(f)
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def new_child(self):
+        return GaugeChild()
+
+    def inc(self, n=1):
+        self.default.inc(n)
+
+    def dec(self, n=1):
+        self.default.dec(n)
+
+    def set(self, value):
+        self.default.set(value)
+
+    def set_function(self, f):
+        self.default.set_function(f)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, v):
+        self.default.observe(v)
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.names = set()
+
+    def register(self, metric):
+        if metric.name in self.names:
+            raise ValueError("duplicated metric %s" % metric.name)
+        self.names.add(metric.name)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collect(self):
+        """ [(name, kind, documentation, [(sample, labels, value), ...]), ...]
+        """
+        return [metric.collect() for metric in self.metrics]
+
+    def expose(self):
+        return render(self.collect())
+
+def render(collected):
+    lines = []
+    for (name, kind, documentation, samples) in collected:
+        lines.append("# HELP %s %s" % (name, documentation))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for (sample, labels, v) in samples:
+            lines.append("%s%s %s" % (sample, labels, _format_value(v)))
+    return "\n".join(lines) + "\n"
+
+def merge(collections, maximum=None):
+    """ sum the samples of several collect() results, e.g. of worker
+    processes serving the same port. metrics named in maximum (by default
+    MAXIMUM_MERGED) do not add up across processes, the largest sample is
+    kept instead.
+    """
+    if maximum is None:
+        maximum = MAXIMUM_MERGED
+    names = []
+    merged = {}
+    for collected in collections:
+        for (name, kind, documentation, samples) in collected:
+            if name not in merged:
+                names.append(name)
+                merged[name] = (kind, documentation, [], {})
+            _, _, keys, values = merged[name]
+            for (sample, labels, v) in samples:
+                key = (sample, labels)
+                if key not in values:
+                    keys.append(key)
+                    values[key] = v
+                elif name in maximum:
+                    values[key] = max(values[key], v)
+                else:
+                    values[key] += v
+    ret = []
+    for name in names:
+        kind, documentation, keys, values = merged[name]
+        ret.append((name, kind, documentation, [(s, l, values[(s, l)]) for (s, l) in keys]))
+    return ret
+
+default_registry = Registry()
+
+# metrics shared by the socks, http and meek frontends
+accepts = default_registry.counter("firefly_accepted_connections_total",
+    "Connections accepted by a listener.", ("server", "listen"))
+active_sessions = default_registry.gauge("firefly_active_sessions",
+    "Sessions being served by a listener.", ("server", "listen"))
+pool_used = default_registry.gauge("firefly_pool_used",
+    "Greenlets taken from a listener's pool.", ("server", "listen"))
+pool_size = default_registry.gauge("firefly_pool_size",
+    "Size of a listener's pool (maxclient).", ("server", "listen"))
+rejected = default_registry.counter("firefly_rejected_connections_total",
+    "Connections refused by admission control, by reason.", ("server", "reason"))
+loop_lag = default_registry.gauge("firefly_loop_lag_seconds",
+    "How late the event loop runs ready greenlets.")
+# merged across processes by the worst one
+MAXIMUM_MERGED = set([loop_lag.name])
+handshake_failures = default_registry.counter("firefly_handshake_failures_total",
+    "Client handshakes that failed before a request was read.", ("proto",))
+relayed_bytes = default_registry.counter("firefly_relayed_bytes_total",
+    "Payload bytes relayed, up is from the client towards the remote side.", ("proto", "direction"))
+connect_seconds = default_registry.histogram("firefly_connect_seconds",
+    "Time to establish outbound TCP connections.")
+connect_failures = default_registry.counter("firefly_connect_failures_total",
+    "Outbound TCP connections that could not be established.")
+dns_hits = default_registry.counter("firefly_dns_hits_total",
+    "Lookups answered by the resolver cache.")
+dns_misses = default_registry.counter("firefly_dns_misses_total",
+    "Lookups sent to the resolver.")
+dns_negative_hits = default_registry.counter("firefly_dns_negative_hits_total",
+    "Lookups answered by a cached failure.")
+dns_collapsed = default_registry.counter("firefly_dns_collapsed_total",
+    "Lookups that waited for a query already running for the same name.")
+dns_prefetches = default_registry.counter("firefly_dns_prefetches_total",
+    "Entries refreshed in the background before they expired.")
+upstream_hits = default_registry.counter("firefly_upstream_pool_hits_total",
+    "Upstream connections taken from a pool.", ("upstream",))
+upstream_misses = default_registry.counter("firefly_upstream_pool_misses_total",
+    "Upstream connections wanted from an empty pool.", ("upstream",))
+upstream_evicted = default_registry.counter("firefly_upstream_pool_evicted_total",
+    "Pooled upstream connections dropped as idle too long or closed.", ("upstream",))
+meek_sessions = default_registry.gauge("firefly_meek_sessions",
+    "Meek sessions alive.", ("side",))
+meek_roundtrips = default_registry.counter("firefly_meek_roundtrips_total",
+    "Meek HTTP roundtrips by outcome.", ("result",))
+meek_roundtrip_seconds = default_registry.histogram("firefly_meek_roundtrip_seconds",
+    "Duration of meek HTTP roundtrips.")
+
+class MetricsServer(object):
+    """ serve a registry at /metrics, meant for a local port.
+    """
+    def __init__(self, ip, port, registry=default_registry):
+        self.ip = ip
+        self.port = port
+        self.registry = registry
+        self.server = WSGIServer((self.ip, self.port), self.application, log=None)
+
+    def application(self, environ, start_response):
+        if environ.get('PATH_INFO', '') not in ("/", "/metrics"):
+            start_response("404 Not Found", [("Content-Type", "text/plain; charset=utf-8")])
+            return ["Not Found"]
+        body = self.registry.expose()
+        start_response("200 OK", [("Content-Type", CONTENT_TYPE),
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+
+    def start(self):
+        self.server.start()
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.stop()
+
+    @property
+    def closed(self):
+        return self.server.closed
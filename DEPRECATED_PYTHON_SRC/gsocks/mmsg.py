@@ -0,0 +1,219 @@
+# linux recvmmsg(2)/sendmmsg(2) based batched UDP I/O
+import os
+import sys
+import errno
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+from gevent import socket
+
+log = logging.getLogger(__name__)
+
+MSG_DONTWAIT = 0x40
+
+# datagrams moved per system call
+BATCH = 32
+DATAGRAM_SIZE = 65536
+SOCKADDR_SIZE = 128
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+_recvmmsg = None
+_sendmmsg = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        _recvmmsg = _libc.recvmmsg
+        _recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _recvmmsg.restype = ctypes.c_int
+        _sendmmsg = _libc.sendmmsg
+        _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        _sendmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        _recvmmsg = _sendmmsg = None
+
+available = _recvmmsg is not None and _sendmmsg is not None
+
+# the structures above only give the layout, the arrays handed to the kernel
+# live in bytearrays and are filled with struct so that the system call is
+# the only ctypes call per batch
+_MMSGHDR_SIZE = ctypes.sizeof(mmsghdr)
+_IOVEC_SIZE = ctypes.sizeof(iovec)
+_NAMELEN_OFFSET = msghdr.msg_namelen.offset
+_LEN_OFFSET = mmsghdr.msg_len.offset
+_POINTER = struct.Struct('P')
+_SIZE = struct.Struct('L')  # size_t is unsigned long on linux
+_UINT = struct.Struct('I')
+
+def _address(buf):
+    return ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+
+# sockaddr <-> (ip, port[, flowinfo, scope_id]) caches, cleared when full
+ADDR_CACHE_SIZE = 1024
+_decoded = {}
+_encoded = {}
+
+def _cached(cache, key, value):
+    if len(cache) >= ADDR_CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+    return value
+
+_FAMILY = struct.Struct('=H')
+_IN = struct.Struct('=H2s4s8x')
+_IN6 = struct.Struct('=H2s4s16sI')
+
+def decode_sockaddr(raw):
+    addr = _decoded.get(raw)
+    if addr is None:
+        family = _FAMILY.unpack_from(raw)[0]
+        if family == socket.AF_INET6:  # @UndefinedVariable
+            _, port, flowinfo, packed, scope_id = _IN6.unpack_from(raw)
+            addr = (socket.inet_ntop(family, packed), struct.unpack('!H', port)[0],  # @UndefinedVariable
+                    struct.unpack('!I', flowinfo)[0], scope_id)
+        else:
+            _, port, packed = _IN.unpack_from(raw)
+            addr = (socket.inet_ntop(family, packed), struct.unpack('!H', port)[0])  # @UndefinedVariable
+        addr = _cached(_decoded, raw, addr)
+    return addr
+
+def encode_sockaddr(addr):
+    raw = _encoded.get(addr)
+    if raw is None:
+        port = struct.pack('!H', addr[1])
+        if ':' in addr[0]:
+            af = socket.AF_INET6  # @UndefinedVariable
+            flowinfo, scope_id = addr[2:4] if len(addr) == 4 else (0, 0)
+            raw = _IN6.pack(af, port, struct.pack('!I', flowinfo),
+                            socket.inet_pton(af, addr[0]), scope_id)  # @UndefinedVariable
+        else:
+            af = socket.AF_INET  # @UndefinedVariable
+            raw = _IN.pack(af, port, socket.inet_pton(af, addr[0]))  # @UndefinedVariable
+        raw = _cached(_encoded, addr, raw)
+    return raw
+
+class _Batch(object):
+    """ n slots of datagram buffer, sockaddr buffer, iovec and mmsghdr.
+    """
+    def __init__(self, n=BATCH, size=DATAGRAM_SIZE):
+        self.n = n
+        self.size = size
+        self.data = bytearray(n * size)
+        self.names = bytearray(n * SOCKADDR_SIZE)
+        self.iovs = bytearray(n * _IOVEC_SIZE)
+        self.hdrs = bytearray(n * _MMSGHDR_SIZE)
+        self.hdrs_addr = _address(self.hdrs)
+        data_addr = _address(self.data)
+        names_addr = _address(self.names)
+        iovs_addr = _address(self.iovs)
+        for i in range(n):
+            iov = i * _IOVEC_SIZE
+            _POINTER.pack_into(self.iovs, iov, data_addr + i * size)
+            _SIZE.pack_into(self.iovs, iov + iovec.iov_len.offset, size)
+            hdr = i * _MMSGHDR_SIZE
+            _POINTER.pack_into(self.hdrs, hdr + msghdr.msg_name.offset, names_addr + i * SOCKADDR_SIZE)
+            _UINT.pack_into(self.hdrs, hdr + _NAMELEN_OFFSET, SOCKADDR_SIZE)
+            _POINTER.pack_into(self.hdrs, hdr + msghdr.msg_iov.offset, iovs_addr + iov)
+            _SIZE.pack_into(self.hdrs, hdr + msghdr.msg_iovlen.offset, 1)
+        # slots whose msg_namelen the kernel has overwritten
+        self.dirty = 0
+
+    def recv(self, fd, n):
+        n = min(n, self.n)
+        for i in range(self.dirty):
+            _UINT.pack_into(self.hdrs, i * _MMSGHDR_SIZE + _NAMELEN_OFFSET, SOCKADDR_SIZE)
+        self.dirty = 0
+        got = _recvmmsg(fd, self.hdrs_addr, n, MSG_DONTWAIT, None)
+        if got < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise socket.error(err, os.strerror(err))  # @UndefinedVariable
+        self.dirty = got
+        ret = []
+        for i in range(got):
+            hdr = i * _MMSGHDR_SIZE
+            length = _UINT.unpack_from(self.hdrs, hdr + _LEN_OFFSET)[0]
+            namelen = _UINT.unpack_from(self.hdrs, hdr + _NAMELEN_OFFSET)[0]
+            ret.append((str(buffer(self.data, i * self.size, length)),
+                        decode_sockaddr(str(buffer(self.names, i * SOCKADDR_SIZE, namelen)))))
+        return ret
+
+    def send(self, fd, packets):
+        """ number of packets sent, None if the socket is full.
+        """
+        n = min(len(packets), self.n)
+        for i in range(n):
+            data, addr = packets[i]
+            name = encode_sockaddr(addr)
+            offset = i * self.size
+            self.data[offset:offset+len(data)] = data
+            offset = i * SOCKADDR_SIZE
+            self.names[offset:offset+len(name)] = name
+            _SIZE.pack_into(self.iovs, i * _IOVEC_SIZE + iovec.iov_len.offset, len(data))
+            _UINT.pack_into(self.hdrs, i * _MMSGHDR_SIZE + _NAMELEN_OFFSET, len(name))
+        sent = _sendmmsg(fd, self.hdrs_addr, n, MSG_DONTWAIT)
+        if sent < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            # the first datagram is refused, drop it and go on with the rest
+            log.info("[sendmany] datagram to %s dropped: %s" % (str(packets[0][1]), os.strerror(err)))
+            return 1
+        return sent
+
+# one batch per direction, shared by every socket of the process: they are
+# only used between two points where the greenlet can not switch
+_rbatch = None
+_sbatch = None
+
+def recvmany(sock, n=BATCH):
+    """ up to n (data, addr) from a readable socket, at least one unless
+    the readiness was spurious.
+    """
+    global _rbatch
+    if not available:
+        return [sock.recvfrom(DATAGRAM_SIZE)]
+    if _rbatch is None:
+        _rbatch = _Batch()
+    return _rbatch.recv(sock.fileno(), n)
+
+def sendmany(sock, packets):
+    """ send [(data, addr), ...], waiting for the socket to drain if needed.
+    """
+    global _sbatch
+    if available and len(packets) > 1:
+        if _sbatch is None:
+            _sbatch = _Batch()
+        fd = sock.fileno()
+        while packets:
+            sent = _sbatch.send(fd, packets)
+            if sent is None:
+                # the socket is full, let gevent wait for it packet by packet
+                break
+            packets = packets[sent:]
+    for (data, addr) in packets:
+        sock.sendto(data, addr)
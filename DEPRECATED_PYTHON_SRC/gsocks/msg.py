@@ -3,7 +3,6 @@ import os
 import struct
 
 from gevent import socket
-import dpkt
 
 if os.name == 'nt':
     import win_inet_pton
@@ -23,7 +22,7 @@ UDP_ASSOCIATE   = '\x03'
 
 # methods
 NO_AUTHENTICATION_REQUIRED  = '\x00'
-NO_ACCEPTABLE_METHODS       = '\xff' 
+NO_ACCEPTABLE_METHODS       = '\xff'
 
 # address type
 IP_V4       = '\x01'
@@ -39,127 +38,264 @@ CONNECTION_REFUSED              = '\x04'
 TTL_EXPIRED                     = '\x06'
 CMD_NOT_SUPPORTED               = '\x07'
 ADDR_TYPE_NOT_SUPPORTED         = '\x08'
-        
+
+class PackError(Exception): pass
+class UnpackError(Exception): pass
+
+# precompiled codecs
+_PORT = struct.Struct('!H')
+
+# packed <-> presentation address caches, cleared when full
+ADDR_CACHE_SIZE = 1024
+_pton_v4 = {}
+_pton_v6 = {}
+_ntop_v4 = {}
+_ntop_v6 = {}
+
+def _cached(cache, key, value):
+    if len(cache) >= ADDR_CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+    return value
+
 def pack_addr(addrtype, addr):
     if addrtype == IP_V4:
-        s = socket.inet_pton(socket.AF_INET, addr)  # @UndefinedVariable
+        s = _pton_v4.get(addr)
+        if s is None:
+            s = _cached(_pton_v4, addr, socket.inet_pton(socket.AF_INET, addr))  # @UndefinedVariable
+        return s
     elif addrtype == IP_V6:
-        s = socket.inet_pton(socket.AF_INET6, addr)  # @UndefinedVariable
+        s = _pton_v6.get(addr)
+        if s is None:
+            s = _cached(_pton_v6, addr, socket.inet_pton(socket.AF_INET6, addr))  # @UndefinedVariable
+        return s
     elif addrtype == DOMAIN_NAME:
-        s = struct.pack('B', len(addr))
-        s += addr
+        if len(addr) > 255:
+            raise PackError("Domain name too long")
+        return chr(len(addr)) + addr
     else:
-        raise dpkt.PackError("Unknown address type %s" % addrtype.encode('hex'))
-    return s
+        raise PackError("Unknown address type %s" % addrtype.encode('hex'))
 
 def unpack_addr(addrtype, buf, offset):
     if addrtype == IP_V4:
-        addr = socket.inet_ntop(socket.AF_INET, buf[offset:(offset+4)])  # @UndefinedVariable
         nxt = offset+4
+        packed = buf[offset:nxt]
+        addr = _ntop_v4.get(packed)
+        if addr is None:
+            addr = _cached(_ntop_v4, packed, socket.inet_ntop(socket.AF_INET, packed))  # @UndefinedVariable
     elif addrtype == IP_V6:
-        addr = socket.inet_ntop(socket.AF_INET6, buf[offset:(offset+16)])  # @UndefinedVariable
         nxt = offset+16
+        packed = buf[offset:nxt]
+        addr = _ntop_v6.get(packed)
+        if addr is None:
+            addr = _cached(_ntop_v6, packed, socket.inet_ntop(socket.AF_INET6, packed))  # @UndefinedVariable
     elif addrtype == DOMAIN_NAME:
-        length = struct.unpack('B', buf[offset])[0]
-        addr = buf[(offset+1):(offset+1+length)]
-        nxt = offset+1+length
+        nxt = offset+1+ord(buf[offset])
+        addr = buf[(offset+1):nxt]
+        if len(addr) != nxt-offset-1:
+            raise UnpackError("Truncated address")
     else:
-        raise dpkt.UnpackError("Unknown address type %s" % addrtype.encode('hex'))
+        raise UnpackError("Unknown address type %s" % addrtype.encode('hex'))
     return addr, nxt
-        
-class InitRequest(dpkt.Packet):
-    __hdr__ = (
-        ('version', 'c', SOCKS5),
-        ('nmethods', 'B', 1),
-        ('methods', 's', NO_AUTHENTICATION_REQUIRED),
+
+def _write(buf, offset, data):
+    end = offset + len(data)
+    buf[offset:end] = data
+    return end
+
+# constant 4-byte prefixes of request/reply messages, keyed by cmd or rep, then addrtype
+_PREFIXES = {}
+for _code in (CONNECT, BIND, UDP_ASSOCIATE, SUCCEEDED, GENERAL_SOCKS_SERVER_FAILURE,
+              CONNECT_NOT_ALLOWED, NETWORK_UNREACHABLE, CONNECTION_REFUSED,
+              TTL_EXPIRED, CMD_NOT_SUPPORTED, ADDR_TYPE_NOT_SUPPORTED):
+    _PREFIXES[_code] = dict([(t, SOCKS5 + _code + RSV + t) for t in (IP_V4, DOMAIN_NAME, IP_V6)])
+del _code
+
+def _head(version, code, rsv, addrtype):
+    if version == SOCKS5 and rsv == RSV:
+        try:
+            return _PREFIXES[code][addrtype]
+        except KeyError:
+            pass
+    return version + code + rsv + addrtype
+
+class Message(object):
+    """ base of socks5 messages.
+
+    Message(buf) unpacks buf, Message(field=value, ...) starts from the
+    defaults in __fields__. pack() returns a string, pack_into() writes into
+    a caller-provided bytearray and returns the end offset.
+    """
+    __fields__ = ()
+
+    def __init__(self, *args, **kwargs):
+        self.data = ''
+        if args:
+            self.unpack(args[0])
+        else:
+            for (name, default) in self.__fields__:
+                setattr(self, name, default)
+            for (name, value) in kwargs.iteritems():
+                setattr(self, name, value)
+
+    def __str__(self):
+        return self.pack()
+
+    def __len__(self):
+        return len(self.pack())
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+            ", ".join(["%s=%r" % (name, getattr(self, name)) for (name, _) in self.__fields__]))
+
+    def pack(self):
+        raise NotImplementedError
+
+    def pack_into(self, buf, offset=0):
+        return _write(buf, offset, self.pack())
+
+    def unpack(self, buf):
+        raise NotImplementedError
+
+class InitRequest(Message):
+    __fields__ = (
+        ('version', SOCKS5),
+        ('nmethods', 1),
+        ('methods', NO_AUTHENTICATION_REQUIRED),
     )
-    
+
     def pack(self):
-        return self.version + struct.pack('B', self.nmethods) + self.methods
-    
+        return self.version + chr(self.nmethods) + self.methods
+
     def unpack(self, buf):
+        if len(buf) < 2:
+            raise UnpackError("Truncated InitRequest")
         self.version = buf[0]
-        self.nmethods = struct.unpack('B', buf[1])[0]
+        self.nmethods = ord(buf[1])
         self.methods = buf[2:(2+self.nmethods)]
-        
-        
-class InitReply(dpkt.Packet):
-    __hdr__ = (
-        ('version', 'c', SOCKS5),
-        ('method', 'c', NO_AUTHENTICATION_REQUIRED),
-    )
-    
-class Request(dpkt.Packet):
-    __hdr__ = (
-        ('version', 'c', SOCKS5),
-        ('cmd', 'c', CONNECT),
-        ('rsv', 'c', RSV),
-        ('addrtype', 'c', IP_V4),
-        ('dstaddr', 's', ''),
-        ('dstport', 'H', 0x3003),
+        if len(self.methods) != self.nmethods:
+            raise UnpackError("Truncated InitRequest")
+
+class InitReply(Message):
+    __fields__ = (
+        ('version', SOCKS5),
+        ('method', NO_AUTHENTICATION_REQUIRED),
     )
-    
+
     def pack(self):
-        addr = pack_addr(self.addrtype, self.dstaddr)
-        return self.version + self.cmd + self.rsv + \
-                    self.addrtype + addr + struct.pack('!H', self.dstport)
+        return self.version + self.method
 
     def unpack(self, buf):
+        if len(buf) < 2:
+            raise UnpackError("Truncated InitReply")
         self.version = buf[0]
-        self.cmd = buf[1]
-        self.rsv = buf[2]
-        self.addrtype = buf[3]
-        
-        self.dstaddr, offset = unpack_addr(self.addrtype, buf, 4)
-        self.dstport = struct.unpack('!H', buf[offset:(offset+2)])[0]
-
-      
-class Reply(dpkt.Packet):
-    __hdr__ = (
-        ('version', 'c', SOCKS5),
-        ('rep', 'c', SUCCEEDED),
-        ('rsv', 'c', RSV),
-        ('addrtype', 'c', IP_V4),
-        ('bndaddr', 's', ''),
-        ('bndport', 'H', 0x3003),
+        self.method = buf[1]
+
+class Request(Message):
+    __fields__ = (
+        ('version', SOCKS5),
+        ('cmd', CONNECT),
+        ('rsv', RSV),
+        ('addrtype', IP_V4),
+        ('dstaddr', ''),
+        ('dstport', 0x3003),
     )
-    
+
     def pack(self):
-        addr = pack_addr(self.addrtype, self.bndaddr)
-        return self.version + self.rep + self.rsv + \
-                    self.addrtype + addr + struct.pack('!H', self.bndport)
+        return _head(self.version, self.cmd, self.rsv, self.addrtype) \
+                    + pack_addr(self.addrtype, self.dstaddr) + _PORT.pack(self.dstport)
+
+    def pack_into(self, buf, offset=0):
+        offset = _write(buf, offset, _head(self.version, self.cmd, self.rsv, self.addrtype))
+        offset = _write(buf, offset, pack_addr(self.addrtype, self.dstaddr))
+        _PORT.pack_into(buf, offset, self.dstport)
+        return offset + 2
 
     def unpack(self, buf):
-        self.version = buf[0]
-        self.rep = buf[1]
-        self.rsv = buf[2]
-        self.addrtype = buf[3]
-        self.bndaddr, offset = unpack_addr(self.addrtype, buf, 4)
-        self.bndport = struct.unpack('!H', buf[offset:(offset+2)])[0]
-        
-
-class UDPRequest(dpkt.Packet):
-    __hdr__ = (
-        ('rsv', '2s', RSV+RSV),
-        ('frag', 'c', '\x00'),
-        ('addrtype', 'c', IP_V4),
-        ('dstaddr', 's', ''),
-        ('dstport', 'H', 0x3003),
+        try:
+            self.version = buf[0]
+            self.cmd = buf[1]
+            self.rsv = buf[2]
+            self.addrtype = buf[3]
+            self.dstaddr, offset = unpack_addr(self.addrtype, buf, 4)
+            self.dstport = _PORT.unpack_from(buf, offset)[0]
+        except (IndexError, ValueError, struct.error):
+            raise UnpackError("Truncated Request")
+
+class Reply(Message):
+    __fields__ = (
+        ('version', SOCKS5),
+        ('rep', SUCCEEDED),
+        ('rsv', RSV),
+        ('addrtype', IP_V4),
+        ('bndaddr', ''),
+        ('bndport', 0x3003),
     )
-    
+
     def pack(self):
-        addr = pack_addr(self.addrtype, self.dstaddr)
-        return self.rsv + self.frag + self.addrtype \
-                    + addr + struct.pack('!H', self.dstport) + self.data 
-    
+        return _head(self.version, self.rep, self.rsv, self.addrtype) \
+                    + pack_addr(self.addrtype, self.bndaddr) + _PORT.pack(self.bndport)
+
+    def pack_into(self, buf, offset=0):
+        offset = _write(buf, offset, _head(self.version, self.rep, self.rsv, self.addrtype))
+        offset = _write(buf, offset, pack_addr(self.addrtype, self.bndaddr))
+        _PORT.pack_into(buf, offset, self.bndport)
+        return offset + 2
+
     def unpack(self, buf):
-        self.rsv = buf[0:2]
-        self.frag = buf[2]
-        self.addrtype = buf[3]
-        self.dstaddr, offset = unpack_addr(self.addrtype, buf, 4)
-        self.dstport = struct.unpack('!H', buf[offset:(offset+2)])[0]
-        self.data = buf[(offset+2):]
-        
-    
+        try:
+            self.version = buf[0]
+            self.rep = buf[1]
+            self.rsv = buf[2]
+            self.addrtype = buf[3]
+            self.bndaddr, offset = unpack_addr(self.addrtype, buf, 4)
+            self.bndport = _PORT.unpack_from(buf, offset)[0]
+        except (IndexError, ValueError, struct.error):
+            raise UnpackError("Truncated Reply")
+
+# UDP header prefixes of unfragmented datagrams: RSV RSV FRAG ATYP, keyed by addrtype
+_RSV2 = RSV + RSV
+_UDP_PREFIXES = dict([(t, _RSV2 + '\x00' + t) for t in (IP_V4, DOMAIN_NAME, IP_V6)])
+
+def udp_header(addrtype, dstaddr, dstport, frag='\x00'):
+    """ packed UDP request header, without the payload.
+    """
+    if frag == '\x00' and addrtype in _UDP_PREFIXES:
+        prefix = _UDP_PREFIXES[addrtype]
+    else:
+        prefix = _RSV2 + frag + addrtype
+    return prefix + pack_addr(addrtype, dstaddr) + _PORT.pack(dstport)
+
+class UDPRequest(Message):
+    __fields__ = (
+        ('rsv', _RSV2),
+        ('frag', '\x00'),
+        ('addrtype', IP_V4),
+        ('dstaddr', ''),
+        ('dstport', 0x3003),
+    )
 
+    def _header(self):
+        if self.rsv == _RSV2 and self.frag == '\x00' and self.addrtype in _UDP_PREFIXES:
+            prefix = _UDP_PREFIXES[self.addrtype]
+        else:
+            prefix = self.rsv + self.frag + self.addrtype
+        return prefix + pack_addr(self.addrtype, self.dstaddr) + _PORT.pack(self.dstport)
 
+    def pack(self):
+        return self._header() + self.data
+
+    def pack_into(self, buf, offset=0):
+        offset = _write(buf, offset, self._header())
+        return _write(buf, offset, self.data)
+
+    def unpack(self, buf):
+        try:
+            self.rsv = buf[0:2]
+            self.frag = buf[2]
+            self.addrtype = buf[3]
+            self.dstaddr, offset = unpack_addr(self.addrtype, buf, 4)
+            self.dstport = _PORT.unpack_from(buf, offset)[0]
+        except (IndexError, ValueError, struct.error):
+            raise UnpackError("Truncated UDPRequest")
+        self.data = buf[(offset+2):]
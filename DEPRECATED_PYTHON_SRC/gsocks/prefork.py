@@ -0,0 +1,190 @@
+# prefork workers sharing a listening port through SO_REUSEPORT
+import os
+import sys
+import json
+import time
+import signal
+import logging
+
+import gevent
+import gevent.os
+from gevent import socket
+from gevent.event import Event
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# seconds between two stats reports of a worker
+STATS_INTERVAL = 5
+# a worker dying sooner than this after its start is restarted with a delay
+MIN_UPTIME = 1
+RESTART_DELAY = 1
+
+def reuseport_listener(localaddr, backlog=256):
+    """ a listening socket other processes can bind to as well, the kernel
+    spreads incoming connections among them.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise socket.error("SO_REUSEPORT is not supported on this platform")  # @UndefinedVariable
+    family = socket.AF_INET6 if len(localaddr) == 4 else socket.AF_INET  # @UndefinedVariable
+    sock = socket.socket(family, socket.SOCK_STREAM)  # @UndefinedVariable
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # @UndefinedVariable
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # @UndefinedVariable
+        sock.bind(localaddr)
+        sock.listen(backlog)
+    except:
+        sock.close()
+        raise
+    return sock
+
+class Worker(object):
+    def __init__(self, index):
+        self.index = index
+        self.pid = None
+        self.started = 0
+        self.reader = None
+        self.snapshot = []
+
+class Supervisor(object):
+    """ run target(index) in n forked worker processes and restart them
+    when they exit.
+
+    target is expected to serve forever, each worker binding the port with
+    reuse_port on its own. every worker reports its metrics registry over a
+    pipe, and expose() merges the latest reports, so a MetricsServer of the
+    supervisor shows the whole group.
+    """
+    def __init__(self, target, workers, metrics_port=0, stats_interval=STATS_INTERVAL):
+        self.target = target
+        self.workers = [Worker(i) for i in range(workers)]
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.stats_interval = stats_interval
+        self.stopping = False
+        self.registry = metrics.Registry()
+        self.alive = self.registry.gauge("firefly_workers", "Worker processes running.")
+        self.restarts = self.registry.counter("firefly_worker_restarts_total",
+            "Worker processes restarted after exiting.")
+
+    def spawn_worker(self, worker):
+        rfd, wfd = os.pipe()
+        pid = gevent.os.fork_and_watch(callback=lambda watcher: self.on_exit(worker, watcher))
+        if pid == 0:
+            os.close(rfd)
+            self.child(worker, wfd)
+            os._exit(0)
+        os.close(wfd)
+        gevent.os.make_nonblocking(rfd)
+        worker.pid = pid
+        worker.started = time.time()
+        worker.snapshot = []
+        worker.reader = gevent.spawn(self.read_stats, worker, rfd)
+        self.alive.inc()
+        log.info("worker %d started, pid %d" % (worker.index, pid))
+
+    def child(self, worker, wfd):
+        # the supervisor's signal handlers, listener and readers are not ours
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if self.metrics_server:
+            self.metrics_server.stop()
+        gevent.killall([w.reader for w in self.workers if w.reader], block=False)
+        gevent.os.make_nonblocking(wfd)
+        gevent.spawn(self.report_stats, wfd)
+        try:
+            self.target(worker.index)
+        except Exception, e:
+            log.error("[Exception][Worker %d]: %s" % (worker.index, str(e)))
+            sys.exit(1)
+
+    def report_stats(self, wfd):
+        while True:
+            data = json.dumps(metrics.default_registry.collect()) + "\n"
+            try:
+                while data:
+                    data = data[gevent.os.nb_write(wfd, data):]
+            except OSError:
+                # the supervisor is gone
+                os._exit(1)
+            gevent.sleep(self.stats_interval)
+
+    def read_stats(self, worker, rfd):
+        buf = ""
+        try:
+            while True:
+                data = gevent.os.nb_read(rfd, 65536)
+                if not data:
+                    break
+                buf += data
+                lines = buf.split("\n")
+                buf = lines.pop()
+                if lines:
+                    worker.snapshot = json.loads(lines[-1])
+        except (OSError, ValueError), e:
+            log.error("[Exception][Supervisor]: %s" % str(e))
+        finally:
+            os.close(rfd)
+
+    def on_exit(self, worker, watcher):
+        watcher.stop()
+        if worker.pid != watcher.pid:
+            return
+        log.info("worker %d (pid %d) exited with status %d" % (worker.index, worker.pid, watcher.rstatus))
+        worker.pid = None
+        self.alive.dec()
+        if self.stopping:
+            return
+        self.restarts.inc()
+        delay = RESTART_DELAY if time.time() - worker.started < MIN_UPTIME else 0
+        gevent.spawn_later(delay, self.restart, worker)
+
+    def restart(self, worker):
+        if not self.stopping and worker.pid is None:
+            self.spawn_worker(worker)
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            if worker.pid:
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def run(self):
+        if self.metrics_port:
+            self.metrics_server = metrics.MetricsServer("127.0.0.1", self.metrics_port, registry=self)
+            self.metrics_server.start()
+        for worker in self.workers:
+            self.spawn_worker(worker)
+        done = Event()
+        def shutdown():
+            self.stop()
+            done.set()
+        gevent.signal(signal.SIGTERM, shutdown)
+        gevent.signal(signal.SIGINT, shutdown)
+        done.wait()
+        if self.metrics_server:
+            self.metrics_server.stop()
+
+    def stats(self):
+        return {
+            'workers': len(self.workers),
+            'alive': len([w for w in self.workers if w.pid]),
+            'restarts': self.restarts.default.get(),
+            'pids': [w.pid for w in self.workers],
+        }
+
+    def collect(self):
+        return metrics.merge([w.snapshot for w in self.workers if w.pid]) + self.registry.collect()
+
+    def expose(self):
+        return metrics.render(self.collect())
+
+def run(target, workers, metrics_port=0):
+    """ supervise workers running target(index), serving their summed
+    metrics on a local port if one is given.
+    """
+    Supervisor(target, workers, metrics_port).run()
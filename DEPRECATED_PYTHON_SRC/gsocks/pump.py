@@ -0,0 +1,116 @@
+# event-driven tcp relay engine
+import logging
+
+import gevent
+from gevent import socket
+from gevent.event import Event
+
+from bufpool import default_pool
+from timer import default_wheel
+import metrics
+import accesslog
+
+log = logging.getLogger(__name__)
+
+# the pump a greenlet is running, for admission control to find idle sessions
+running = {}
+
+class TCPPump(object):
+    """ relay two connected sockets with one pump greenlet per direction.
+
+    each pump blocks in recv() on its source, so a slow reader only stalls
+    its own direction. EOF from one side is propagated to the other side as
+    shutdown(SHUT_WR), and the relay ends when both directions reach EOF.
+
+    idle tracking is one timer in the shared TimerWheel, reset on every
+    read, so the sockets block without timeouts of their own. the relay
+    ends once no data moved for the shorter of the two timeouts.
+
+    data is received with recv_into() into a buffer borrowed from a shared
+    BufferPool and forwarded as a memoryview slice, so the steady state
+    allocates no payload strings.
+    """
+    def __init__(self, local, remote, local_timeout, remote_timeout, pool=default_pool,
+                 wheel=default_wheel):
+        self.local = local
+        self.remote = remote
+        self.local_timeout = local_timeout
+        self.remote_timeout = remote_timeout
+        self.pool = pool
+        self.wheel = wheel
+        self.timer = None
+        self.open_directions = 2
+        self.finished = Event()
+        self.record = accesslog.current()
+
+    def touch(self):
+        if self.timer:
+            self.timer.reset()
+
+    def idle(self):
+        """ seconds without data, 0 when idle time is not tracked.
+        """
+        if self.timer:
+            return self.timer.idle
+        return 0
+
+    def stop(self):
+        self.finished.set()
+
+    def half_close(self, dst):
+        try:
+            dst.shutdown(socket.SHUT_WR)  # @UndefinedVariable
+        except socket.error:  # @UndefinedVariable
+            pass
+        self.open_directions -= 1
+        if self.open_directions <= 0:
+            self.finished.set()
+
+    def tally(self, src):
+        direction = "up" if src is self.local else "down"
+        return metrics.relayed_bytes.labels("tcp", direction).tally()
+
+    def pump(self, src, dst):
+        buf = self.pool.get()
+        view = memoryview(buf)
+        relayed = self.tally(src)
+        try:
+            while True:
+                n = src.recv_into(buf)
+                if not n:
+                    self.half_close(dst)
+                    return
+                self.touch()
+                dst.sendall(view[:n])
+                relayed.value += n
+        except (socket.error, IOError), e:  # @UndefinedVariable
+            log.debug("[TCPPump]: %s" % str(e))
+        finally:
+            if self.record:
+                self.record.relayed(src is self.local, relayed.value)
+            relayed.release()
+            self.pool.put(buf)
+        self.finished.set()
+
+    def run(self):
+        timeouts = [t for t in (self.local_timeout, self.remote_timeout) if t]
+        if timeouts:
+            self.timer = self.wheel.arm(min(timeouts), self.finished.set)
+        self.local.settimeout(None)
+        self.remote.settimeout(None)
+        pumps = [
+            gevent.spawn(self.pump, self.local, self.remote),
+            gevent.spawn(self.pump, self.remote, self.local),
+        ]
+        current = gevent.getcurrent()
+        running[current] = self
+        try:
+            self.finished.wait()
+        finally:
+            running.pop(current, None)
+            if self.timer:
+                self.timer.cancel()
+            gevent.killall(pumps)
+
+def pump_tcp(local, remote, local_timeout, remote_timeout, pool=default_pool):
+    TCPPump(local, remote, local_timeout, remote_timeout, pool).run()
@@ -5,11 +5,17 @@ import time
 from gevent import socket
 from gevent import select
 
-from utils import request_fail, basic_handshake_server, read_request, \
-sock_addr_info, request_success, pipe_tcp, bind_local_udp, addr_info, \
-bind_local_sock_by_addr, pipe_udp
+from utils import request_fail, basic_handshake_server, SocksReader, \
+sock_addr_info, request_success, bind_local_udp, addr_info, pipe_udp
+from pump import pump_tcp
+import dial
+import splice
+import metrics
+import accesslog
+from udpnat import UDPNat
+from udpfrag import Reassembler
 from msg import CMD_NOT_SUPPORTED, CONNECT, BIND, UDP_ASSOCIATE, \
-GENERAL_SOCKS_SERVER_FAILURE, UDPRequest
+GENERAL_SOCKS_SERVER_FAILURE, UDPRequest, udp_header
 
 log = logging.getLogger(__name__)
 
@@ -24,6 +30,8 @@ class RelaySession(object):
         self.socksconn = socksconn
         self.timeout = self.socksconn.gettimeout()
         self.allsocks = [self.socksconn]
+        # client bytes that arrived together with the request
+        self.early_data = ""
         
     def track_sock(self, sock):
         # track all sockets so we know what to clean
@@ -48,12 +56,16 @@ class RelaySession(object):
         raise NotImplementedError
     
     def process(self):
+        req = None
         try:
-            if not basic_handshake_server(self.socksconn):
+            reader = SocksReader(self.socksconn)
+            if not basic_handshake_server(self.socksconn, reader):
+                metrics.handshake_failures.labels("socks5").inc()
                 self.clean()
                 return
     
-            req = read_request(self.socksconn)
+            req = reader.read_request()
+            self.early_data = reader.rest()
             {
                 CONNECT: self.cmd_connect,
                 BIND: self.cmd_bind,
@@ -62,6 +74,9 @@ class RelaySession(object):
             self.clean()
         except Exception, e:
             log.error("[Exception][RelaySession]: %s" % str(e))
+            accesslog.note(error=str(e))
+            if req is None:
+                metrics.handshake_failures.labels("socks5").inc()
             self.clean()
     
     def clean(self):
@@ -70,29 +85,37 @@ class RelaySession(object):
                 sock.close()
     
 class SocksSession(RelaySession):
-    def __init__(self, socksconn):
+    def __init__(self, socksconn, use_splice=False):
         super(SocksSession, self).__init__(socksconn)
         
+        self.use_splice = use_splice and splice.available
         self.remoteconn = None
         self.client_associate = None
         self.last_clientaddr = None
         self.client2local_udpsock = None
-        self.local2remote_udpsock = None
+        self.udpnat = None
+        self.reassembler = Reassembler()
        
     def proc_tcp_request(self, req):
         dst = (req.dstaddr, req.dstport)
-        log.info("TCP request address: (%s:%d)" % dst)
-        self.remoteconn = socket.create_connection(dst, self.timeout)
+        log.info("TCP request address: (%s:%d)", *dst)
+        accesslog.note(target=dst)
+        self.remoteconn = dial.create_connection(dst, self.timeout)
         self.track_sock(self.remoteconn)
         addrtype, bndaddr, bndport = sock_addr_info(self.remoteconn)
         request_success(self.socksconn, addrtype, bndaddr, bndport)
     
     def relay_tcp(self):
-        pipe_tcp(self.socksconn, self.remoteconn, self.timeout, self.timeout)
+        if self.early_data:
+            self.remoteconn.sendall(self.early_data)
+        if self.use_splice:
+            splice.splice_tcp(self.socksconn, self.remoteconn, self.timeout, self.timeout)
+        else:
+            pump_tcp(self.socksconn, self.remoteconn, self.timeout, self.timeout)
             
     def proc_udp_request(self, req):
         self.client_associate = (req.dstaddr, req.dstport)
-        log.info("UDP client adress: (%s:%d)" % self.client_associate)
+        log.info("UDP client adress: (%s:%d)", *self.client_associate)
         self.last_clientaddr = self.client_associate
         self.client2local_udpsock = bind_local_udp(self.socksconn)
         if not self.client2local_udpsock:
@@ -100,7 +123,7 @@ class SocksSession(RelaySession):
             return False
         self.track_sock(self.client2local_udpsock)
         bndtype, bndaddr, bndport = sock_addr_info(self.client2local_udpsock)
-        log.info("UDP ACCOSIATE: (%s:%d)" % (bndaddr, bndport))
+        log.info("UDP ACCOSIATE: (%s:%d)", bndaddr, bndport)
         request_success(self.socksconn, bndtype, bndaddr, bndport)
         return True
         
@@ -123,6 +146,9 @@ class SocksSession(RelaySession):
                 udpreq = UDPRequest(data)
                 if udpreq.frag == '\x00':
                     return data, addr
+                udpreq = self.reassembler.feed(udpreq)
+                if udpreq:
+                    return udpreq.pack(), addr
             except:
                 pass
         
@@ -144,8 +170,10 @@ class SocksSession(RelaySession):
                 try:
                     udpreq = UDPRequest(data)
                     if udpreq.frag != '\x00':
-                        return None, None
-                    return udpreq.data, (udpreq.dstaddr, udpreq.dstport)
+                        udpreq = self.reassembler.feed(udpreq)
+                        if not udpreq:
+                            return None, None
+                    return udpreq.data, self.udpnat.route(udpreq.dstaddr, udpreq.dstport)
                 except Exception, e:
                     log.error("[relay_udp][c2r] Exception: %s", str(e))
                     return None, None
@@ -153,17 +181,20 @@ class SocksSession(RelaySession):
             
         def r2c():
             def _(data, addr):
+                if not self.udpnat.accept(addr):
+                    return None, None
                 addrtype, dstaddr, dstport = addr_info(addr)
-                udpreq = UDPRequest(addrtype=addrtype, dstaddr=dstaddr, dstport=dstport, data=data)
-                return udpreq.pack(), self.last_clientaddr
+                return udp_header(addrtype, dstaddr, dstport) + data, self.last_clientaddr
             return _
         
+        self.udpnat = UDPNat(idle=self.timeout)
+        for sock in self.udpnat.sockets():
+            self.track_sock(sock)
         data, dst = c2r()(firstdata, firstaddr)
-        self.local2remote_udpsock = bind_local_sock_by_addr(dst)
-        self.track_sock(self.local2remote_udpsock)
-        self.local2remote_udpsock.send(data)
+        if data and dst:
+            self.udpnat.sock_for(dst).sendto(data, dst)
         pipe_udp([self.socksconn],
-            self.client2local_udpsock, self.local2remote_udpsock,
+            self.client2local_udpsock, self.udpnat.sockets(),
             self.timeout, self.timeout,
             addrchecker(), c2r(), r2c())
         
@@ -171,9 +202,16 @@ class SocksSession(RelaySession):
         if self.proc_udp_request(req):
             firstdata, firstaddr = self.wait_for_first_udp()
             self.relay_udp(firstdata, firstaddr)
+            
+    def clean(self):
+        super(SocksSession, self).clean()
+        self.reassembler.reset()
     
 class SocksRelayFactory(RelayFactory):
+    def __init__(self, use_splice=False):
+        self.use_splice = use_splice
+        
     def create_relay_session(self, socksconn, clientaddr):
-        log.info("New socks connection from %s" % str(clientaddr))
-        return SocksSession(socksconn)
+        log.info("New socks connection from %s", clientaddr)
+        return SocksSession(socksconn, self.use_splice)
     
@@ -0,0 +1,410 @@
+# forwarding rules compiled for first-match lookups
+import re
+import collections
+import sre_parse
+import sre_constants
+
+from cidr import CIDRIndex, parse_network
+
+# protocols a port or proto pattern is evaluated against when compiled
+PROTOS = ("tcp", "udp")
+MAX_PORT = 65535
+MAX_DIGITS = len(str(MAX_PORT))
+# strings built in one step of expanding a port pattern, past which
+# matching it port by port is cheaper
+MAX_EXPANSION = 4096
+# python 2 re refuses patterns with more groups than that
+MAX_GROUPS = 99
+
+_ANCHORS_BEGIN = (sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING)
+_ANCHORS_END = (sre_constants.AT_END, sre_constants.AT_END_STRING)
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+_DIGITS = frozenset("0123456789")
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: _DIGITS,
+    sre_constants.CATEGORY_NOT_DIGIT: frozenset(),
+    sre_constants.CATEGORY_WORD: _DIGITS,
+    sre_constants.CATEGORY_NOT_WORD: frozenset(),
+    sre_constants.CATEGORY_SPACE: frozenset(),
+    sre_constants.CATEGORY_NOT_SPACE: _DIGITS,
+}
+
+class Unsupported(Exception): pass
+
+def _chr(code):
+    # only ascii digits matter
+    return chr(code) if code < 0x80 else ""
+
+def _concat(heads, tails):
+    """ heads followed by tails. a string ending with "$" is anchored and
+    takes nothing more, none has more than MAX_DIGITS digits.
+    """
+    if len(heads) * len(tails) > MAX_EXPANSION:
+        raise Unsupported()
+    ret = set()
+    for head in heads:
+        if head.endswith("$"):
+            if "" in tails or "$" in tails:
+                ret.add(head)
+            continue
+        for tail in tails:
+            s = head + tail
+            if len(s) - s.endswith("$") <= MAX_DIGITS:
+                ret.add(s)
+    return ret
+
+def _char_set(items):
+    chars = set()
+    negate = False
+    for (op, av) in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            chars.add(_chr(av))
+        elif op == sre_constants.RANGE:
+            chars.update([c for c in _DIGITS if av[0] <= ord(c) <= av[1]])
+        elif op == sre_constants.CATEGORY and av in _CATEGORIES:
+            chars.update(_CATEGORIES[av])
+        else:
+            raise Unsupported()
+    if negate:
+        return _DIGITS - chars
+    return _DIGITS & chars
+
+def _expand(items, strings):
+    """ strings extended by what a parsed sequence matches, as far as
+    it consists of digits.
+    """
+    for (op, av) in items:
+        if not strings:
+            break
+        if op == sre_constants.LITERAL:
+            tails = _DIGITS & set([_chr(av)])
+        elif op == sre_constants.NOT_LITERAL:
+            tails = _DIGITS - set([_chr(av)])
+        elif op == sre_constants.ANY:
+            tails = _DIGITS
+        elif op == sre_constants.IN:
+            tails = _char_set(av)
+        elif op == sre_constants.BRANCH:
+            tails = set()
+            for branch in av[1]:
+                tails |= _expand(branch, set([""]))
+        elif op == sre_constants.SUBPATTERN:
+            tails = _expand(av[1], set([""]))
+        elif op in _REPEATS:
+            low, high, item = av
+            if low > MAX_DIGITS + 1:
+                raise Unsupported()
+            once = _expand(item, set([""]))
+            tails = set()
+            repeated = set([""])
+            for i in xrange(min(high, MAX_DIGITS + 1) + 1):
+                if i >= low:
+                    tails |= repeated
+                repeated = _concat(repeated, once)
+        elif op == sre_constants.AT and av in _ANCHORS_BEGIN:
+            strings = set([s for s in strings if s == ""])
+            continue
+        elif op == sre_constants.AT and av in _ANCHORS_END:
+            tails = set(["$"])
+        else:
+            raise Unsupported()
+        strings = _concat(strings, tails)
+    return strings
+
+def _prefixed(prefix):
+    """ the ports whose decimal string starts with prefix.
+    """
+    if not prefix:
+        return xrange(MAX_PORT + 1)
+    if prefix[0] == "0":
+        return [0] if prefix == "0" else []
+    ports = []
+    n = int(prefix)
+    scale = 1
+    while n * scale <= MAX_PORT:
+        ports.extend(xrange(n * scale, min((n + 1) * scale - 1, MAX_PORT) + 1))
+        scale *= 10
+    return ports
+
+def expand_ports(pattern):
+    """ the ports re.match() finds pattern in, worked out from its parse
+    tree without matching each port. raises Unsupported for patterns
+    using more than literals, classes, groups, repeats and anchors.
+    """
+    source, flags = _source(pattern)
+    try:
+        parsed = sre_parse.parse(source, flags)
+    except (sre_constants.error, TypeError):
+        raise Unsupported()
+    ports = set()
+    for s in _expand(parsed, set([""])):
+        if s.endswith("$"):
+            s = s[:-1]
+            if s and s == str(int(s)) and int(s) <= MAX_PORT:
+                ports.add(int(s))
+        else:
+            ports.update(_prefixed(s))
+    return ports
+
+class PortSet(object):
+    """ the ports a pattern matches, as a 65536 bit bitmap. worked out
+    from the pattern when expand_ports() can, by matching every port
+    otherwise.
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, pattern):
+        self.bits = bits = bytearray((MAX_PORT >> 3) + 1)
+        try:
+            ports = expand_ports(pattern)
+        except Unsupported:
+            match = pattern.match
+            ports = [port for port in xrange(MAX_PORT + 1) if match(str(port))]
+        for port in ports:
+            bits[port >> 3] |= 1 << (port & 7)
+
+    def __contains__(self, port):
+        return 0 <= port <= MAX_PORT and bool(self.bits[port >> 3] & (1 << (port & 7)))
+
+def _is_any(item):
+    op, av = item
+    return op in _REPEATS and av[1] == sre_constants.MAXREPEAT and av[0] <= 1 and \
+        list(av[2]) == [(sre_constants.ANY, None)]
+
+def _source(pattern):
+    if isinstance(pattern, basestring):
+        return pattern, 0
+    return pattern.pattern, pattern.flags
+
+def analyze_network(pattern):
+    """ the parse_network() tuple of a host pattern written as a CIDR
+    range, e.g. "10.0.0.0/8", None for the others. as a regex it would
+    never match, hosts have no "/".
+    """
+    source, _ = _source(pattern)
+    if "/" not in source:
+        return None
+    try:
+        return parse_network(source)
+    except ValueError:
+        return None
+
+def analyze_host(pattern):
+    """ ("any", minlen, None), ("exact", minlen, literal) or ("suffix",
+    minlen, literal) for the host patterns a dict lookup can stand for,
+    None for the others. pattern is a string or a compiled regex.
+    """
+    source, flags = _source(pattern)
+    try:
+        parsed = sre_parse.parse(source, flags)
+    except (sre_constants.error, TypeError):
+        return None
+    # with inline flags as well
+    if parsed.pattern.flags & (re.I | re.L):
+        return None
+    items = list(parsed)
+    if items and items[0][0] == sre_constants.AT and items[0][1] in _ANCHORS_BEGIN:
+        items.pop(0)
+    prefix = None
+    if items and _is_any(items[0]):
+        prefix = items.pop(0)[1][0]
+    anchored = False
+    if items and items[-1][0] == sre_constants.AT and items[-1][1] in _ANCHORS_END:
+        items.pop()
+        anchored = True
+    if any([op != sre_constants.LITERAL or av > 0xff for (op, av) in items]):
+        return None
+    literal = "".join([chr(av) for (_, av) in items])
+    if prefix is not None:
+        if not literal:
+            return ("any", prefix, None)
+        if anchored:
+            return ("suffix", len(literal) + prefix, literal)
+    elif anchored:
+        return ("exact", len(literal), literal)
+    return None
+
+class Rule(object):
+    __slots__ = ('index', 'host', 'ports', 'protos', 'proto', 'minlen', 'dst')
+
+    def __init__(self, index, host, port, proto, dst):
+        self.index = index
+        # compiled only when no index can stand for it
+        self.host = host
+        self.proto = re.compile(proto)
+        self.dst = dst
+        self.minlen = 0
+        # None stands for every port
+        self.ports = _port_set(port)
+        self.protos = frozenset([p for p in PROTOS if self.proto.match(p)])
+
+    def accepts(self, port, proto):
+        if proto in PROTOS:
+            if proto not in self.protos:
+                return False
+        elif not self.proto.match(proto):
+            return False
+        return self.ports is None or port in self.ports
+
+_port_sets = {}
+
+def _port_set(pattern):
+    key = _source(pattern)
+    if key not in _port_sets:
+        # port strings are never empty, so .+ does as well as .*
+        kind = analyze_host(pattern)
+        if kind is not None and kind[0] == "any" and kind[1] <= 1:
+            _port_sets[key] = None
+        else:
+            _port_sets[key] = PortSet(re.compile(pattern))
+    return _port_sets[key]
+
+class RuleSet(object):
+    """ rules (host, port, proto) -> dst, looked up first match first.
+
+    host patterns of the forms .*literal$, literal$ and .* go to a suffix
+    index, an exact index or a list, CIDR ranges such as "10.0.0.0/8" to a
+    CIDRIndex matching IP literals only. the other host patterns are joined
+    into alternations with one named group per rule, so that one re.match
+    finds the first of them matching. port and proto patterns are turned
+    into sets when compiled, which is exact as re.match sees the port as a
+    decimal string.
+    """
+    def __init__(self, rules):
+        self.rules = []
+        self.exact = {}
+        self.suffixes = {}
+        self.suffix_lengths = []
+        self.anyhost = []
+        self.networks = CIDRIndex()
+        self.chunks = []
+
+        leftover = []
+        for (index, ((host, port, proto), dst)) in enumerate(rules):
+            rule = Rule(index, host, port, proto, dst)
+            self.rules.append(rule)
+            network = analyze_network(host)
+            if network is not None:
+                netrules = self.networks.get(network)
+                if netrules is None:
+                    netrules = []
+                    self.networks.add(network, netrules)
+                netrules.append(rule)
+                continue
+            kind = analyze_host(host)
+            if kind is None:
+                rule.host = re.compile(host)
+                leftover.append(rule)
+                continue
+            kind, rule.minlen, literal = kind
+            if kind == "any":
+                self.anyhost.append(rule)
+            elif kind == "exact":
+                self.exact.setdefault(literal, []).append(rule)
+            else:
+                self.suffixes.setdefault(literal, []).append(rule)
+        self.suffix_lengths = sorted(set([len(s) for s in self.suffixes]))
+        self.compile_leftover(leftover)
+
+    def compile_leftover(self, rules):
+        chunk = []
+        groups = 0
+        for rule in rules:
+            if rule.host.groupindex or re.search(r'\\\d|\(\?P=|\(\?[iLmsux]', rule.host.pattern):
+                # named groups, back references and inline flags do not
+                # survive the join
+                self.add_chunk(chunk)
+                self.add_chunk([rule])
+                chunk = []
+                groups = 0
+                continue
+            if groups + rule.host.groups + 1 > MAX_GROUPS or \
+                    (chunk and rule.host.flags != chunk[0].host.flags):
+                self.add_chunk(chunk)
+                chunk = []
+                groups = 0
+            chunk.append(rule)
+            groups += rule.host.groups + 1
+        self.add_chunk(chunk)
+
+    def add_chunk(self, rules):
+        if not rules:
+            return
+        if len(rules) == 1:
+            combined = rules[0].host
+        else:
+            try:
+                combined = re.compile("|".join(["(?P<r%d>%s)" % (r.index, r.host.pattern) for r in rules]),
+                                      rules[0].host.flags)
+            except (re.error, AssertionError, OverflowError):
+                for rule in rules:
+                    self.add_chunk([rule])
+                return
+        positions = dict([(r.index, i) for (i, r) in enumerate(rules)])
+        self.chunks.append((rules[0].index, combined, rules, positions))
+
+    def _first(self, rules, port, proto, hostlen, best):
+        for rule in rules:
+            if rule.index >= best:
+                break
+            if hostlen >= rule.minlen and rule.accepts(port, proto):
+                return rule.index
+        return best
+
+    def find_rule(self, host, port, proto="tcp"):
+        best = len(self.rules)
+        hostlen = len(host)
+        rules = self.exact.get(host)
+        if rules:
+            best = self._first(rules, port, proto, hostlen, best)
+        suffixes = self.suffixes
+        for n in self.suffix_lengths:
+            if n > hostlen:
+                break
+            rules = suffixes.get(host[-n:])
+            if rules:
+                best = self._first(rules, port, proto, hostlen, best)
+        if self.anyhost:
+            best = self._first(self.anyhost, port, proto, hostlen, best)
+        if self.networks:
+            for rules in self.networks.lookup_all(host):
+                best = self._first(rules, port, proto, hostlen, best)
+        for (first, combined, rules, positions) in self.chunks:
+            if first >= best:
+                break
+            m = combined.match(host)
+            if not m:
+                continue
+            start = 0 if len(rules) == 1 else positions[int(m.lastgroup[1:])]
+            for rule in rules[start:]:
+                if rule.index >= best:
+                    break
+                if (rule is rules[start] or rule.host.match(host)) and rule.accepts(port, proto):
+                    best = rule.index
+                    break
+        if best < len(self.rules):
+            return self.rules[best]
+        return None
+
+    def find(self, host, port, proto="tcp"):
+        rule = self.find_rule(host, port, proto)
+        if rule:
+            return rule.dst
+        return None
+
+    def __len__(self):
+        return len(self.rules)
+
+def ordered_rules(rules):
+    """ the (pattern, dst) pairs of rules. a dict is sorted by pattern
+    source, as its own order changes from a run to another.
+    """
+    if isinstance(rules, collections.OrderedDict):
+        return rules.items()
+    if isinstance(rules, dict):
+        def source(item):
+            return tuple([getattr(p, 'pattern', p) for p in item[0]])
+        return sorted(rules.items(), key=source)
+    return list(rules)
@@ -5,38 +5,92 @@ from gevent import socket
 from gevent.server import StreamServer
 from gevent.pool import Pool
 
+import metrics
+import tuning
+import accesslog
+from admission import AdmissionControl, reject, SOCKS_REJECT
+from prefork import reuseport_listener
+
 log = logging.getLogger(__name__)
 
 class SocksServer(object):
-    def __init__(self, ip, port, relayfactory, timeout=30, maxclient=200):
+    def __init__(self, ip, port, relayfactory, timeout=30, maxclient=200, reuse_port=False,
+                 profile=None, admission=None, listener=None, accesslog=None):
         self.ip = ip
         self.port = port
         self.timeout = timeout
+        self.accesslog = accesslog
+        # None follows tuning.default_profile
+        self.profile = profile
         self.relayfactory = relayfactory
-        self.pool = Pool(maxclient)
+        self.admission = admission or AdmissionControl(maxclient)
+        self.pool = Pool(self.admission.poolsize)
         addrinfo = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM, socket.SOL_TCP)  # @UndefinedVariable
         _, _, _, _, localaddr = addrinfo[0]
+        if listener is not None:
+            # taken over from a process being drained
+            localaddr = listener
+        elif reuse_port:
+            # for prefork workers sharing the port
+            localaddr = reuseport_listener(localaddr)
         self.server = StreamServer(localaddr, self._handle, spawn=self.pool)
         
+        listen = "%s:%d" % (ip, port)
+        self.accepts = metrics.accepts.labels("socks", listen)
+        self.active = metrics.active_sessions.labels("socks", listen)
+        self.rejected = {
+            "full": metrics.rejected.labels("socks", "full"),
+            "lag": metrics.rejected.labels("socks", "lag"),
+        }
+        metrics.pool_used.labels("socks", listen).set_function(lambda: len(self.pool))
+        metrics.pool_size.labels("socks", listen).set(maxclient)
+        
     def _handle(self, sock, addr):
+        self.accepts.inc()
+        reason = self.admission.enter()
+        if reason:
+            self.rejected[reason].inc()
+            reject(sock, SOCKS_REJECT)
+            return
+        self.active.inc()
+        record = self.accesslog.begin("socks", addr) if self.accesslog else None
         try:
+            (self.profile or tuning.default_profile).accepted(sock)
             sock.settimeout(self.timeout)
             session = self.relayfactory.create_relay_session(sock, addr)
             session.process()
         except Exception, e:
             log.error("[Exception][SocksServer]: %s" % str(e))
+            accesslog.note(error=str(e))
+        finally:
+            if record:
+                self.accesslog.end(record)
+            self.active.dec()
+            self.admission.leave()
             
     def stop(self):
         return self.server.stop()
         
+    def drain(self, timeout=None):
+        """ stop accepting, give the sessions being served timeout seconds
+        to finish (None for as long as they last) and kill the rest. run()
+        returns once they are gone.
+        """
+        # serve_forever stops the server again when woken up by close()
+        self.server.stop_timeout = timeout
+        self.server.stop(timeout)
+        
     @property
     def closed(self):
         return self.server.closed
             
     def start(self):
         self.server.start()
+        (self.profile or tuning.default_profile).listening(self.server.socket)
         
     def run(self):
+        if not self.server.started:
+            self.start()
         self.server.serve_forever()
     
     
@@ -1,14 +1,14 @@
 # a relay with policy based forwarding.
 import logging
-import re
-
-from gevent import socket
 
 from relay import SocksSession, RelayFactory, RelaySession
 from socks_relay import SocksForwardSession
 
 import msg
 import utils
+import upstream
+import accesslog
+from rules import RuleSet, ordered_rules
 
 log = logging.getLogger(__name__)
 
@@ -26,17 +26,20 @@ class ForwardMatcher(object):
         return None
     
 class RESocksMatcher(ForwardMatcher):
+    """ rules map (host, port, proto) regular expressions to destinations.
+    
+    the first matching rule wins: rules in the order of a list of pairs or
+    an OrderedDict, a plain dict is ordered by the patterns' source.
+    """
     def __init__(self, rules):
         self.rules = rules
+        self.ruleset = RuleSet(ordered_rules(rules))
         
     def find(self, host, port, proto="tcp"):
-        for (pattern, dst) in self.rules.iteritems():
-            (h, p, pr) = pattern
-            if re.match(pr, proto) and re.match(h, host.rstrip(".")) \
-                        and re.match(p, str(port)):
-                log.info("forward rule %s found for %s:%d:%s" % (dst, host, port, proto))
-                return dst
-        return None
+        dst = self.ruleset.find(host.rstrip("."), int(port), proto)
+        if dst:
+            log.debug("forward rule %s found for %s:%d:%s", dst, host, port, proto)
+        return dst
 
 class SmartRelayError(Exception): pass
 
@@ -55,28 +58,20 @@ class SmartRelaySession(RelaySession):
     def find_forwarder(self, scheme, proto):
         return self.forwarders.get("_".join([scheme, proto]), None)
         
-    def forward_socks5_handshake(self, socksconn):
-        initreq = msg.InitRequest()
-        socksconn.sendall(initreq.pack())
-        initreply = utils.read_init_reply(socksconn)
-        if initreply.method != msg.NO_AUTHENTICATION_REQUIRED:
-            return False
-        return True
-        
     def forward_socks5_tcp(self, url, req):
-        remoteconn = socket.create_connection((url.hostname, url.port), self.timeout)
-        remoteconn.settimeout(self.timeout)
+        # greeting (unless pooled), request and early data go out together.
+        # the reply is read here, so the pool can tell a failed pipelined
+        # handshake and retry it
+        pool = upstream.get_pool(url.hostname, url.port, self.timeout)
+        remoteconn, reply = pool.request(req.pack(), self.early_data)
+        self.socksconn.sendall(reply.pack())
         handler = SocksForwardSession(self.socksconn, remoteconn)
         self.handler = handler
-        # handshake, send request, then start to pipe
-        if self.forward_socks5_handshake(handler.remoteconn):
-            handler.proc_tcp_request(req)
-            handler.relay_tcp()
+        handler.relay_tcp()
         return True
             
     def forward_socks5_udp(self, url, localhandler, firstdata, firstaddr):
-        remoteconn = socket.create_connection((url.hostname, url.port), self.timeout)
-        remoteconn.settimeout(self.timeout)
+        remoteconn = upstream.get_pool(url.hostname, url.port, self.timeout).open()
         handler = SocksForwardSession(self.socksconn, remoteconn)
         # copy already-exist states from local handler
         handler.client_associate = localhandler.client_associate
@@ -85,18 +80,17 @@ class SmartRelaySession(RelaySession):
         handler.track_sock(handler.client2local_udpsock)
         self.handler = handler
         
-        # handshake, then request-reply, then send first packet, finally start to pipe
-        if self.forward_socks5_handshake(handler.remoteconn):
-            handler.local2remote_udpsock = utils.bind_local_udp(handler.remoteconn)
-            handler.track_sock(handler.local2remote_udpsock)
-            utils.send_request(handler.remoteconn, msg.UDP_ASSOCIATE, *utils.sock_addr_info(handler.local2remote_udpsock))
-            reply = utils.read_reply(handler.remoteconn)
-            if reply.rep != msg.SUCCEEDED:
-                return False           
-            handler.remote_associate = (reply.bndaddr, reply.bndport)
-            handler.last_clientaddr = firstaddr
-            handler.local2remote_udpsock.sendto(firstdata, handler.remote_associate)
-            handler.relay_udp()
+        # request-reply, then send first packet, finally start to pipe
+        handler.local2remote_udpsock = utils.bind_local_udp(handler.remoteconn)
+        handler.track_sock(handler.local2remote_udpsock)
+        utils.send_request(handler.remoteconn, msg.UDP_ASSOCIATE, *utils.sock_addr_info(handler.local2remote_udpsock))
+        reply = utils.read_reply(handler.remoteconn)
+        if reply.rep != msg.SUCCEEDED:
+            return False           
+        handler.remote_associate = (reply.bndaddr, reply.bndport)
+        handler.last_clientaddr = firstaddr
+        handler.local2remote_udpsock.sendto(firstdata, handler.remote_associate)
+        handler.relay_udp()
         return True
     
     def forward_tcp(self, dst, req):
@@ -115,13 +109,16 @@ class SmartRelaySession(RelaySession):
             
     def cmd_connect(self, req):
         dst = self.matcher.find(req.dstaddr, req.dstport, proto="tcp")
+        accesslog.note(target=(req.dstaddr, req.dstport))
         if not dst:
             # no forward schemes found, go as local socks proxy 
             handler = SocksSession(self.socksconn)
+            handler.early_data = self.early_data
             self.handler = handler
             handler.proc_tcp_request(req)
             handler.relay_tcp()
         else:
+            accesslog.note(route=dst.scheme)
             self.forward_tcp(dst, req)
             
     def cmd_udp_associate(self, req):
@@ -135,6 +132,7 @@ class SmartRelaySession(RelaySession):
                 # no forward schemes found, go as local socks proxy 
                 handler.relay_udp(firstdata, firstaddr)    
             else:
+                accesslog.note(route=scheme.scheme)
                 self.forward_udp(scheme, handler, firstdata, firstaddr)
                     
     def clean(self):
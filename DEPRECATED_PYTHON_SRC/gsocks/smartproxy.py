@@ -4,20 +4,25 @@ import sys
 import os
 import re
 from urlparse import urlparse
+from optparse import OptionParser
 from sys import platform as _platform
 if _platform == "linux" or _platform == "linux2":
     os.environ['GEVENT_RESOLVER'] = "ares"
 
 from smart_relay import SmartRelayFactory, RESocksMatcher, ForwardDestination
 from server import SocksServer
+import prefork
 
 def usage(f):
     print >> f, """
-Usage: python smartproxy.py localip localport
+Usage: python smartproxy.py [--workers n] localip localport
     """
 
 def main():
-    if len(sys.argv) < 3:
+    parser = OptionParser(add_help_option=False)
+    parser.add_option("--workers", type="int", dest="workers", default=1)
+    options, args = parser.parse_args()
+    if len(args) < 2:
         usage(f=sys.stderr)
         sys.exit(-1)
         
@@ -27,8 +32,8 @@ def main():
         level=logging.DEBUG, 
     )
         
-    localip = sys.argv[1]
-    localport = int(sys.argv[2])
+    localip = args[0]
+    localport = int(args[1])
     
     dst = ForwardDestination("socks5", urlparse('socks5://127.0.0.1:1080/'))
     rules = {
@@ -36,6 +41,13 @@ def main():
         (re.compile(r'.*\.google\.com$'), re.compile(r'.*'), re.compile(r'.*')): dst,
     }
     matcher = RESocksMatcher(rules)
+    if options.workers > 1:
+        def worker(_):
+            relay = SmartRelayFactory(matcher)
+            SocksServer(localip, localport, relay, reuse_port=True).run()
+        prefork.run(worker, options.workers)
+        return
+    
     relay = SmartRelayFactory(matcher)
     socks = SocksServer(localip, localport, relay)
     socks.run()
@@ -4,9 +4,13 @@ import logging
 from gevent import socket
 
 from relay import RelayFactory, RelaySession, RelaySessionError
-from utils import pipe_tcp, bind_local_udp, request_fail, send_request, \
-sock_addr_info, read_reply, request_success, pipe_udp, read_init_request, \
-read_init_reply, read_request
+from utils import bind_local_udp, request_fail, send_request, \
+sock_addr_info, read_reply, request_success, pipe_udp, read_init_reply, \
+SocksReader, basic_handshake_server
+from pump import pump_tcp
+from upstream import UpstreamPool
+import dial
+import metrics
 from msg import GENERAL_SOCKS_SERVER_FAILURE, UDP_ASSOCIATE, SUCCEEDED, \
 CONNECT, BIND
 
@@ -14,10 +18,12 @@ log = logging.getLogger(__name__)
 
 class SocksForwardSession(RelaySession):
     
-    def __init__(self, socksconn, remoteconn):
+    def __init__(self, socksconn, remoteconn, handshaken=False):
         super(SocksForwardSession, self).__init__(socksconn)
         
         self.remoteconn = remoteconn
+        # remoteconn already passed the method exchange, answer the client locally
+        self.handshaken = handshaken
         self.track_sock(self.remoteconn)
         self.remotetimeout = self.remoteconn.gettimeout()
         self.client_associate = None
@@ -26,10 +32,10 @@ class SocksForwardSession(RelaySession):
         self.local2remote_udpsock = None
         
     def proc_tcp_request(self, req):
-        self.remoteconn.sendall(req.pack())
+        self.remoteconn.sendall(req.pack() + self.early_data)
         
     def relay_tcp(self):
-        pipe_tcp(self.socksconn, self.remoteconn, self.timeout, self.remotetimeout)
+        pump_tcp(self.socksconn, self.remoteconn, self.timeout, self.remotetimeout)
         
     def proc_udp_request(self, req):
         self.client_associate = (req.dstaddr, req.dstport)
@@ -75,7 +81,7 @@ class SocksForwardSession(RelaySession):
             return _
             
         pipe_udp([self.socksconn, self.remoteconn],
-            self.client2local_udpsock, self.local2remote_udpsock,
+            self.client2local_udpsock, [self.local2remote_udpsock],
             self.timeout, self.remotetimeout,
             addrchecker(), c2r(), r2c())
     
@@ -84,12 +90,21 @@ class SocksForwardSession(RelaySession):
             self.relay_udp()
     
     def process(self):
+        req = None
         try:
-            initreq = read_init_request(self.socksconn)
-            self.remoteconn.sendall(initreq.pack())
-            initreply = read_init_reply(self.remoteconn)
-            self.socksconn.sendall(initreply.pack())
-            req = read_request(self.socksconn)
+            reader = SocksReader(self.socksconn)
+            if self.handshaken:
+                if not basic_handshake_server(self.socksconn, reader):
+                    metrics.handshake_failures.labels("socks5").inc()
+                    self.clean()
+                    return
+            else:
+                initreq = reader.read_init_request()
+                self.remoteconn.sendall(initreq.pack())
+                initreply = read_init_reply(self.remoteconn)
+                self.socksconn.sendall(initreply.pack())
+            req = reader.read_request()
+            self.early_data = reader.rest()
             {
                 CONNECT: self.cmd_connect,
                 BIND: self.cmd_bind,
@@ -98,20 +113,33 @@ class SocksForwardSession(RelaySession):
             self.clean()
         except Exception, e:
             log.error("[Exception][SocksForwardSession]: %s" % str(e))
+            if req is None:
+                metrics.handshake_failures.labels("socks5").inc()
             self.clean()
     
 class SocksForwardFactory(RelayFactory):
     """ forward to another socks.
+    
+    with pool_size > 0, connections that already passed the method exchange
+    are kept ready and the client greeting is answered locally.
     """
-    def __init__(self, remoteip, remoteport, timeout=30):
+    def __init__(self, remoteip, remoteport, timeout=30, pool_size=4):
         self.remoteip = remoteip
         self.remoteport = remoteport
         self.timeout = timeout
+        self.pool = None
+        if pool_size > 0:
+            self.pool = UpstreamPool(remoteip, remoteport, pool_size, timeout)
+            self.pool.warm()
     
     def create_relay_session(self, socksconn, clientaddr):
         try:
-            log.info("New socks connection from %s" % str(clientaddr))
-            remoteconn = socket.create_connection((self.remoteip, self.remoteport), self.timeout)
+            log.info("New socks connection from %s", clientaddr)
+            if self.pool:
+                remoteconn = self.pool.get()
+                if remoteconn:
+                    return SocksForwardSession(socksconn, remoteconn, handshaken=True)
+            remoteconn = dial.create_connection((self.remoteip, self.remoteport), self.timeout)
             remoteconn.settimeout(self.timeout)
             return SocksForwardSession(socksconn, remoteconn)
         except socket.timeout, e:  # @UndefinedVariable
@@ -22,7 +22,7 @@ def main():
     localip = sys.argv[1]
     localport = sys.argv[2]
     remoteip = sys.argv[3]
-    remoteport = sys.argv[4]
+    remoteport = int(sys.argv[4])
     
     logging.basicConfig(
         format='[%(asctime)s][%(name)s][%(levelname)s] - %(message)s',
@@ -2,20 +2,37 @@
 import logging
 import sys
 import os
+from optparse import OptionParser
 from sys import platform as _platform
 if _platform == "linux" or _platform == "linux2":
     os.environ['GEVENT_RESOLVER'] = "ares"
 
 from relay import SocksRelayFactory
 from server import SocksServer
+from metrics import MetricsServer
+import prefork
+import tuning
+from admission import AdmissionControl
+from accesslog import open_access_log
 
 def usage(f):
     print >> f, """
-Usage: python proxy.py localip localport
+Usage: python proxy.py [--splice] [--metrics port] [--workers n] [--tuning default|interactive|bulk] [--evict-idle]
+       [--access-log file [--access-sample ratio] [--access-rate n]] localip localport
     """
 
 def main():
-    if len(sys.argv) < 3:
+    parser = OptionParser(add_help_option=False)
+    parser.add_option("--splice", action="store_true", dest="splice", default=False)
+    parser.add_option("--metrics", type="int", dest="metrics", default=0)
+    parser.add_option("--workers", type="int", dest="workers", default=1)
+    parser.add_option("--tuning", dest="tuning", default="default")
+    parser.add_option("--evict-idle", action="store_true", dest="evict_idle", default=False)
+    parser.add_option("--access-log", dest="access_log", default="")
+    parser.add_option("--access-sample", type="float", dest="access_sample", default=1.0)
+    parser.add_option("--access-rate", type="int", dest="access_rate", default=0)
+    options, args = parser.parse_args()
+    if len(args) < 2:
         usage(f=sys.stderr)
         sys.exit(-1)
         
@@ -24,10 +41,28 @@ def main():
         datefmt='%Y-%d-%m %H:%M:%S',
         level=logging.DEBUG, 
     )
-    localip = sys.argv[1]
-    localport = int(sys.argv[2])
-    relayfactory = SocksRelayFactory()
-    socks = SocksServer(localip, localport, relayfactory)
+    localip = args[0]
+    localport = int(args[1])
+    tuning.set_default(options.tuning)
+    def accesslog():
+        if options.access_log:
+            return open_access_log(options.access_log, options.access_sample, options.access_rate)
+        return None
+    
+    if options.workers > 1:
+        def worker(_):
+            relayfactory = SocksRelayFactory(use_splice=options.splice)
+            admission = AdmissionControl(200, evict_idle=options.evict_idle)
+            SocksServer(localip, localport, relayfactory, reuse_port=True, admission=admission,
+                        accesslog=accesslog()).run()
+        prefork.run(worker, options.workers, options.metrics)
+        return
+    
+    relayfactory = SocksRelayFactory(use_splice=options.splice)
+    admission = AdmissionControl(200, evict_idle=options.evict_idle)
+    socks = SocksServer(localip, localport, relayfactory, admission=admission, accesslog=accesslog())
+    if options.metrics:
+        MetricsServer("127.0.0.1", options.metrics).start()
     socks.run()
     
 if __name__ == '__main__':
@@ -0,0 +1,105 @@
+# linux splice(2) based zero-copy tcp relay
+import os
+import sys
+import errno
+import fcntl
+import logging
+import ctypes
+import ctypes.util
+
+from gevent import socket
+
+from pump import TCPPump
+
+log = logging.getLogger(__name__)
+
+SPLICE_F_MOVE       = 1
+SPLICE_F_NONBLOCK   = 2
+SPLICE_F_MORE       = 4
+
+CHUNKSIZE = 65536
+
+_splice = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        _splice = _libc.splice
+        _splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                            ctypes.c_size_t, ctypes.c_uint]
+        _splice.restype = ctypes.c_ssize_t
+    except (OSError, AttributeError):
+        _splice = None
+
+available = _splice is not None
+
+def splice(fd_in, fd_out, length, flags=SPLICE_F_MOVE|SPLICE_F_NONBLOCK):
+    """ return bytes moved, or None if the call would block.
+    """
+    n = _splice(fd_in, None, fd_out, None, length, flags)
+    if n < 0:
+        err = ctypes.get_errno()
+        if err == errno.EAGAIN:
+            return None
+        raise OSError(err, os.strerror(err))
+    return n
+
+def nonblocking_pipe():
+    rfd, wfd = os.pipe()
+    for fd in (rfd, wfd):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return rfd, wfd
+
+class SplicePump(TCPPump):
+    """ TCPPump moving payload socket->pipe->socket inside the kernel.
+
+    every splice call is preceded by a gevent wait_read/wait_write on the
+    descriptor it touches, so the hub keeps scheduling other sessions. a
+    direction whose very first splice is refused (EINVAL, ENOSYS) falls
+    back to the userspace pump.
+    """
+    def pump(self, src, dst):
+        sfd = src.fileno()
+        dfd = dst.fileno()
+        rfd, wfd = nonblocking_pipe()
+        moved = False
+        relayed = self.tally(src)
+        try:
+            while True:
+                socket.wait_read(sfd)
+                try:
+                    n = splice(sfd, wfd, CHUNKSIZE)
+                except OSError, e:
+                    if not moved and e.errno in (errno.EINVAL, errno.ENOSYS):
+                        log.info("[SplicePump]: splice refused, fallback to userspace pump")
+                        os.close(rfd)
+                        os.close(wfd)
+                        rfd = wfd = None
+                        return TCPPump.pump(self, src, dst)
+                    raise
+                if n is None:
+                    continue
+                if n == 0:
+                    self.half_close(dst)
+                    return
+                moved = True
+                self.touch()
+                while n:
+                    socket.wait_write(dfd)
+                    m = splice(rfd, dfd, n)
+                    if m:
+                        n -= m
+                        relayed.value += m
+        except (socket.error, IOError, OSError), e:  # @UndefinedVariable
+            log.debug("[SplicePump]: %s" % str(e))
+        finally:
+            if self.record:
+                self.record.relayed(src is self.local, relayed.value)
+            relayed.release()
+            if rfd is not None:
+                os.close(rfd)
+                os.close(wfd)
+        self.finished.set()
+
+def splice_tcp(local, remote, local_timeout, remote_timeout):
+    SplicePump(local, remote, local_timeout, remote_timeout).run()
@@ -0,0 +1,152 @@
+# hierarchical timing wheel for session idle timeouts
+import time
+import logging
+
+import gevent
+
+log = logging.getLogger(__name__)
+
+class Timer(object):
+    """ a deadline registered in a TimerWheel.
+
+    reset() only moves the deadline: the timer stays in its slot and is
+    re-filed when that slot comes up, so resetting on every read costs an
+    assignment. only a reset to an earlier deadline re-files it at once.
+    """
+    __slots__ = ('wheel', 'delay', 'deadline', 'callback', 'args', 'slot')
+
+    def __init__(self, wheel, delay, callback, args):
+        self.wheel = wheel
+        self.delay = delay
+        self.deadline = time.time() + delay
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+    @property
+    def idle(self):
+        """ seconds since the last reset.
+        """
+        return time.time() - (self.deadline - self.delay)
+
+    def reset(self, delay=None):
+        if delay is None:
+            self.deadline = time.time() + self.delay
+            return
+        deadline = time.time() + delay
+        earlier = deadline < self.deadline
+        self.delay = delay
+        self.deadline = deadline
+        if earlier and self.slot is not None:
+            self.slot.discard(self)
+            self.wheel._insert(self, self.wheel.current + 1)
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+class TimerWheel(object):
+    """ timers filed by expiry tick into levels of slots, each level
+    covering slots times the span of the one below.
+
+    arm, reset and cancel are O(1). one greenlet advances the wheel every
+    tick while there are timers, and callbacks run in that greenlet, so
+    they must not block.
+    """
+    def __init__(self, tick=0.5, bits=6, levels=4):
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = levels
+        self.horizon = (1 << (bits * levels)) - 1
+        self.wheels = [[set() for _ in range(1 << bits)] for _ in range(levels)]
+        self.origin = time.time()
+        self.current = 0
+        self.count = 0
+        self.ticker = None
+        self.fired = 0
+
+    def _ticks(self, t):
+        return int((t - self.origin) / self.tick) + 1
+
+    def _insert(self, timer, earliest):
+        expires = max(self._ticks(timer.deadline), earliest)
+        delta = min(expires - self.current, self.horizon)
+        expires = self.current + delta
+        level = 0
+        while delta > self.mask and level < self.levels - 1:
+            delta >>= self.bits
+            level += 1
+        slot = self.wheels[level][(expires >> (self.bits * level)) & self.mask]
+        slot.add(timer)
+        timer.slot = slot
+
+    def arm(self, delay, callback, *args):
+        """ call callback(*args) once delay seconds have passed without
+        the returned timer being reset or cancelled.
+        """
+        if self.count == 0:
+            # nothing filed, skip the ticks missed while idle
+            self.current = self._ticks(time.time()) - 1
+        timer = Timer(self, delay, callback, args)
+        self._insert(timer, self.current + 1)
+        self.count += 1
+        if self.ticker is None:
+            self.ticker = gevent.spawn(self._run)
+        return timer
+
+    def _fire(self, timer):
+        timer.slot = None
+        self.count -= 1
+        self.fired += 1
+        try:
+            timer.callback(*timer.args)
+        except Exception, e:
+            log.error("[Exception][TimerWheel]: %s" % str(e))
+
+    def advance(self, now):
+        target = self._ticks(now) - 1
+        while self.current < target:
+            self.current += 1
+            t = self.current
+            for level in range(1, self.levels):
+                if t & ((1 << (self.bits * level)) - 1):
+                    break
+                slot = self.wheels[level][(t >> (self.bits * level)) & self.mask]
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    self._insert(timer, t)
+            slot = self.wheels[0][t & self.mask]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                if timer.slot is not slot:
+                    # cancelled or re-filed by an earlier callback
+                    continue
+                if timer.deadline <= now:
+                    self._fire(timer)
+                else:
+                    self._insert(timer, t + 1)
+
+    def _run(self):
+        try:
+            while self.count > 0:
+                gevent.sleep(self.tick)
+                self.advance(time.time())
+        finally:
+            self.ticker = None
+
+    def stats(self):
+        return {
+            'timers': self.count,
+            'fired': self.fired,
+        }
+
+default_wheel = TimerWheel()
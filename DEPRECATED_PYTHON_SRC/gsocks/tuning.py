@@ -0,0 +1,126 @@
+# socket option profiles for accepted and outbound relay sockets
+import sys
+import logging
+
+from gevent import socket
+
+log = logging.getLogger(__name__)
+
+# missing from the socket module of python 2
+TCP_FASTOPEN = getattr(socket, "TCP_FASTOPEN", 23 if sys.platform.startswith("linux") else None)
+TCP_FASTOPEN_CONNECT = 30 if sys.platform.startswith("linux") else None
+# darwin calls TCP_KEEPIDLE TCP_KEEPALIVE
+TCP_KEEPIDLE = getattr(socket, "TCP_KEEPIDLE", 0x10 if sys.platform == "darwin" else None)
+TCP_KEEPINTVL = getattr(socket, "TCP_KEEPINTVL", None)
+TCP_KEEPCNT = getattr(socket, "TCP_KEEPCNT", None)
+
+class SocketProfile(object):
+    """ options set on relay sockets.
+
+    nodelay turns Nagle off. keepalive is (idle, interval, count) in
+    seconds, platforms without the per-socket knobs get plain SO_KEEPALIVE.
+    sndbuf/rcvbuf of 0 keep the kernel's autotuned buffers, fixed sizes
+    are capped by net.core.wmem_max/rmem_max on linux. fastopen is the
+    TCP Fast Open queue length of listeners, fastopen_connect sends the
+    first write of outbound sockets in the SYN.
+    """
+    def __init__(self, name="custom", nodelay=False, keepalive=None, sndbuf=0, rcvbuf=0,
+                 fastopen=0, fastopen_connect=False):
+        self.name = name
+        self.nodelay = nodelay
+        self.keepalive = tuple(keepalive) if keepalive else None
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.fastopen = fastopen
+        self.fastopen_connect = fastopen_connect
+
+    def _set(self, sock, level, option, value):
+        if option is None:
+            return
+        try:
+            sock.setsockopt(level, option, value)
+        except socket.error, e:  # @UndefinedVariable
+            log.debug("[SocketProfile %s]: option %d: %s" % (self.name, option, str(e)))
+
+    def _common(self, sock):
+        if self.nodelay:
+            self._set(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # @UndefinedVariable
+        if self.keepalive:
+            idle, interval, count = self.keepalive
+            self._set(sock, socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)  # @UndefinedVariable
+            self._set(sock, socket.IPPROTO_TCP, TCP_KEEPIDLE, idle)  # @UndefinedVariable
+            self._set(sock, socket.IPPROTO_TCP, TCP_KEEPINTVL, interval)  # @UndefinedVariable
+            self._set(sock, socket.IPPROTO_TCP, TCP_KEEPCNT, count)  # @UndefinedVariable
+        if self.sndbuf:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)  # @UndefinedVariable
+        if self.rcvbuf:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)  # @UndefinedVariable
+
+    def listening(self, sock):
+        """ for a listener, accepted sockets inherit the buffer sizes.
+        """
+        if self.fastopen:
+            self._set(sock, socket.IPPROTO_TCP, TCP_FASTOPEN, self.fastopen)  # @UndefinedVariable
+        if self.sndbuf:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)  # @UndefinedVariable
+        if self.rcvbuf:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)  # @UndefinedVariable
+
+    def accepted(self, sock):
+        self._common(sock)
+
+    def outbound(self, sock):
+        """ for a socket about to connect, so that the buffer sizes count
+        in the window scale negotiated by the handshake.
+        """
+        self._common(sock)
+        if self.fastopen_connect:
+            self._set(sock, socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)  # @UndefinedVariable
+
+    def __repr__(self):
+        return "<SocketProfile %s>" % self.name
+
+# fastopen_connect is off in both presets: a connect() that returns before
+# the handshake hides unreachable addresses from dial's connection racing
+PROFILES = {
+    "default": SocketProfile("default"),
+    # ssh and the like, small writes that must not wait for Nagle
+    "interactive": SocketProfile("interactive", nodelay=True, keepalive=(60, 10, 6), fastopen=64),
+    # downloads over long fat pipes
+    "bulk": SocketProfile("bulk", keepalive=(300, 30, 4), sndbuf=4<<20, rcvbuf=4<<20),
+}
+
+default_profile = PROFILES["default"]
+
+def get_profile(conf):
+    """ a profile from a preset name, or from a dict of options on top of
+    the preset given as "base".
+    """
+    if not conf:
+        return PROFILES["default"]
+    if isinstance(conf, SocketProfile):
+        return conf
+    if isinstance(conf, basestring):
+        if conf not in PROFILES:
+            raise ValueError("unknown socket tuning profile: %s" % conf)
+        return PROFILES[conf]
+    conf = dict(conf)
+    base = get_profile(conf.pop("base", "default"))
+    options = dict(base.__dict__)
+    options.update(conf)
+    options["name"] = "%s+custom" % base.name
+    return SocketProfile(**options)
+
+def set_default(conf):
+    """ make conf the profile of servers and dials not given one.
+    """
+    global default_profile
+    default_profile = get_profile(conf)
+    log.info("socket tuning profile: %s" % default_profile.name)
+    return default_profile
+
+def accepted(sock):
+    default_profile.accepted(sock)
+
+def outbound(sock):
+    default_profile.outbound(sock)
@@ -0,0 +1,126 @@
+# socks5 UDP fragment reassembly (RFC 1928, section 7)
+import time
+import logging
+
+from msg import UDPRequest
+
+log = logging.getLogger(__name__)
+
+# high-order bit of FRAG marks the end of a fragment sequence
+FRAG_END = 0x80
+FRAG_POSITION = 0x7f
+
+# the RFC asks for no less than 5 seconds
+REASSEMBLY_TIMEOUT = 5
+
+class FragmentBudget(object):
+    """ memory held by all reassembly queues of a process.
+
+    when a fragment does not fit, queues whose timer has already run out
+    are evicted first, and the fragment is dropped if that is not enough.
+    """
+    def __init__(self, limit=4<<20):
+        self.limit = limit
+        self.used = 0
+        self.queues = set()
+        self.completed = 0
+        self.dropped = 0
+        self.evicted = 0
+
+    def reserve(self, n):
+        if self.used + n > self.limit:
+            now = time.time()
+            for queue in [q for q in self.queues if q.expired(now)]:
+                queue.evict()
+        if self.used + n > self.limit:
+            return False
+        self.used += n
+        return True
+
+    def release(self, n):
+        self.used -= n
+
+    def stats(self):
+        return {
+            'used': self.used,
+            'queues': len(self.queues),
+            'completed': self.completed,
+            'dropped': self.dropped,
+            'evicted': self.evicted,
+        }
+
+default_budget = FragmentBudget()
+
+class Reassembler(object):
+    """ reassembly queue and timer of one UDP association.
+
+    fragments are accepted in increasing FRAG order only. a fragment with
+    FRAG not above the highest one queued, or arriving after the timer ran
+    out, abandons the sequence in progress. a sequence over maxbytes, or
+    one the shared budget cannot hold, is dropped.
+    """
+    def __init__(self, timeout=REASSEMBLY_TIMEOUT, maxbytes=65536, budget=default_budget):
+        self.timeout = timeout
+        self.maxbytes = maxbytes
+        self.budget = budget
+        self.first = None
+        self.fragments = []
+        self.highest = 0
+        self.size = 0
+        self.started = 0
+
+    def expired(self, now):
+        return bool(self.fragments) and now - self.started > self.timeout
+
+    def reset(self):
+        if self.size:
+            self.budget.release(self.size)
+        self.budget.queues.discard(self)
+        self.first = None
+        self.fragments = []
+        self.highest = 0
+        self.size = 0
+
+    def evict(self):
+        log.info("[Reassembler] incomplete fragment sequence of %d bytes evicted" % self.size)
+        self.budget.evicted += 1
+        self.reset()
+
+    def drop(self):
+        self.budget.dropped += 1
+        self.reset()
+
+    def feed(self, udpreq):
+        """ the reassembled UDPRequest once udpreq completes a sequence,
+        None while it is incomplete or after it has been dropped.
+        """
+        frag = ord(udpreq.frag)
+        position = frag & FRAG_POSITION
+        now = time.time()
+        if self.fragments and (position <= self.highest or self.expired(now)):
+            self.evict()
+        if not self.fragments:
+            if position != 1:
+                # the head of this sequence is lost
+                self.budget.dropped += 1
+                return None
+            self.first = udpreq
+            self.started = now
+            self.budget.queues.add(self)
+
+        n = len(udpreq.data)
+        if self.size + n > self.maxbytes or not self.budget.reserve(n):
+            self.drop()
+            return None
+        self.fragments.append(udpreq.data)
+        self.size += n
+        self.highest = position
+        if not frag & FRAG_END:
+            return None
+
+        first = self.first
+        data = "".join(self.fragments)
+        self.reset()
+        self.budget.completed += 1
+        return UDPRequest(addrtype=first.addrtype, dstaddr=first.dstaddr,
+                          dstport=first.dstport, data=data)
@@ -0,0 +1,113 @@
+# destination table of a socks5 UDP association
+import time
+import logging
+
+from gevent import socket
+
+from dial import is_ip
+from dnscache import default_cache
+
+log = logging.getLogger(__name__)
+
+class UDPNat(object):
+    """ outbound side of one UDP association.
+
+    datagrams leave through one unconnected socket per address family, so a
+    client can talk to any number of peers over a single association.
+    every destination sent to gets an entry, and only datagrams from a live
+    entry are passed back to the client. entries expire after idle seconds
+    without traffic, and the least recently used one is evicted once there
+    are maxentries of them.
+    """
+    def __init__(self, idle=60, maxentries=256):
+        self.idle = idle
+        self.maxentries = maxentries
+        # family -> unconnected socket
+        self.socks = {}
+        # (ip, port) -> last active
+        self.entries = {}
+        self.evicted = 0
+        self.expired = 0
+        self.dropped = 0
+        for (af, anyaddr) in ((socket.AF_INET, '0.0.0.0'), (socket.AF_INET6, '::')):  # @UndefinedVariable
+            try:
+                sock = socket.socket(af, socket.SOCK_DGRAM)  # @UndefinedVariable
+                sock.bind((anyaddr, 0))
+                self.socks[af] = sock
+            except socket.error, e:  # @UndefinedVariable
+                log.debug("[UDPNat] no socket for family %d: %s" % (af, str(e)))
+
+    def sockets(self):
+        return self.socks.values()
+
+    def sock_for(self, sockaddr):
+        if len(sockaddr) == 4:
+            return self.socks.get(socket.AF_INET6)  # @UndefinedVariable
+        return self.socks.get(socket.AF_INET)  # @UndefinedVariable
+
+    def resolve(self, host, port):
+        af = is_ip(host)
+        if af == socket.AF_INET6:  # @UndefinedVariable
+            # the form recvfrom() reports replies with
+            host = socket.inet_ntop(af, socket.inet_pton(af, host))  # @UndefinedVariable
+            return (host, port, 0, 0)
+        elif af:
+            return (host, port)
+        try:
+            addrs = default_cache.getaddrinfo(host, port)
+        except (socket.error, socket.gaierror), e:  # @UndefinedVariable
+            log.info("[UDPNat] cannot resolve %s: %s" % (host, str(e)))
+            return None
+        for (af, sockaddr) in addrs:
+            if af in self.socks:
+                return sockaddr
+        return None
+
+    def expire(self):
+        deadline = time.time() - self.idle
+        for key in [k for (k, t) in self.entries.iteritems() if t < deadline]:
+            del self.entries[key]
+            self.expired += 1
+
+    def route(self, host, port):
+        """ sockaddr to send a datagram for host:port to, or None when there
+        is no way to reach it.
+        """
+        sockaddr = self.resolve(host, port)
+        if not sockaddr or not self.sock_for(sockaddr):
+            self.dropped += 1
+            return None
+        key = sockaddr[:2]
+        if key not in self.entries and len(self.entries) >= self.maxentries:
+            self.expire()
+            if len(self.entries) >= self.maxentries:
+                oldest = min(self.entries, key=self.entries.get)
+                del self.entries[oldest]
+                self.evicted += 1
+        self.entries[key] = time.time()
+        return sockaddr
+
+    def accept(self, addr):
+        """ whether a datagram from addr belongs to this association.
+        """
+        key = addr[:2]
+        t = self.entries.get(key)
+        now = time.time()
+        if t is None or now - t > self.idle:
+            self.dropped += 1
+            return False
+        self.entries[key] = now
+        return True
+
+    def close(self):
+        for sock in self.socks.itervalues():
+            sock.close()
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'evicted': self.evicted,
+            'expired': self.expired,
+            'dropped': self.dropped,
+        }
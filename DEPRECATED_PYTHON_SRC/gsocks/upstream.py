@@ -0,0 +1,217 @@
+# pre-handshaken connections to upstream socks5 servers
+import time
+import logging
+from collections import deque
+
+import gevent
+from gevent import select, socket
+
+from utils import basic_handshake_client, read_init_reply, read_reply, ProtocolError, FormatError
+from msg import InitRequest, NO_AUTHENTICATION_REQUIRED, UnpackError
+import dial
+import metrics
+
+log = logging.getLogger(__name__)
+
+# delay before refilling again after a failure, doubled on each one
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 300
+# pipelined handshakes failing in a row before an upstream is no longer
+# sent any
+MAX_PIPELINE_FAILURES = 3
+
+HANDSHAKE_ERRORS = (socket.error, ProtocolError, FormatError, UnpackError)  # @UndefinedVariable
+
+class UpstreamError(Exception): pass
+
+class UpstreamPool(object):
+    """ keeps up to size connections to one upstream socks5 server that have
+    already passed the method exchange, so a session only has to send its
+    request.
+
+    get() takes the freshest idle connection, or returns None when there is
+    none, and refills the pool in the background, waiting longer after
+    each failed refill. an upstream requiring authentication is not
+    refilled before the longest wait. connections idle for more than
+    max_idle seconds, or that became readable (an upstream must stay
+    silent until it sees a request, so readable means closed or broken),
+    are dropped instead of handed out.
+
+    request() sends the greeting and a request in one write when the pool
+    is empty. when that gets no valid reply it retries the request once
+    with the strict exchange, and after MAX_PIPELINE_FAILURES such
+    failures in a row it stops pipelining to the upstream.
+    """
+    def __init__(self, host, port, size=4, timeout=30, max_idle=30):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = deque()
+        self.filling = False
+        self.pipelining = True
+        self.pipeline_failures = 0
+        # consecutive failed refills and when the next one may start
+        self.failures = 0
+        self.retry_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def new_connection(self):
+        sock = dial.create_connection((self.host, self.port), self.timeout)
+        sock.settimeout(self.timeout)
+        return sock
+
+    def connect(self):
+        sock = self.new_connection()
+        try:
+            if not basic_handshake_client(sock):
+                raise UpstreamError("upstream %s:%s requires authentication" % (self.host, self.port))
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def alive(self, sock):
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except Exception:
+            return False
+        return not readable
+
+    def evict(self):
+        deadline = time.time() - self.max_idle
+        while self.idle and self.idle[0][1] < deadline:
+            sock, _ = self.idle.popleft()
+            sock.close()
+            self.evicted += 1
+
+    def get(self):
+        self.evict()
+        while self.idle:
+            sock, _ = self.idle.pop()
+            if self.alive(sock):
+                self.hits += 1
+                self.warm()
+                return sock
+            sock.close()
+            self.evicted += 1
+        self.misses += 1
+        self.warm()
+        return None
+
+    def pipeline_failed(self, reason):
+        self.pipeline_failures += 1
+        log.debug("[UpstreamPool] pipelined handshake to %s:%s failed: %s" % (self.host, self.port, reason))
+        if self.pipeline_failures >= MAX_PIPELINE_FAILURES:
+            log.info("upstream %s:%s rejects pipelined handshake" % (self.host, self.port))
+            self.pipelining = False
+
+    def pipeline(self, request):
+        """ a new connection with the greeting and request sent in one
+        write and the method reply read, None when that failed.
+        """
+        sock = self.new_connection()
+        try:
+            sock.sendall(InitRequest().pack() + request)
+            if read_init_reply(sock).method == NO_AUTHENTICATION_REQUIRED:
+                return sock
+            self.pipeline_failed("method refused")
+        except HANDSHAKE_ERRORS, e:
+            self.pipeline_failed(str(e))
+        sock.close()
+        return None
+
+    def open(self, request=''):
+        """ a connection past the method exchange with request already
+        sent, for callers which leave the reply to someone else.
+        """
+        sock = self.get()
+        if not sock:
+            sock = self.connect()
+        try:
+            if request:
+                sock.sendall(request)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def request(self, request, data=''):
+        """ (connection, reply) for request, which is followed by data.
+        """
+        sock = self.get()
+        if not sock and self.pipelining:
+            sock = self.pipeline(request + data)
+            if sock:
+                try:
+                    reply = read_reply(sock)
+                    self.pipeline_failures = 0
+                    return sock, reply
+                except HANDSHAKE_ERRORS, e:
+                    # nothing answered, safe to send again
+                    sock.close()
+                    self.pipeline_failed(str(e))
+        sock = self.open(request + data)
+        try:
+            return sock, read_reply(sock)
+        except:
+            sock.close()
+            raise
+
+    def warm(self):
+        if self.size > 0 and not self.filling and len(self.idle) < self.size \
+                and time.time() >= self.retry_at:
+            self.filling = True
+            gevent.spawn(self._fill)
+
+    def _fill(self):
+        try:
+            while len(self.idle) < self.size:
+                self.idle.append((self.connect(), time.time()))
+            self.failures = 0
+        except Exception, e:
+            self.failures += 1
+            if isinstance(e, UpstreamError):
+                delay = MAX_RETRY_DELAY
+            else:
+                delay = min(RETRY_DELAY << (self.failures - 1), MAX_RETRY_DELAY)
+            self.retry_at = time.time() + delay
+            log.error("[Exception][UpstreamPool] %s:%s: %s, refill in %ds" % (self.host, self.port, str(e), delay))
+        finally:
+            self.filling = False
+
+    def close(self):
+        while self.idle:
+            sock, _ = self.idle.pop()
+            sock.close()
+
+    def stats(self):
+        return {
+            'idle': len(self.idle),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evicted': self.evicted,
+            'pipelining': self.pipelining,
+            'pipeline_failures': self.pipeline_failures,
+            'failures': self.failures,
+        }
+
+# (host, port) -> UpstreamPool, shared by all sessions of a process
+pools = {}
+
+def get_pool(host, port, timeout=30, size=4):
+    key = (host, port)
+    pool = pools.get(key)
+    if pool is None:
+        pool = UpstreamPool(host, port, size=size, timeout=timeout)
+        pools[key] = pool
+        upstream = "%s:%s" % key
+        metrics.upstream_hits.labels(upstream).set_function(lambda: pool.hits)
+        metrics.upstream_misses.labels(upstream).set_function(lambda: pool.misses)
+        metrics.upstream_evicted.labels(upstream).set_function(lambda: pool.evicted)
+        pool.warm()
+    return pool
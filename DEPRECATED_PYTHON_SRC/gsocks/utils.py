@@ -1,39 +1,93 @@
 # basic routinues
-import struct
+import time
 
 from gevent import socket
 from gevent import select
 
 import msg
+import mmsg
+import metrics
+import accesslog
 
 class ProtocolError(Exception): pass
 class FormatError(Exception): pass
 
-def readaddr(sock, addrtype):
-    if addrtype == msg.IP_V4:
-        return sock.recv(4)
-    elif addrtype == msg.IP_V6:
-        return sock.recv(16)
-    elif addrtype == msg.DOMAIN_NAME:
-        data1 = sock.recv(1)
-        length = struct.unpack('B', data1)[0]
-        data2 = sock.recv(length)
-        return data1 + data2
-    else:
-        raise FormatError("Unknown address type %s" % addrtype.encode('hex'))
+class SocksReader(object):
+    """ buffered reader for socks5 handshake messages.
+    
+    by default it reads whatever is available, so a greeting and a request
+    pipelined into one segment cost a single recv(). bytes read past the last
+    parsed message are kept and handed out by rest(). with exact=True it never
+    reads past the message being parsed, for sockets handed on to code that
+    does not know about the buffer.
+    """
+    def __init__(self, sock, exact=False, bufsize=4096):
+        self.sock = sock
+        self.exact = exact
+        self.bufsize = bufsize
+        self.buf = ""
+        
+    def _need(self, n):
+        while len(self.buf) < n:
+            if self.exact:
+                data = self.sock.recv(n - len(self.buf))
+            else:
+                data = self.sock.recv(self.bufsize)
+            if not data:
+                raise ProtocolError("connection closed in handshake")
+            self.buf += data
+            
+    def _take(self, n):
+        data = self.buf[:n]
+        self.buf = self.buf[n:]
+        return data
+    
+    def _addressed_length(self):
+        # VER CMD/REP RSV ATYP ADDR PORT, needs the first address byte for domains
+        self._need(5)
+        addrtype = self.buf[3]
+        if addrtype == msg.IP_V4:
+            return 10
+        elif addrtype == msg.IP_V6:
+            return 22
+        elif addrtype == msg.DOMAIN_NAME:
+            return 7 + ord(self.buf[4])
+        else:
+            raise FormatError("Unknown address type %s" % addrtype.encode('hex'))
+        
+    def read_init_request(self):
+        self._need(2)
+        n = 2 + ord(self.buf[1])
+        self._need(n)
+        initreq = msg.InitRequest(self._take(n))
+        if initreq.version != msg.SOCKS5:
+            raise ProtocolError("Unsupported version %s" % initreq.version.encode('hex'))
+        return initreq
+    
+    def read_init_reply(self):
+        self._need(2)
+        return msg.InitReply(self._take(2))
+    
+    def read_request(self):
+        n = self._addressed_length()
+        self._need(n)
+        return msg.Request(self._take(n))
+    
+    def read_reply(self):
+        n = self._addressed_length()
+        self._need(n)
+        return msg.Reply(self._take(n))
+    
+    def rest(self):
+        data = self.buf
+        self.buf = ""
+        return data
 
 def read_init_request(sock):
-    data1 = sock.recv(2)
-    data2 = sock.recv(struct.unpack('B', data1[1])[0])
-    initreq = msg.InitRequest(data1+data2)
-    if initreq.version != msg.SOCKS5:
-        raise ProtocolError("Unsupported version %s" % initreq.version.encode('hex'))
-    return initreq
+    return SocksReader(sock, exact=True).read_init_request()
 
 def read_init_reply(sock):
-    data = sock.recv(2)
-    initreply = msg.InitReply(data)
-    return initreply
+    return SocksReader(sock, exact=True).read_init_reply()
 
 def init_reply(sock, method):
     sock.sendall(msg.InitReply(method=method).pack())
@@ -48,8 +102,10 @@ def basic_handshake_client(sock):
         return False
     return True
 
-def basic_handshake_server(sock):
-    initreq = read_init_request(sock)
+def basic_handshake_server(sock, reader=None):
+    if reader is None:
+        reader = SocksReader(sock, exact=True)
+    initreq = reader.read_init_request()
     if initreq.version != msg.SOCKS5:
         return False
     if msg.NO_AUTHENTICATION_REQUIRED not in initreq.methods:
@@ -60,21 +116,13 @@ def basic_handshake_server(sock):
     return True
 
 def read_request(sock):
-    data1 = sock.recv(4)
-    data2 = readaddr(sock, data1[3])
-    data3 = sock.recv(2)
-    req = msg.Request(data1 + data2 + data3)
-    return req
+    return SocksReader(sock, exact=True).read_request()
 
 def send_request(sock, cmd, addrtype, dstaddr, dstport):
     sock.sendall(msg.Request(cmd=cmd, addrtype=addrtype, dstaddr=dstaddr, dstport=dstport).pack())
 
 def read_reply(sock):
-    data1 = sock.recv(4)
-    data2 = readaddr(sock, data1[3])
-    data3 = sock.recv(2)
-    reply = msg.Reply(data1 + data2 + data3)
-    return reply
+    return SocksReader(sock, exact=True).read_reply()
 
 def request_fail(sock, request, response):
     reply = msg.Reply(rep=response, addrtype=request.addrtype,
@@ -86,67 +134,76 @@ def request_success(sock, addrtype, bndaddr, bndport):
         bndaddr=bndaddr, bndport=bndport)
     sock.sendall(reply.pack())
     
-def pipe_tcp(local, remote, local_timeout, remote_timeout, bufsize=65536):
-    rlist = [local, remote]
-    local_timer = 0
-    remote_timer = 0
-    while True:
-        readable, _, _ = select.select(rlist, [], [], timeout=1)
-        if not readable:
-            local_timer += 1
-            remote_timer += 1
-            if local_timer > local_timeout or remote_timer > remote_timeout:
-                return
-            else:
-                continue
-        
-        if local in readable:
-            local_timer = 0
-            data = local.recv(bufsize)
-            if not data:
-                return
-            remote.sendall(data)
-            
-        if remote in readable:
-            remote_timer = 0
-            data = remote.recv(bufsize)
-            if not data:
-                return
-            local.sendall(data)
+def udp_sock_for(socks, addr):
+    """ the socket among socks able to send to addr.
+    """
+    if len(socks) == 1:
+        return socks[0]
+    if len(addr) == 4:
+        af = socket.AF_INET6  # @UndefinedVariable
+    else:
+        af = socket.AF_INET  # @UndefinedVariable
+    for sock in socks:
+        if sock.family == af:
+            return sock
+    return None
 
-def pipe_udp(tcpsocks, csock, rsock, ctimeout, rtimeout,
+def pipe_udp(tcpsocks, csock, rsocks, ctimeout, rtimeout,
                 caddrchecker, c2r, r2c):
-    rlist = tcpsocks + [csock, rsock]
-    csock_timer = 0
-    rsock_timer = 0
-    while True:
-        readable, _, _ = select.select(rlist, [], [], timeout=1)
-        if not readable:
-            csock_timer += 1
-            rsock_timer += 1
-            if csock_timer > ctimeout or rsock_timer > rtimeout:
-                return    
-            else:
-                continue
-           
-        for s in tcpsocks: 
-            if s in readable:
+    """ relay datagrams between csock and rsocks until a tcp socket becomes
+    readable or either side idles out. every wakeup drains a batch of
+    datagrams and sends the transformed batch with as few calls as possible.
+    idling out is noticed by select() timing out, nothing is raised into
+    c2r or r2c, which may be waiting on lookups shared with other sessions.
+    """
+    rlist = tcpsocks + [csock] + rsocks
+    now = time.time()
+    cexpires = now + ctimeout
+    rexpires = now + rtimeout
+    up = metrics.relayed_bytes.labels("udp", "up").tally()
+    down = metrics.relayed_bytes.labels("udp", "down").tally()
+    try:
+        while True:
+            timeout = min(cexpires, rexpires) - time.time()
+            if timeout <= 0:
                 return
-            
-        if csock in readable:
-            csock_timer = 0
-            fromdata, fromaddr = csock.recvfrom(65536)
-            if caddrchecker(fromaddr[0], fromaddr[1]):
-                todata, toaddr = c2r(fromdata, fromaddr)
-                if todata and toaddr:
-                    rsock.sendto(todata, toaddr)
+            readable, _, _ = select.select(rlist, [], [], timeout)
+            for s in tcpsocks: 
+                if s in readable:
+                    return
                 
-        if rsock in readable:
-            rsock_timer = 0
-            fromdata, fromaddr = rsock.recvfrom(65536)
-            todata, toaddr = r2c(fromdata, fromaddr)
-            if todata and toaddr:
-                csock.sendto(todata, toaddr)
+            if csock in readable:
+                cexpires = time.time() + ctimeout
+                out = {}
+                for (fromdata, fromaddr) in mmsg.recvmany(csock):
+                    if caddrchecker(fromaddr[0], fromaddr[1]):
+                        todata, toaddr = c2r(fromdata, fromaddr)
+                        if todata and toaddr:
+                            rsock = udp_sock_for(rsocks, toaddr)
+                            if rsock:
+                                out.setdefault(rsock, []).append((todata, toaddr))
+                                up.value += len(todata)
+                for (rsock, packets) in out.iteritems():
+                    mmsg.sendmany(rsock, packets)
+            
+            for rsock in rsocks:
+                if rsock in readable:
+                    rexpires = time.time() + rtimeout
+                    packets = []
+                    for (fromdata, fromaddr) in mmsg.recvmany(rsock):
+                        todata, toaddr = r2c(fromdata, fromaddr)
+                        if todata and toaddr:
+                            packets.append((todata, toaddr))
+                            down.value += len(todata)
+                    if packets:
+                        mmsg.sendmany(csock, packets)
+    finally:
+        record = accesslog.current()
+        if record:
+            record.up += up.value
+            record.down += down.value
+        up.release()
+        down.release()
                 
 def bind_local_udp(tcpsock):
     tcpaddr = tcpsock.getsockname()
@@ -156,13 +213,6 @@ def bind_local_udp(tcpsock):
     udpsock.bind(localaddr)
     return udpsock
 
-def bind_local_sock_by_addr(addr):
-    addrinfo = socket.getaddrinfo(addr[0], addr[1], 0, socket.SOCK_DGRAM, socket.SOL_UDP)  # @UndefinedVariable
-    af, socktype, proto, _, remoteaddr = addrinfo[0]
-    sock = socket.socket(af, socktype, proto)
-    sock.connect(remoteaddr)
-    return sock
-
 def sock_addr_info(sock):
     addr = sock.getsockname()
     if len(addr) == 4:
@@ -191,16 +241,3 @@ def addr_type(addr):
     except:
         pass
     return msg.DOMAIN_NAME
-    
-class SharedTimer(object):
-    """ this timer can be shared by two greenlets
-    """
-    def __init__(self, to):
-        self.to = to
-        self.timer = 0
-    def count(self, secs):
-        self.timer += secs
-    def reset(self):
-        self.timer = 0
-    def timeout(self):
-        return self.timer > self.to   
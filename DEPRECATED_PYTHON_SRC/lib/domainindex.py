@@ -0,0 +1,88 @@
+import re
+import fnmatch
+
+# what an entry says of a host equal to its name (EXACT) or below it (BELOW)
+WHITE = 1
+BLACK = 2
+EXACT_SHIFT = 0
+BELOW_SHIFT = 2
+
+WILDCARDS = re.compile(r'[*?\[]')
+
+class DomainIndex(object):
+    """ flags of domain names, looked up for every suffix of a host in one
+    walk from its last label.
+
+    every suffix of an entry is a key of one dict, entries map to their
+    flags and the suffixes in between to 0, so a walk stops at the first
+    suffix no entry ends with. flags hold WHITE and BLACK twice, for the
+    host being the name itself and for the host being below it.
+    fnmatch patterns of the custom lists compile to the same entries when
+    they are a name or *.name, the others are joined into one regex.
+    """
+    def __init__(self):
+        self.suffixes = {}
+        self.patterns = {WHITE: [], BLACK: []}
+        self.regex = {}
+
+    def add(self, name, flag, exact=True, below=True):
+        name = name.lower().rstrip(".")
+        bits = 0
+        if exact:
+            bits |= flag << EXACT_SHIFT
+        if below:
+            bits |= flag << BELOW_SHIFT
+        suffixes = self.suffixes
+        suffixes[name] = suffixes.get(name, 0) | bits
+        i = name.find(".")
+        while i >= 0:
+            parent = name[i+1:]
+            if parent in suffixes:
+                break
+            suffixes[parent] = 0
+            i = name.find(".", i+1)
+
+    def add_pattern(self, pattern, flag):
+        """ an fnmatch pattern as in the custom lists.
+        """
+        pattern = pattern.lower()
+        if not WILDCARDS.search(pattern):
+            self.add(pattern, flag, below=False)
+        elif pattern.startswith("*.") and not WILDCARDS.search(pattern[2:]):
+            self.add(pattern[2:], flag, exact=False)
+        else:
+            self.patterns[flag].append(pattern)
+            self.regex[flag] = re.compile("|".join([fnmatch.translate(p) for p in self.patterns[flag]]))
+
+    def lookup(self, host):
+        """ the WHITE and BLACK flags of all entries matching host.
+        """
+        host = host.lower()
+        if host.endswith("."):
+            host = host.rstrip(".")
+        suffixes = self.suffixes
+        flags = 0
+        end = len(host)
+        while True:
+            i = host.rfind(".", 0, end)
+            bits = suffixes.get(host[i+1:])
+            if bits is None:
+                break
+            if i < 0:
+                flags |= bits >> EXACT_SHIFT
+                break
+            flags |= bits >> BELOW_SHIFT
+            end = i
+        return self.match_patterns(host, flags & (WHITE | BLACK))
+
+    def match_patterns(self, host, flags=0):
+        """ flags with those of the wildcard patterns matching host added.
+        host is lower case.
+        """
+        for (flag, regex) in self.regex.iteritems():
+            if not flags & flag and regex.match(host):
+                flags |= flag
+        return flags
+
+    def __len__(self):
+        return len(self.suffixes)
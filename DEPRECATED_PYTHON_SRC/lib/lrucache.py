@@ -0,0 +1,62 @@
+import time
+from collections import OrderedDict
+
+class LRUCache(object):
+    """ at most maxsize entries kept for ttl seconds, the least recently
+    used going first when full.
+
+    None is a value like any other, get() tells a hit by its first item.
+    a pickled cache is restored empty, with its counters reset.
+    """
+    def __init__(self, maxsize=4096, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ (True, value) for a live entry, (False, None) otherwise.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            if entry[0] > time.time():
+                # back at the most recently used end
+                self.entries[key] = entry
+                self.hits += 1
+                return True, entry[1]
+            self.expired += 1
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        entries = self.entries
+        entries.pop(key, None)
+        entries[key] = (time.time() + self.ttl, value)
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        return (self.maxsize, self.ttl)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+        }
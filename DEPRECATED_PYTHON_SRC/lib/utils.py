@@ -13,6 +13,8 @@ import subprocess
 
 import requests
 import requesocks
+
+from gsocks.accesslog import BackgroundHandler
     
 def idle_port():
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -41,12 +43,17 @@ class LoggerWriter:
         pass
             
 def init_logging():
+    # a forked process inherits the handlers of its parent, but not their threads
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        if isinstance(h, BackgroundHandler):
+            root.removeHandler(h)
     if len(sys.argv)>1 and sys.argv[1] == "--debug":
         logger = logging.getLogger()
         logger.setLevel(logging.DEBUG)
         ch = logging.FileHandler("firefly.log")
         ch.setFormatter(logging.Formatter('[%(asctime)s][%(name)s][%(levelname)s] - %(message)s'))
-        logger.addHandler(ch)
+        logger.addHandler(BackgroundHandler(ch))
         sys.stdout = LoggerWriter(logger, logging.DEBUG)
         sys.stderr = LoggerWriter(logger, logging.DEBUG)
     else:
@@ -54,7 +61,7 @@ def init_logging():
         logger.setLevel(logging.DEBUG)
         ch = logging.StreamHandler()
         ch.setFormatter(logging.Formatter('[%(asctime)s][%(name)s][%(levelname)s] - %(message)s'))
-        logger.addHandler(ch)
+        logger.addHandler(BackgroundHandler(ch))
         
 def load_file(filename, idna=True):
     f = codecs.open(filename, "r", "utf-8")
@@ -30,6 +30,9 @@ from component.local import HTTPProxy, SocksProxy
 from component.brz import Browser, able_to_setproxy
 from component.matcher import create_matcher, blacklist_info, remote_update_blacklist
 from component.hosts import hosts_info, remote_update_hosts
+
+# seconds a replacing proxy process has to start listening
+READY_TIMEOUT = 10
     
 class Coordinator(ActorObject):
     def __init__(self, rootdir, conf_file):
@@ -108,6 +111,58 @@ class Coordinator(ActorObject):
             except Exception, e:
                 print "failed to start socks proxy: %s" % str(e)
                 
+    def replace_proxy(self, old, cls, enabled):
+        """ start cls with the current config and matcher in place of old,
+        which drains. the new process takes the listening socket over when
+        the address is unchanged, so no connection attempt is refused.
+        """
+        new = cls(self.ref(), self.matcher) if enabled else None
+        if old is None or not old.is_alive():
+            if new:
+                new.start()
+            return new
+        
+        if new and (new.ip, new.port) == (old.ip, old.port):
+            new.listener = old.ref().IPC_listener()
+            if not new.listener:
+                # the port cannot be shared, fall back to a plain restart
+                old.terminate()
+                old.join()
+                new.start()
+                return new
+        if new:
+            new.start()
+            if not new.ready.wait(READY_TIMEOUT):
+                print "failed to start %s, keep the running one" % cls.__name__
+                new.terminate()
+                new.join()
+                return old
+        old.drain()
+        t = threading.Thread(target=self.reap_proxy, args=(old, old.drain_timeout + READY_TIMEOUT))
+        t.daemon = True
+        t.start()
+        return new
+    
+    def reap_proxy(self, proxy, timeout):
+        proxy.process.join(timeout)
+        if proxy.is_alive():
+            proxy.terminate()
+        proxy.join()
+        
+    def reload_local_proxy(self):
+        global rootdir
+        
+        circumvention_url = self.IPC_circumvention_url()
+        self.matcher = create_matcher(rootdir, self.confdata, circumvention_url)
+        try:
+            self.http_proxy = self.replace_proxy(self.http_proxy, HTTPProxy, self.confdata['enable_http_proxy'])
+        except Exception, e:
+            print "failed to reload http proxy: %s" % str(e)
+        try:
+            self.socks_proxy = self.replace_proxy(self.socks_proxy, SocksProxy, self.confdata['enable_socks_proxy'])
+        except Exception, e:
+            print "failed to reload socks proxy: %s" % str(e)
+        
     def proxy_info(self):
         if self.socks_proxy:
             #ip, port = self.socks_proxy.ref().IPC_addr()
@@ -237,6 +292,11 @@ class Coordinator(ActorObject):
         self.end()
         return True
     
+    def IPC_reload_local_proxy(self):
+        """restart local proxies with the current config, draining the old ones"""
+        self.reload_local_proxy()
+        return True
+    
     def IPC_circumvention_url(self):
         """ask circumvention channel for forwarding url"""
         return self.cc_channel.ref().IPC_url()
@@ -275,6 +335,16 @@ class Coordinator(ActorObject):
     def IPC_hosts_info(self):
         return hosts_info(self.rootdir, self.confdata, self.matcher.hosts)
         
+    def IPC_matcher_stats(self):
+        """ decision cache stats of each running local proxy.
+        """
+        ret = {}
+        if self.http_proxy:
+            ret['http'] = self.http_proxy.ref().IPC_matcher_stats()
+        if self.socks_proxy:
+            ret['socks'] = self.socks_proxy.ref().IPC_matcher_stats()
+        return ret
+
     def IPC_get_custom_blacklist(self):
         return self.matcher.blacklist_matcher.get_custom_blacklist()
     
@@ -5,6 +5,9 @@ MAX_PAYLOAD_LENGTH  = 0x10000
 CLIENT_MAX_TRIES           = 5
 CLIENT_RETRY_DELAY         = 5
 CLIENT_MAX_FAILURE         = 5
+# wait before sending again an upload the server answered 503 to, when it
+# gives no Retry-After
+CLIENT_BUSY_DELAY          = 1
 
 CLIENT_INITIAL_POLL_INTERVAL       = 0.1        
 CLIENT_POLL_INTERVAL_MULTIPLIER    = 1.5
@@ -12,6 +15,13 @@ CLIENT_MAX_POLL_INTERVAL           = 5
 
 SERVER_TURNAROUND_TIMEOUT          = 0.05
 SERVER_TURNAROUND_MAX              = 0.2
+# longest a request waits for a full upstream queue to drain
+SERVER_BACKPRESSURE_WAIT           = 5
+
+# buffered bytes per queue at which a session stops reading its source,
+# and the level it resumes at
+QUEUE_HIGH_WATERMARK       = 4 * MAX_PAYLOAD_LENGTH
+QUEUE_LOW_WATERMARK        = MAX_PAYLOAD_LENGTH
 
 HEADER_SESSION_ID   = "X-Session-Id"
 HEADER_MSGTYPE      = "X-MsgType"
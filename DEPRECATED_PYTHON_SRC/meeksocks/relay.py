@@ -3,28 +3,35 @@ import logging
 import uuid
 import random
 import ssl
+import time
 from collections import defaultdict
 
 import gevent
 from gevent import select
 from gevent import socket
-from gevent.queue import Queue, LifoQueue
+from gevent.queue import LifoQueue
 from gevent.event import Event
 
 from geventhttpclient import HTTPClient, URL
 
 from gsocks.relay import RelayFactory, RelaySession, RelaySessionError
 from gsocks.msg import Reply, GENERAL_SOCKS_SERVER_FAILURE
-from gsocks.utils import SharedTimer, bind_local_udp, request_fail, request_success, \
-sock_addr_info
+from gsocks.utils import bind_local_udp, request_fail, request_success, sock_addr_info
+from gsocks.timer import default_wheel
+from gsocks.bytequeue import ByteQueue
+from gsocks import metrics
 from constants import SESSION_ID_LENGTH, MAX_PAYLOAD_LENGTH, HEADER_SESSION_ID, \
 HEADER_UDP_PKTS, HEADER_MODE, HEADER_MSGTYPE, MSGTYPE_DATA, MODE_STREAM, \
 HEADER_ERROR, CLIENT_MAX_TRIES, CLIENT_RETRY_DELAY, CLIENT_INITIAL_POLL_INTERVAL, \
 CLIENT_POLL_INTERVAL_MULTIPLIER, CLIENT_MAX_POLL_INTERVAL, MSGTYPE_TERMINATE, \
-CLIENT_MAX_FAILURE
+CLIENT_MAX_FAILURE, CLIENT_BUSY_DELAY, QUEUE_HIGH_WATERMARK, QUEUE_LOW_WATERMARK
 
 log = logging.getLogger(__name__)
 
+meek_up = metrics.relayed_bytes.labels("meek", "up")
+meek_down = metrics.relayed_bytes.labels("meek", "down")
+client_sessions = metrics.meek_sessions.labels("client")
+
 def session_id():
     return str(uuid.uuid4())[:SESSION_ID_LENGTH]
         
@@ -32,6 +39,12 @@ def get_meek_meta(headers, key, default=""):
     # requests lib gives lower-string headers
     return dict(headers).get(key.lower(), default)    
 
+def retry_after(headers):
+    try:
+        return min(max(int(get_meek_meta(headers, "Retry-After", CLIENT_BUSY_DELAY)), 0), CLIENT_RETRY_DELAY)
+    except ValueError:
+        return CLIENT_BUSY_DELAY
+
 class Relay:
     def __init__(self, fronturl="", hostname="", properties="", failure=0):
         self.fronturl = fronturl
@@ -82,15 +95,18 @@ class MeekSession(RelaySession):
         self.udpsock = None
         self.allsocks = [self.socksconn]
         
-        self.l2m_queue = Queue()
-        self.m2l_queue = Queue()
+        # reads from the client pause while l2m_queue is full, and meek
+        # polls while m2l_queue is
+        self.l2m_queue = ByteQueue(meek.high_watermark, meek.low_watermark)
+        self.m2l_queue = ByteQueue(meek.high_watermark, meek.low_watermark)
         self.m_notifier = Event()
         self.l_notifier = Event()
         self.finish = Event()
         self.m_notifier.clear()
         self.l_notifier.clear()
         self.finish.clear()
-        self.timer = SharedTimer(self.meektimeout)
+        self.timer = None
+        client_sessions.inc()
         
     def _stream_response(self, response):
         try:
@@ -143,18 +159,34 @@ class MeekSession(RelaySession):
     
         data = "".join(pkts)
         headers['Content-Length'] = str(len(data))
-        for _ in range(CLIENT_MAX_TRIES):
+        tries = 0
+        while tries < CLIENT_MAX_TRIES:
+            tries += 1
             try:
                 log.debug("%s UP %d bytes" % (self.sessionid, len(data)))
+                start = time.time()
                 resp = self.httpclient.post("/", body=data, headers=headers)
+                metrics.meek_roundtrip_seconds.observe(time.time() - start)
+                if resp.status_code == 503:
+                    # the server holds uploads back while its socks side is
+                    # stalled. that is flow control, not a failure: wait as
+                    # told and send the same upload again.
+                    metrics.meek_roundtrips.labels("busy").inc()
+                    resp.release()
+                    tries -= 1
+                    gevent.sleep(retry_after(resp.headers))
+                    continue
                 if resp.status_code != 200:  
-                    # meek server always give 200, so all non-200s mean external issues. 
+                    # other non-200s mean external issues. the upload is sent again.
+                    metrics.meek_roundtrips.labels("http_error").inc()
                     continue
+                meek_up.inc(len(data))
                 err = get_meek_meta(resp.headers, HEADER_ERROR)
                 if err:
+                    metrics.meek_roundtrips.labels("error").inc()
                     return [("", err)]
                 else:
-                    
+                    metrics.meek_roundtrips.labels("ok").inc()
                     try:
                         return self.meek_response(resp, stream)
                     except Exception as ex:
@@ -162,9 +194,11 @@ class MeekSession(RelaySession):
                         resp.release()
                         return [("", "Data Format Error")]
             except socket.timeout:  # @UndefinedVariable
+                metrics.meek_roundtrips.labels("timeout").inc()
                 return [("", "timeout")]
             except Exception as ex:
                 log.error("[Exception][meek_roundtrip]: %s" % str(ex))
+                metrics.meek_roundtrips.labels("failed").inc()
                 gevent.sleep(CLIENT_RETRY_DELAY)
         self.relay.failure += 1
         return [("", "Max Retry (%d) Exceeded" % CLIENT_MAX_TRIES)]
@@ -194,8 +228,11 @@ class MeekSession(RelaySession):
             if err:
                 return err
             if resp:
+                meek_down.inc(len(resp))
                 self.m2l_queue.put(resp)
                 self.l_notifier.set()
+                # a streamed response is only read on while the client keeps up
+                self.m2l_queue.wait_writable()
         return ""
                 
     def meek_relay_thread(self):
@@ -204,9 +241,15 @@ class MeekSession(RelaySession):
             try:
                 hasdata = self.m_notifier.wait(timeout=interval)
                 self.m_notifier.clear()
+                self.m2l_queue.wait_writable()
                 err = self.meek_relay() 
                 if err:
                     break                
+                if self.early_data:
+                    # meek server parses the request alone, send early data after it
+                    self.l2m_queue.put(self.early_data)
+                    self.early_data = ""
+                    self.m_notifier.set()
                 if not hasdata:
                     interval *= CLIENT_POLL_INTERVAL_MULTIPLIER
                     if interval > CLIENT_MAX_POLL_INTERVAL:
@@ -225,27 +268,20 @@ class MeekSession(RelaySession):
     def meek_write_to_client_thread(self):
         while not self.finish.is_set():
             try:
-                hasdata = self.l_notifier.wait(timeout=CLIENT_MAX_POLL_INTERVAL)
+                self.l_notifier.wait()
                 self.l_notifier.clear()
-                if not hasdata:
-                    self.timer.count(CLIENT_MAX_POLL_INTERVAL)
-                    if self.timer.timeout():
-                        break
-                else:
-                    self.timer.reset()
-                    while not self.m2l_queue.empty():
-                        data = self.m2l_queue.get()
-                        if data:
-                            self.write_to_client(data)
+                self.timer.reset()
+                while not self.m2l_queue.empty():
+                    data = self.m2l_queue.get()
+                    if data:
+                        self.write_to_client(data)
             except Exception as ex:
                 log.error("[Exception][meek_write_to_client_thread]: %s" % str(ex))
                 break
         self.finish.set()
         
-    def read_from_client(self, timeout):
-        readable, _, _ = select.select(self.allsocks, [], [], CLIENT_MAX_POLL_INTERVAL)
-        if not readable:
-            return None
+    def read_from_client(self):
+        readable, _, _ = select.select(self.allsocks, [], [])
         if self.socksconn in readable:
             if self.udpsock:
                 raise RelaySessionError("unexcepted read-event from tcp socket in UDP session")
@@ -264,12 +300,9 @@ class MeekSession(RelaySession):
     def meek_read_from_client_thread(self):
         while not self.finish.is_set():
             try:
-                data = self.read_from_client(CLIENT_MAX_POLL_INTERVAL)
-                if not data:
-                    self.timer.count(CLIENT_MAX_POLL_INTERVAL)
-                    if self.timer.timeout():
-                        break
-                else:
+                self.l2m_queue.wait_writable()
+                data = self.read_from_client()
+                if data:
                     self.timer.reset() 
                     self.l2m_queue.put(data)
                     self.m_notifier.set()
@@ -281,14 +314,31 @@ class MeekSession(RelaySession):
     def proc_tcp_request(self, req):
         self.l2m_queue.put(req.pack())
     
+    def expire(self):
+        log.info("Session %s idle timeout" % self.sessionid)
+        self.finish.set()
+        
+    def run_threads(self):
+        """ run the three relay threads until one of them ends or the
+        session idles out.
+        """
+        self.timer = default_wheel.arm(self.meektimeout, self.expire)
+        threads = [
+            gevent.spawn(self.meek_read_from_client_thread),
+            gevent.spawn(self.meek_write_to_client_thread),
+            gevent.spawn(self.meek_relay_thread),
+        ]
+        try:
+            self.finish.wait()
+        finally:
+            self.timer.cancel()
+            gevent.killall(threads)
+        log.info("Session %s Ended" % self.sessionid)
+        
     def relay_tcp(self):
-        read_thread = gevent.spawn(self.meek_read_from_client_thread)
-        write_thread = gevent.spawn(self.meek_write_to_client_thread)
-        relay_thread = gevent.spawn(self.meek_relay_thread)
         # notify relay to send request
         self.m_notifier.set()
-        [t.join() for t in (read_thread, write_thread, relay_thread)]
-        log.info("Session %s Ended" % self.sessionid)
+        self.run_threads()
         
     def valid_udp_client(self, addr):
         if  self.client_associate[0] == "0.0.0.0" or \
@@ -313,13 +363,8 @@ class MeekSession(RelaySession):
             return
         self.track_sock(self.udpsock)
         
-        read_thread = gevent.spawn(self.meek_read_from_client_thread)
-        write_thread = gevent.spawn(self.meek_write_to_client_thread)
-        relay_thread = gevent.spawn(self.meek_relay_thread)
-        
         request_success(self.socksconn, *sock_addr_info(self.udpsock))
-        [t.join() for t in (read_thread, write_thread, relay_thread)]
-        log.info("Session %s Ended" % self.sessionid)
+        self.run_threads()
         
     def meek_terminate(self):
         headers = {
@@ -336,6 +381,7 @@ class MeekSession(RelaySession):
             pass
     
     def clean(self):
+        client_sessions.dec()
         self.meek_terminate()
         for sock in self.allsocks:
             sock.close()
@@ -343,10 +389,13 @@ class MeekSession(RelaySession):
         self.conn_pool.release(self.relay, self.httpclient)
         
 class MeekRelayFactory(RelayFactory):
-    def __init__(self, relays, ca_certs="", timeout=60):     
+    def __init__(self, relays, ca_certs="", timeout=60,
+                 high_watermark=QUEUE_HIGH_WATERMARK, low_watermark=QUEUE_LOW_WATERMARK):     
         self.relays = relays
         self.timeout = timeout
         self.ca_certs = ca_certs
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
         
     def set_relays(self, relays):
         self.relays = relays
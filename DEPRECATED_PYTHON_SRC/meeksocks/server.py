@@ -10,20 +10,22 @@ if _platform == "linux" or _platform == "linux2":
 
 import gevent
 from gevent import select
-from gevent import socket
 from gevent.pywsgi import WSGIServer
-from gevent.queue import Queue, Empty
+from gevent.queue import Empty
 from gevent.event import Event
 
 from gsocks.server import SocksServer
 from gsocks.relay import SocksRelayFactory, RelaySessionError
-from gsocks.utils import SharedTimer, read_init_reply, bind_local_udp, sock_addr_info, \
-read_reply
+from gsocks.utils import read_init_reply, bind_local_udp, sock_addr_info, read_reply
+from gsocks.timer import default_wheel
+from gsocks.bytequeue import ByteQueue
+from gsocks import dial
+from gsocks import metrics
 from gsocks.msg import InitRequest, Request, UDP_ASSOCIATE, CONNECT, BIND
 from constants import MAX_PAYLOAD_LENGTH, HEADER_SESSION_ID, HEADER_UDP_PKTS, \
 HEADER_MODE, HEADER_MSGTYPE, MSGTYPE_DATA, MODE_STREAM, HEADER_ERROR, \
-CLIENT_MAX_POLL_INTERVAL, MSGTYPE_TERMINATE, SERVER_TURNAROUND_TIMEOUT, \
-SERVER_TURNAROUND_MAX
+MSGTYPE_TERMINATE, SERVER_TURNAROUND_TIMEOUT, SERVER_TURNAROUND_MAX, \
+SERVER_BACKPRESSURE_WAIT, QUEUE_HIGH_WATERMARK, QUEUE_LOW_WATERMARK
 
 log = logging.getLogger(__name__)
 
@@ -37,15 +39,23 @@ class globalvars(object):
     socksip         = "0.0.0.0"
     socksport       = 1080
     sockstimeout    = 60
+    high_watermark  = QUEUE_HIGH_WATERMARK
+    low_watermark   = QUEUE_LOW_WATERMARK
     
 class options(object):
     daemonize = False
     logginglevel = logging.INFO
     pidfile   = "meeksocks_server.pid"
     logfile   = "meeksocks_server.log"
+    metrics   = 0
+
+metrics.meek_sessions.labels("server").set_function(lambda: len(globalvars.meek_sessions))
+meek_up = metrics.relayed_bytes.labels("meek", "up")
+meek_down = metrics.relayed_bytes.labels("meek", "down")
 
 class MeekSession(object):
-    def __init__(self, sessionid, socksip, socksport, timeout, sessionmap):
+    def __init__(self, sessionid, socksip, socksport, timeout, sessionmap,
+                 high_watermark=QUEUE_HIGH_WATERMARK, low_watermark=QUEUE_LOW_WATERMARK):
         self.sessionid = sessionid
         self.socksip = socksip
         self.socksport = socksport
@@ -59,21 +69,33 @@ class MeekSession(object):
         self.status = SESSION_WAIT_INIT
         
         self.initialized = False
-        self.in_queue = Queue()
+        # both queues are bounded by their watermarks: in_queue by making
+        # requests wait, out_queue by pausing reads from socks
+        self.in_queue = ByteQueue(high_watermark, low_watermark)
         self.in_notifier = Event()
         self.in_notifier.clear()
-        self.out_queue = Queue()
-        self.timer = SharedTimer(self.timeout)
+        self.out_queue = ByteQueue(high_watermark, low_watermark)
+        self.timer = None
         self.finish = Event()
         self.finish.clear()
         
         self.threads = []
     
     def meeks_clean_thread(self):
-        while not self.finish.is_set():
-            gevent.sleep(SERVER_TURNAROUND_MAX)
-        [t.join() for t in self.threads]
+        self.finish.wait()
+        gevent.killall(self.threads)
         self.clean()
+        
+    def expire(self):
+        log.info("%s: idle timeout" % self.sessionid)
+        self.finish.set()
+        
+    def start_threads(self):
+        self.timer = default_wheel.arm(self.timeout, self.expire)
+        self.threads.append(gevent.spawn(self.meeks_write_to_socks_thread))
+        self.threads.append(gevent.spawn(self.meeks_read_from_socks_thread))
+        # clean_thread will stop the other two threads, then clean resources
+        gevent.spawn(self.meeks_clean_thread)
             
     def write_to_socks(self, data):
         if self.udpsock:
@@ -84,12 +106,8 @@ class MeekSession(object):
     def meeks_write_to_socks_thread(self):
         while not self.finish.is_set():
             try:
-                hasdata = self.in_notifier.wait(timeout=CLIENT_MAX_POLL_INTERVAL)
+                self.in_notifier.wait()
                 self.in_notifier.clear()
-                if not hasdata:
-                    self.timer.count(CLIENT_MAX_POLL_INTERVAL)
-                if self.timer.timeout():
-                    break
                 self.timer.reset()
                 while not self.in_queue.empty():
                     data = self.in_queue.get()
@@ -103,32 +121,29 @@ class MeekSession(object):
     def meeks_read_from_socks_thread(self):
         while not self.finish.is_set():
             try:
-                readable, _, _ = select.select(self.allsocks, [], [], CLIENT_MAX_POLL_INTERVAL)
-                if not readable:
-                    self.timer.count(CLIENT_MAX_POLL_INTERVAL)
-                    if self.timer.timeout():
-                        break
-                else:
-                    self.timer.reset()
-                    if self.socksconn in readable:
-                        if self.udpsock:
-                            raise RelaySessionError("unexcepted read-event from tcp socket in UDP session")
-                        data = self.socksconn.recv(MAX_PAYLOAD_LENGTH)
-                        if not data:
-                            raise RelaySessionError("peer closed")
+                # leave data in the socket while the client is behind
+                self.out_queue.wait_writable()
+                readable, _, _ = select.select(self.allsocks, [], [])
+                self.timer.reset()
+                if self.socksconn in readable:
+                    if self.udpsock:
+                        raise RelaySessionError("unexcepted read-event from tcp socket in UDP session")
+                    data = self.socksconn.recv(MAX_PAYLOAD_LENGTH)
+                    if not data:
+                        raise RelaySessionError("peer closed")
+                    self.out_queue.put(data)
+                    continue
+                if self.udpsock and self.udpsock in readable:
+                    data, _ = self.udpsock.recvfrom(MAX_PAYLOAD_LENGTH)
+                    if data:
                         self.out_queue.put(data)
-                        continue
-                    if self.udpsock and self.udpsock in readable:
-                        data, _ = self.udpsock.recvfrom(MAX_PAYLOAD_LENGTH)
-                        if data:
-                            self.out_queue.put(data)
             except Exception as ex:
                 log.error("[Exception][meeks_read_from_socks_thread] %s:%s" % (self.sessionid, str(ex)))
                 break
         self.finish.set()
         
     def initialize(self):
-        self.socksconn = socket.create_connection((self.socksip, self.socksport), self.timeout)
+        self.socksconn = dial.create_connection((self.socksip, self.socksport), self.timeout)
         self.allsocks = [self.socksconn]
         self.socksconn.sendall(InitRequest().pack())
         read_init_reply(self.socksconn)
@@ -144,10 +159,7 @@ class MeekSession(object):
             (HEADER_MSGTYPE, MSGTYPE_DATA)
         ]
         
-        self.threads.append(gevent.spawn(self.meeks_write_to_socks_thread))
-        self.threads.append(gevent.spawn(self.meeks_read_from_socks_thread))
-        # clean_thread will join the other two threads, then clean resources
-        gevent.spawn(self.meeks_clean_thread)
+        self.start_threads()
         self.status = SESSION_TCP
         return resp, headers
         
@@ -165,10 +177,7 @@ class MeekSession(object):
         ]
         
         self.udp_associate = (reply.bndaddr, reply.bndport)
-        self.threads.append(gevent.spawn(self.meeks_write_to_socks_thread))
-        self.threads.append(gevent.spawn(self.meeks_read_from_socks_thread))
-        # clean_thread will join the other two threads, then clean resources
-        gevent.spawn(self.meeks_clean_thread)
+        self.start_threads()
         self.status = SESSION_UDP
         return resp, headers
     
@@ -249,11 +258,13 @@ class MeekSession(object):
     
     def clean(self):
         self.finish.set()
+        if self.timer:
+            self.timer.cancel()
         for sock in self.allsocks:
             sock.close()
             
-        self.in_queue.queue.clear()
-        self.out_queue.queue.clear()
+        self.in_queue.clear()
+        self.out_queue.clear()
         if self.sessionid in self.sessionmap:
             del self.sessionmap[self.sessionid]
             log.info("%s: quit, %d sessions left" % (self.sessionid, len(self.sessionmap.keys())))
@@ -273,6 +284,7 @@ def meek_tcp_stream(status, response_headers, session, data, start_response):
         while not session.out_queue.empty():
             pkt = session.out_queue.get()
             log.debug("%s: RELAY-DOWN streaming %d bytes" % (session.sessionid, len(pkt)))
+            meek_down.inc(len(pkt))
             yield pkt
         try:
             session.out_queue.peek(block=True, timeout=SERVER_TURNAROUND_TIMEOUT)
@@ -313,9 +325,17 @@ def meek_server_application(env, start_response):
     if not session:
         log.info("%s: new session created" % sessionid)
         session = MeekSession(sessionid, globalvars.socksip,    
-                globalvars.socksport, globalvars.sockstimeout, globalvars.meek_sessions)
+                globalvars.socksport, globalvars.sockstimeout, globalvars.meek_sessions,
+                globalvars.high_watermark, globalvars.low_watermark)
     
+    # hold the upload back while socks is not taking what was sent before,
+    # and refuse it unread if that lasts: the client sends it again
+    if not session.in_queue.wait_writable(SERVER_BACKPRESSURE_WAIT):
+        log.debug("%s: upload refused, socks side stalled" % sessionid)
+        start_response("503 Service Unavailable", response_headers + [("Retry-After", "1")])
+        return ""
     data = env['wsgi.input'].read()
+    meek_up.inc(len(data))
     log.debug("%s: request with %d data" % (sessionid, len(data)))
     if env.get(header_to_env(HEADER_MODE), "") == MODE_STREAM and session.status == SESSION_TCP:
         return meek_tcp_stream(status, response_headers, session, data, start_response)
@@ -323,6 +343,7 @@ def meek_server_application(env, start_response):
         try:
             response, headers = session.process(data, env.copy())
             log.debug("%s: RELAY-DOWN %d bytes" % (session.sessionid, len(response)))
+            meek_down.inc(len(response))
             response_headers += headers
             start_response(status, response_headers)
             return [response]
@@ -343,6 +364,7 @@ Options:
   -d, --debug       more verbose logging
   -p, --pidfile     file to write pid, implies daemonization.
   -l, --logfile     file to write log, also implies daemonization.
+  -m, --metrics     local port to serve metrics on.
 """
 
 def main():
@@ -355,8 +377,8 @@ def main():
     socksip = sys.argv[3]
     socksport = int(sys.argv[4])
     
-    opts, _ = getopt.gnu_getopt(sys.argv[5:], "hdp:l:",
-                            ["help", "debug", "pidfile=", "logfile="])
+    opts, _ = getopt.gnu_getopt(sys.argv[5:], "hdp:l:m:",
+                            ["help", "debug", "pidfile=", "logfile=", "metrics="])
     for o, a in opts:
         if o == "-h" or o == "--help":
             usage()
@@ -369,6 +391,8 @@ def main():
         elif o == "-l" or o == "--logfile":
             options.daemonize = True
             options.logfile = a
+        elif o == "-m" or o == "--metrics":
+            options.metrics = int(a)
             
     if options.daemonize:
         pid = os.fork()
@@ -394,6 +418,8 @@ def main():
     
     socks = SocksServer(socksip, socksport, SocksRelayFactory(), timeout=30, maxclient=500)
     socks.start()
+    if options.metrics:
+        metrics.MetricsServer("127.0.0.1", options.metrics).start()
 
     globalvars.socksip = socksip
     globalvars.socksport = socksport
@@ -53,7 +53,10 @@ def get_int(data, key, default):
         print e
         return default
             
-def update_config(update, reboot=True, ipc=True, reload_hosts=False):
+# local proxy settings are applied by reloading the proxies, which hand
+# their listening sockets over and drain. the circumvention channel, and
+# so its settings and a reset to the default config, still need a reboot.
+def update_config(update, reboot=True, ipc=True, reload_hosts=False, reload_proxy=False):
     global coordinator, need_reboot
     
     try:
@@ -70,6 +73,8 @@ def update_config(update, reboot=True, ipc=True, reload_hosts=False):
             
         # update local confdata so webpage displays updated values
         coordinator.get('confdata').update(updated)
+        if reload_proxy:
+            coordinator.IPC_reload_local_proxy()
         if reboot:
             need_reboot = True
         web.header('Content-Type', 'application/json')
@@ -182,7 +187,7 @@ class localproxy_settings:
             resp = json.dumps([{'message': u'数据格式错误'}])
             raise web.HTTPError(status, headers, unicode(resp))
         
-        return update_config(update)
+        return update_config(update, reboot=False, reload_proxy=True)
         
 class browser_settings:
     def POST(self):